@@ -31,8 +31,40 @@ bl_info = {
 
 import bpy
 
-from .ops import FLOWMAP_OT_FLOW_MAP_PAINT_2D, FLOWMAP_OT_FLOW_MAP_PAINT_3D, FLOWMAP_OT_FLOW_MAP_PAINT_VERTCOL
+from .ops import (
+    FLOWMAP_OT_FLOW_MAP_PAINT_2D,
+    FLOWMAP_OT_FLOW_MAP_PAINT_3D,
+    FLOWMAP_OT_FLOW_MAP_PAINT_VERTCOL,
+    FLOWMAP_OT_REPLAY_STROKES,
+    FLOWMAP_OT_EXPORT_TIMINGS,
+    FLOWMAP_OT_UNDO_STROKE,
+    FLOWMAP_OT_BAKE_CURVE_FLOW,
+    FLOWMAP_OT_POST_PROCESS,
+)
 from .props import FlowmapPainterProperties
+from . import funcs
+from . import vars
+
+
+def draw_timings(layout, stage_timings):
+    """p50 and p95 of every stage of the last paint session, in milliseconds"""
+
+    box = layout.box()
+    split = box.split(factor=0.5)
+    column_stage = split.column()
+    column_p50 = split.column()
+    column_p95 = split.column()
+    column_stage.label(text="Stage")
+    column_p50.label(text="p50 ms")
+    column_p95.label(text="p95 ms")
+
+    for row in stage_timings.summary():
+        column_stage.label(text=row["stage"])
+        column_p50.label(text="%.2f" % (row["p50"] * 1000))
+        column_p95.label(text="%.2f" % (row["p95"] * 1000))
+
+    box.operator("flowmap.export_timings", text="Export Timings", icon='EXPORT')
+    return None
 
 
 def draw_interface(self, context, mode):
@@ -58,10 +90,74 @@ def draw_interface(self, context, mode):
             column2.label(text="Object")
             column3.prop_search(context.scene.flowmap_painter_props, "object", context.scene, "objects", text="")
 
+    # paint engine
+    column1.label(icon='BRUSH_DATA')
+    column2.label(text="Paint Engine")
+    column3.prop(context.scene.flowmap_painter_props, "paint_engine", text="")
+
+    if context.scene.flowmap_painter_props.paint_engine == "direct":
+        column1.label(text="")
+        column2.label(text="Update Interval")
+        column3.prop(context.scene.flowmap_painter_props, "flush_interval", text="")
+
+        if mode == '3D_PAINT':
+            column1.label(icon='UV_EDGESEL')
+            column2.label(text="Seam Splatting")
+            column3.prop(context.scene.flowmap_painter_props, "seam_splatting", text="")
+
+        column1.label(icon='SETTINGS')
+        column2.label(text="Background")
+        column3.prop(context.scene.flowmap_painter_props, "background_compositing", text="")
+
+        column1.label(icon='LOOP_BACK')
+        column2.label(text="Undo Memory MB")
+        column3.prop(context.scene.flowmap_painter_props, "undo_memory", text="")
+
+        column1.label(icon='DISK_DRIVE')
+        column2.label(text="Scratch Buffer")
+        column3.prop(context.scene.flowmap_painter_props, "scratch_buffer", text="")
+        if context.scene.flowmap_painter_props.scratch_buffer:
+            column1.label(text="")
+            column2.label(text="Scratch Channels")
+            column3.prop(context.scene.flowmap_painter_props, "scratch_channels", text="")
+
+        column1.label(icon='UV')
+        column2.label(text="UDIM Tiles")
+        column3.prop(context.scene.flowmap_painter_props, "udim_tile_cache", text="")
+
+        column1.label(text="")
+        column2.label(text="Save UDIM")
+        column3.prop(context.scene.flowmap_painter_props, "udim_save_changes", text="")
+
+    # udim strokes work on the tile files, unsaved changes have to be saved first
+    if context.scene.flowmap_painter_props.paint_engine == "direct" and mode != 'VERTEX_PAINT':
+        image = funcs.get_paint_image(context, mode=mode)
+        if (
+            image is not None
+            and image.source == 'TILED'
+            and image.is_dirty
+            and not context.scene.flowmap_painter_props.udim_save_changes
+        ):
+            column1.label(icon='ERROR')
+            column2.label(text="Unsaved UDIM")
+            column3.label(text="Save it or turn on Save UDIM")
+
     # spacing
     column1.label(icon='ONIONSKIN_ON')
     column2.label(text="Brush Spacing")
-    column3.prop(context.scene.flowmap_painter_props, "brush_spacing", slider=True, text="")
+    if mode == 'VERTEX_PAINT' or context.scene.flowmap_painter_props.spacing_mode == "screen":
+        column3.prop(context.scene.flowmap_painter_props, "brush_spacing", slider=True, text="")
+    else:
+        column3.prop(context.scene.flowmap_painter_props, "texel_spacing", slider=True, text="")
+    if mode != 'VERTEX_PAINT':
+        column1.label(text="")
+        column2.label(text="Spacing Mode")
+        column3.prop(context.scene.flowmap_painter_props, "spacing_mode", text="")
+
+    # smoothing
+    column1.label(icon='SMOOTHCURVE')
+    column2.label(text="Smooth Stroke")
+    column3.prop(context.scene.flowmap_painter_props, "smooth_stroke", text="")
 
     # trace distance
     if mode == '3D_PAINT' or mode == 'VERTEX_PAINT':
@@ -69,6 +165,28 @@ def draw_interface(self, context, mode):
         column2.label(text="Trace Distance")
         column3.prop(context.scene.flowmap_painter_props, "trace_distance", slider=True, text="")
 
+        column1.label(icon='TIME')
+        column2.label(text="Frame Budget")
+        column3.prop(context.scene.flowmap_painter_props, "frame_budget", text="")
+
+    # recording
+    column1.label(icon='REC')
+    column2.label(text="Record Strokes")
+    column3.prop(context.scene.flowmap_painter_props, "record_strokes", text="")
+
+    if context.scene.flowmap_painter_props.record_strokes:
+        column1.label(text="")
+        column2.label(text="Record Path")
+        column3.prop(context.scene.flowmap_painter_props, "record_path", text="")
+
+    # timings
+    column1.label(icon='SORTTIME')
+    column2.label(text="Collect Timings")
+    column3.prop(context.scene.flowmap_painter_props, "collect_timings", text="")
+
+    if context.scene.flowmap_painter_props.collect_timings and vars.stage_timings is not None:
+        draw_timings(self.layout, vars.stage_timings)
+
     # exit
     self.layout.separator()
 
@@ -92,9 +210,57 @@ def draw_interface(self, context, mode):
         self.layout.operator("flowmap.flow_map_paint_two_d", text="Flowmap 2D Paint Mode", icon='ANIM_DATA')
     if mode == '3D_PAINT':
         self.layout.operator("flowmap.flow_map_paint_three_d", text="Flowmap 3D Paint Mode", icon='ANIM_DATA')
+
+        # curve bake
+        self.layout.separator()
+        split_bake = self.layout.split(factor=0.55)
+        split_bake_labels = split_bake.split(factor=0.15)
+        column_bake1 = split_bake_labels.column()
+        column_bake2 = split_bake_labels.column()
+        column_bake3 = split_bake.column()
+
+        column_bake1.label(icon='CURVE_DATA')
+        column_bake2.label(text="Bake Image")
+        column_bake3.prop(context.scene.flowmap_painter_props, "bake_image", text="")
+
+        column_bake1.label(text="")
+        column_bake2.label(text="Blend Distance")
+        column_bake3.prop(context.scene.flowmap_painter_props, "bake_blend_distance", text="")
+
+        self.layout.operator("flowmap.bake_curve_flow", text="Bake Curve Flow", icon='RENDER_STILL')
+
+    # post process
+    if mode == '2D_PAINT' or mode == '3D_PAINT':
+        self.layout.separator()
+        split_post = self.layout.split(factor=0.55)
+        split_post_labels = split_post.split(factor=0.15)
+        column_post1 = split_post_labels.column()
+        column_post2 = split_post_labels.column()
+        column_post3 = split_post.column()
+
+        column_post1.label(icon='FULLSCREEN_ENTER')
+        column_post2.label(text="Padding")
+        column_post3.prop(context.scene.flowmap_painter_props, "post_padding", text="")
+
+        column_post1.label(icon='MOD_SMOOTH')
+        column_post2.label(text="Blur Radius")
+        column_post3.prop(context.scene.flowmap_painter_props, "post_blur_radius", text="")
+
+        row = self.layout.row(align=True)
+        row.operator("flowmap.post_process", text="Renormalize", icon='NORMALIZE_FCURVES').process = "renormalize"
+        row.operator("flowmap.post_process", text="Dilate", icon='FULLSCREEN_ENTER').process = "dilate"
+        row.operator("flowmap.post_process", text="Blur", icon='MOD_SMOOTH').process = "blur"
+
     if mode == 'VERTEX_PAINT':
         self.layout.operator("flowmap.flow_map_paint_vcol", text="Flowmap Vertex Paint Mode", icon='ANIM_DATA')
 
+    if context.scene.flowmap_painter_props.paint_engine == "direct":
+        row = self.layout.row(align=True)
+        row.operator("flowmap.undo_stroke", text="Undo Stroke", icon='LOOP_BACK').redo = False
+        row.operator("flowmap.undo_stroke", text="Redo Stroke", icon='LOOP_FORWARDS').redo = True
+
+    self.layout.operator("flowmap.replay_strokes", text="Replay Strokes", icon='PLAY')
+
     self.layout.separator()
 
 
@@ -157,17 +323,34 @@ def register():
     bpy.utils.register_class(FLOWMAP_OT_FLOW_MAP_PAINT_2D)
     bpy.utils.register_class(FLOWMAP_OT_FLOW_MAP_PAINT_3D)
     bpy.utils.register_class(FLOWMAP_OT_FLOW_MAP_PAINT_VERTCOL)
+    bpy.utils.register_class(FLOWMAP_OT_REPLAY_STROKES)
+    bpy.utils.register_class(FLOWMAP_OT_EXPORT_TIMINGS)
+    bpy.utils.register_class(FLOWMAP_OT_UNDO_STROKE)
+    bpy.utils.register_class(FLOWMAP_OT_BAKE_CURVE_FLOW)
+    bpy.utils.register_class(FLOWMAP_OT_POST_PROCESS)
 
     # PANELS
     bpy.utils.register_class(FLOWMAP_PT_FLOW_MAP_PAINT_2D)
     bpy.utils.register_class(FLOWMAP_PT_FLOW_MAP_PAINT_3D)
     bpy.utils.register_class(FLOWMAP_PT_FLOW_MAP_PAINT_VERTCOL)
 
+    # HANDLERS
+    bpy.app.handlers.depsgraph_update_post.append(funcs.mesh_cache_depsgraph_update)
+    bpy.app.handlers.load_post.append(funcs.mesh_cache_load_post)
+
     return None
 
 
 def unregister():
 
+    # HANDLERS
+    if funcs.mesh_cache_depsgraph_update in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(funcs.mesh_cache_depsgraph_update)
+    if funcs.mesh_cache_load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(funcs.mesh_cache_load_post)
+    vars.mesh_cache = None
+    funcs.stop_dab_worker()
+
     # PROPS
     del bpy.types.Scene.flowmap_painter_props
     bpy.utils.unregister_class(FlowmapPainterProperties)
@@ -176,6 +359,11 @@ def unregister():
     bpy.utils.unregister_class(FLOWMAP_OT_FLOW_MAP_PAINT_2D)
     bpy.utils.unregister_class(FLOWMAP_OT_FLOW_MAP_PAINT_3D)
     bpy.utils.unregister_class(FLOWMAP_OT_FLOW_MAP_PAINT_VERTCOL)
+    bpy.utils.unregister_class(FLOWMAP_OT_REPLAY_STROKES)
+    bpy.utils.unregister_class(FLOWMAP_OT_EXPORT_TIMINGS)
+    bpy.utils.unregister_class(FLOWMAP_OT_UNDO_STROKE)
+    bpy.utils.unregister_class(FLOWMAP_OT_BAKE_CURVE_FLOW)
+    bpy.utils.unregister_class(FLOWMAP_OT_POST_PROCESS)
 
     # PANELS
     bpy.utils.unregister_class(FLOWMAP_PT_FLOW_MAP_PAINT_2D)
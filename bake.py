@@ -0,0 +1,302 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import contextlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from mathutils.kdtree import KDTree
+
+# texels x segments per distance block, bounds the memory of one block to some megabytes
+MAX_BLOCK_ELEMENTS = 1000000
+# tolerance of the inside test, so texels on shared uv edges are not lost
+BARYCENTRIC_EPSILON = 1e-6
+DISTANCE_EPSILON = 1e-6
+
+
+def spline_curve_edges(obj, depsgraph):
+    """object space vertices and edges of the evaluated splines of a curve object
+
+    the edges of an evaluated curve follow the spline, from the first to the last point,
+    as long as there is no bevel, extrusion or fill, see flat_curves
+    """
+
+    obj_eval = obj.evaluated_get(depsgraph)
+    mesh = obj_eval.to_mesh()
+    try:
+        vertices = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float64)
+        mesh.vertices.foreach_get("co", vertices)
+        edges = numpy.empty(len(mesh.edges) * 2, dtype=numpy.int32)
+        mesh.edges.foreach_get("vertices", edges)
+    finally:
+        obj_eval.to_mesh_clear()
+    return vertices.reshape(-1, 3), edges.reshape(-1, 2)
+
+
+def hair_curve_edges(obj, depsgraph):
+    """object space points and the edges between consecutive points of every curve of a hair curves object"""
+
+    curves = obj.evaluated_get(depsgraph).data
+    positions = numpy.empty(len(curves.points) * 3, dtype=numpy.float64)
+    curves.position_data.foreach_get("vector", positions)
+    offsets = numpy.empty(len(curves.curves) + 1, dtype=numpy.int64)
+    curves.curve_offset_data.foreach_get("value", offsets)
+
+    # every point is connected to the next one, unless that one starts a new curve
+    point_count = len(positions) // 3
+    is_first = numpy.zeros(point_count + 1, dtype=bool)
+    is_first[offsets] = True
+    starts = numpy.flatnonzero(~is_first[1:point_count])
+    return positions.reshape(-1, 3), numpy.column_stack((starts, starts + 1))
+
+
+@contextlib.contextmanager
+def flat_curves(curve_objects, depsgraph):
+    """evaluate the curve objects without bevel, extrusion and fill, so their meshes have no cross section edges"""
+
+    saved = {}
+    for obj in curve_objects:
+        curve = obj.data
+        if obj.type != 'CURVE' or curve in saved:
+            continue
+        saved[curve] = (curve.bevel_depth, curve.extrude, curve.bevel_object, curve.fill_mode)
+        curve.bevel_depth = 0
+        curve.extrude = 0
+        curve.bevel_object = None
+        if curve.dimensions == '2D':
+            curve.fill_mode = 'NONE'
+    depsgraph.update()
+
+    try:
+        yield
+    finally:
+        for curve, (bevel_depth, extrude, bevel_object, fill_mode) in saved.items():
+            curve.bevel_depth = bevel_depth
+            curve.extrude = extrude
+            curve.bevel_object = bevel_object
+            curve.fill_mode = fill_mode
+        depsgraph.update()
+
+
+class CurveSegments:
+    """world space line segments of the evaluated curve and hair curves objects, with a kd tree over their midpoints"""
+
+    def __init__(self, curve_objects, depsgraph):
+        starts = []
+        ends = []
+        with flat_curves(curve_objects, depsgraph):
+            for obj in curve_objects:
+                if obj.type == 'CURVES':
+                    vertices, edges = hair_curve_edges(obj, depsgraph)
+                else:
+                    vertices, edges = spline_curve_edges(obj, depsgraph)
+
+                matrix = numpy.array(obj.matrix_world, dtype=numpy.float64)
+                vertices = vertices @ matrix[:3, :3].T + matrix[:3, 3]
+                starts.append(vertices[edges[:, 0]])
+                ends.append(vertices[edges[:, 1]])
+
+        self.starts = numpy.concatenate(starts) if starts else numpy.empty((0, 3))
+        ends = numpy.concatenate(ends) if ends else numpy.empty((0, 3))
+        self.vectors = ends - self.starts
+
+        lengths = numpy.linalg.norm(self.vectors, axis=1)
+        keep = lengths > 0
+        self.starts = self.starts[keep]
+        self.vectors = self.vectors[keep]
+        lengths = lengths[keep]
+        self.tangents = self.vectors / lengths[:, numpy.newaxis]
+        self.inv_squared_lengths = 1.0 / (lengths * lengths)
+        self.max_half_length = float(lengths.max()) * 0.5 if len(lengths) else 0.0
+
+        midpoints = self.starts + self.vectors * 0.5
+        self.tree = KDTree(len(midpoints))
+        for index, co in enumerate(midpoints.tolist()):
+            self.tree.insert(co, index)
+        self.tree.balance()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def candidates(self, points, blend_distance):
+        """indices of all segments, that can be the nearest or within blend distance of it, for any of the points"""
+
+        center = points.mean(axis=0)
+        half_extent = float(numpy.linalg.norm(points - center, axis=1).max())
+
+        # the nearest midpoint bounds the distance of every point to its nearest segment from above,
+        # a segment further away than that plus the blend distance can not contribute
+        _, _, nearest_distance = self.tree.find(center)
+        radius = nearest_distance + 2 * half_extent + blend_distance + self.max_half_length
+        return numpy.array([index for _, index, _ in self.tree.find_range(center, radius)], dtype=numpy.intp)
+
+    def blended_tangents(self, points, candidates, blend_distance):
+        """inverse distance weighted tangent of the segments within blend distance of the nearest one, per point"""
+
+        starts = self.starts[candidates][numpy.newaxis]
+        vectors = self.vectors[candidates][numpy.newaxis]
+        inv_squared_lengths = self.inv_squared_lengths[candidates][numpy.newaxis]
+        tangents = self.tangents[candidates]
+
+        block_size = max(MAX_BLOCK_ELEMENTS // max(len(candidates), 1), 1)
+        result = numpy.empty((len(points), 3))
+        for block_start in range(0, len(points), block_size):
+            block = points[block_start:block_start + block_size, numpy.newaxis]
+            offsets = block - starts
+            t = numpy.clip(numpy.sum(offsets * vectors, axis=2) * inv_squared_lengths, 0.0, 1.0)
+            distances = numpy.linalg.norm(offsets - vectors * t[:, :, numpy.newaxis], axis=2)
+
+            nearest = distances.min(axis=1, keepdims=True)
+            weights = numpy.where(distances <= nearest + blend_distance, 1.0 / (distances + DISTANCE_EPSILON)**2, 0.0)
+            result[block_start:block_start + block_size] = weights @ tangents
+
+        return result
+
+
+class UvRaster:
+    """per triangle tables to find the triangle and surface position of every texel center in uv space"""
+
+    def __init__(self, snapshot, matrix_world, width, height):
+        self.width = width
+        self.height = height
+
+        uvs = snapshot.triangle_uvs.astype(numpy.float64)
+        self.uv_origins = uvs[:, 0]
+
+        # range of texel centers inside the uv bounding box of every triangle
+        texels = uvs * numpy.array([width, height], dtype=numpy.float64)
+        self.x_min = numpy.maximum(numpy.ceil(texels[:, :, 0].min(axis=1) - 0.5), 0).astype(numpy.int64)
+        self.x_max = numpy.minimum(numpy.floor(texels[:, :, 0].max(axis=1) - 0.5), width - 1).astype(numpy.int64)
+        self.y_min = numpy.maximum(numpy.ceil(texels[:, :, 1].min(axis=1) - 0.5), 0).astype(numpy.int64)
+        self.y_max = numpy.minimum(numpy.floor(texels[:, :, 1].max(axis=1) - 0.5), height - 1).astype(numpy.int64)
+
+        # inverse of the uv edge matrix, maps an uv offset to the second and third barycentric weight
+        uv_edges_a = uvs[:, 1] - uvs[:, 0]
+        uv_edges_b = uvs[:, 2] - uvs[:, 0]
+        determinants = uv_edges_a[:, 0] * uv_edges_b[:, 1] - uv_edges_a[:, 1] * uv_edges_b[:, 0]
+        self.valid = numpy.abs(determinants) > 1e-12
+        inv_determinants = numpy.divide(1.0, determinants, out=numpy.zeros_like(determinants), where=self.valid)
+        self.uv_inverses = numpy.stack((
+            numpy.stack((uv_edges_b[:, 1], -uv_edges_b[:, 0]), axis=1),
+            numpy.stack((-uv_edges_a[:, 1], uv_edges_a[:, 0]), axis=1),
+        ), axis=1) * inv_determinants[:, numpy.newaxis, numpy.newaxis]
+
+        matrix = numpy.array(matrix_world, dtype=numpy.float64)
+        self.world_corners = snapshot.vertices[snapshot.triangles].astype(numpy.float64) @ matrix[:3, :3].T + matrix[:3, 3]
+
+        # world offset per uv offset on every triangle, and its pseudo inverse, that turns a world direction into uv
+        world_edges = numpy.stack(
+            (self.world_corners[:, 1] - self.world_corners[:, 0], self.world_corners[:, 2] - self.world_corners[:, 0]), axis=2
+        )
+        jacobians = world_edges @ self.uv_inverses
+        self.uv_projections = numpy.linalg.pinv(jacobians)
+
+    def rasterize(self, x0, x1, y0, y1):
+        """texel coordinates, triangle indices and world positions of all covered texels in the rectangle"""
+
+        selected = numpy.flatnonzero(
+            self.valid & (self.x_max >= x0) & (self.x_min < x1) & (self.y_max >= y0) & (self.y_min < y1)
+        )
+        box_x0 = numpy.maximum(self.x_min[selected], x0)
+        box_y0 = numpy.maximum(self.y_min[selected], y0)
+        box_widths = numpy.maximum(numpy.minimum(self.x_max[selected], x1 - 1) - box_x0 + 1, 0)
+        box_heights = numpy.maximum(numpy.minimum(self.y_max[selected], y1 - 1) - box_y0 + 1, 0)
+        counts = box_widths * box_heights
+        total = int(counts.sum())
+        if total == 0:
+            return None
+
+        # one entry per triangle and texel of its bounding box, expanded without a loop
+        triangles = numpy.repeat(selected, counts)
+        local = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        widths = numpy.repeat(box_widths, counts)
+        x = numpy.repeat(box_x0, counts) + local % widths
+        y = numpy.repeat(box_y0, counts) + local // widths
+
+        offsets = numpy.column_stack(((x + 0.5) / self.width, (y + 0.5) / self.height)) - self.uv_origins[triangles]
+        weights_bc = numpy.einsum('nij,nj->ni', self.uv_inverses[triangles], offsets)
+        weights = numpy.column_stack((1.0 - weights_bc.sum(axis=1), weights_bc))
+        inside = (weights >= -BARYCENTRIC_EPSILON).all(axis=1)
+        if not inside.any():
+            return None
+
+        triangles = triangles[inside]
+        positions = numpy.einsum('ni,nij->nj', weights[inside], self.world_corners[triangles])
+        return x[inside], y[inside], triangles, positions
+
+
+def bake_tile(uv_raster, segments, x0, x1, y0, y1, blend_distance):
+    """uv space flow colors of the covered texels in the tile | returns x, y and colors, or None"""
+
+    rasterized = uv_raster.rasterize(x0, x1, y0, y1)
+    if rasterized is None:
+        return None
+    x, y, triangles, positions = rasterized
+
+    candidates = segments.candidates(positions, blend_distance)
+    if candidates.size == 0:
+        return None
+    tangents = segments.blended_tangents(positions, candidates, blend_distance)
+
+    # the world tangent projected onto the uv plane of the triangle, the same mapping as painting in uv space
+    directions = numpy.einsum('nij,nj->ni', uv_raster.uv_projections[triangles], tangents)
+    lengths = numpy.linalg.norm(directions, axis=1)
+    directions = numpy.divide(
+        directions, lengths[:, numpy.newaxis], out=numpy.zeros_like(directions), where=lengths[:, numpy.newaxis] > 0
+    )
+    colors = (directions + 1) * 0.5
+    return x, y, colors
+
+
+def bake_curve_flow(buffer, snapshot, matrix_world, segments, blend_distance, workers=None):
+    """write the flow of the curves into the image buffer, tile by tile on a thread pool | returns the texel count
+
+    numpy releases the gil in the heavy parts, so threads run the tiles in parallel
+    """
+
+    uv_raster = UvRaster(snapshot, matrix_world, buffer.width, buffer.height)
+    tile_size = buffer.tile_size
+    tiles = [
+        (x0, min(x0 + tile_size, buffer.width), y0, min(y0 + tile_size, buffer.height))
+        for y0 in range(0, buffer.height, tile_size)
+        for x0 in range(0, buffer.width, tile_size)
+    ]
+
+    texel_count = 0
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(bake_tile, uv_raster, segments, x0, x1, y0, y1, blend_distance) for x0, x1, y0, y1 in tiles
+        ]
+        for (x0, x1, y0, y1), future in zip(tiles, futures):
+            result = future.result()
+            if result is None:
+                continue
+            x, y, colors = result
+
+            if buffer.undo_tiles is not None:
+                buffer.save_tiles(x0, x1, y0, y1)
+            buffer.pixels[y, x, 0] = colors[:, 0]
+            buffer.pixels[y, x, 1] = colors[:, 1]
+            if buffer.channels > 2:
+                buffer.pixels[y, x, 2] = 0
+            buffer.mark_dirty(x0, x1, y0, y1)
+            texel_count += len(x)
+
+    return texel_count
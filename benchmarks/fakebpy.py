@@ -0,0 +1,269 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""lightweight stand-in for the parts of bpy, that the paint functions use
+
+only meant for the benchmarks, outside of blender. mathutils and numpy are the real packages
+(pip install numpy mathutils), the blender data is held in numpy arrays
+"""
+
+import sys
+import types
+
+import numpy
+from mathutils import Matrix, Vector
+from mathutils.geometry import intersect_line_plane, intersect_point_line
+
+
+class FakeCollection:
+    """rna collection with foreach_get and foreach_set over numpy arrays"""
+
+    def __init__(self, **arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(next(iter(self.arrays.values())))
+
+    def foreach_get(self, attr, out):
+        out[:] = self.arrays[attr].ravel()
+        return None
+
+    def foreach_set(self, attr, seq):
+        array = self.arrays[attr]
+        array[...] = numpy.asarray(seq, dtype=array.dtype).reshape(array.shape)
+        return None
+
+
+class FakePixels:
+    """image.pixels, a flat float array"""
+
+    def __init__(self, size):
+        self.array = numpy.zeros(size, dtype=numpy.float32)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __setitem__(self, key, value):
+        self.array[key] = value
+
+    def foreach_get(self, out):
+        out[:] = self.array
+        return None
+
+    def foreach_set(self, seq):
+        self.array[:] = seq
+        return None
+
+
+class FakeTimers:
+    """bpy.app.timers, registered functions are never called, there is no event loop"""
+
+    def __init__(self):
+        self.functions = set()
+
+    def register(self, function, first_interval=0.0):
+        self.functions.add(function)
+        return None
+
+    def unregister(self, function):
+        self.functions.discard(function)
+        return None
+
+    def is_registered(self, function):
+        return function in self.functions
+
+
+class FakeImage:
+    def __init__(self, name, width, height, channels=4):
+        self.name = name
+        self.source = "GENERATED"
+        self.size = (width, height)
+        self.channels = channels
+        self.pixels = FakePixels(width * height * channels)
+        # mid grey, like an empty flow map
+        self.pixels.array[:] = 0.5
+
+    def update(self):
+        return None
+
+
+class FakeMesh:
+    """triangulated mesh with one uv map and one corner color attribute"""
+
+    def __init__(self, vertices, quads, uvs, name="mesh"):
+        self.name = name
+        self.vertices = FakeCollection(co=numpy.asarray(vertices, dtype=numpy.float32))
+        self.loops = FakeCollection(vertex_index=numpy.asarray(quads, dtype=numpy.int32).ravel())
+
+        # every quad is split into the triangles 0 1 2 and 0 2 3
+        quad_loops = numpy.arange(quads.size, dtype=numpy.int32).reshape(-1, 4)
+        triangle_loops = numpy.stack((quad_loops[:, [0, 1, 2]], quad_loops[:, [0, 2, 3]]), axis=1).reshape(-1, 3)
+        self.loop_triangles = FakeCollection(
+            vertices=self.loops.arrays["vertex_index"][triangle_loops], loops=triangle_loops
+        )
+
+        self.uv_layers = types.SimpleNamespace(
+            active=types.SimpleNamespace(uv=FakeCollection(vector=numpy.asarray(uvs, dtype=numpy.float32).reshape(-1, 2)))
+        )
+
+        colors = numpy.full((quads.size, 4), 0.5, dtype=numpy.float32)
+        self.color_attributes = types.SimpleNamespace(
+            active_color=types.SimpleNamespace(name="flow", domain='CORNER', data=FakeCollection(color=colors))
+        )
+
+    def calc_loop_triangles(self):
+        return None
+
+    def update(self):
+        return None
+
+
+class FakeObject:
+    def __init__(self, name, mesh):
+        self.name = name
+        self.type = 'MESH'
+        self.data = mesh
+        self.matrix_world = Matrix.Identity(4)
+
+    def evaluated_get(self, depsgraph):
+        return self
+
+    def to_mesh(self):
+        return self.data
+
+    def to_mesh_clear(self):
+        return None
+
+
+class FakeImages(dict):
+    def new(self, name, width, height, alpha=True, float_buffer=True):
+        image = FakeImage(name, width, height)
+        self[name] = image
+        return image
+
+
+def region_2d_to_vector_3d(region, rv3d, coord):
+    """same as bpy_extras.view3d_utils"""
+
+    viewinv = rv3d.view_matrix.inverted()
+    if rv3d.is_perspective:
+        persinv = rv3d.perspective_matrix.inverted()
+        out = Vector(((2.0 * coord[0] / region.width) - 1.0, (2.0 * coord[1] / region.height) - 1.0, -0.5))
+        w = out.dot(persinv[3].xyz) + persinv[3][3]
+        view_vector = ((persinv @ out) / w) - viewinv.translation
+    else:
+        view_vector = -viewinv.col[2].xyz
+
+    view_vector.normalize()
+    return view_vector
+
+
+def region_2d_to_origin_3d(region, rv3d, coord, *, clamp=None):
+    """same as bpy_extras.view3d_utils, without clamping"""
+
+    viewinv = rv3d.view_matrix.inverted()
+    if rv3d.is_perspective:
+        return viewinv.translation.copy()
+
+    persinv = rv3d.perspective_matrix.inverted()
+    dx = (2.0 * coord[0] / region.width) - 1.0
+    dy = (2.0 * coord[1] / region.height) - 1.0
+    return (persinv.col[0].xyz * dx) + (persinv.col[1].xyz * dy) + persinv.translation
+
+
+def region_2d_to_location_3d(region, rv3d, coord, depth_location):
+    """same as bpy_extras.view3d_utils"""
+
+    coord_vec = region_2d_to_vector_3d(region, rv3d, coord)
+    depth_location = Vector(depth_location)
+    origin_start = region_2d_to_origin_3d(region, rv3d, coord)
+    origin_end = origin_start + coord_vec
+
+    if rv3d.is_perspective:
+        viewinv = rv3d.view_matrix.inverted()
+        return intersect_line_plane(origin_start, origin_end, depth_location, viewinv.col[2].xyz)
+    return intersect_point_line(depth_location, origin_start, origin_end)[0]
+
+
+def install():
+    """put the stand-in bpy and bpy_extras modules into sys.modules | returns the bpy module"""
+
+    unified_paint_settings = types.SimpleNamespace(
+        size=50,
+        strength=1.0,
+        color=[0.5, 0.5, 0.5],
+        use_unified_color=True,
+        use_unified_strength=True,
+        use_unified_size=True,
+    )
+    brush = types.SimpleNamespace(curve_preset='SMOOTH', use_pressure_size=False, use_pressure_strength=True)
+    tool_settings = types.SimpleNamespace(
+        unified_paint_settings=unified_paint_settings,
+        image_paint=types.SimpleNamespace(brush=brush, mode='IMAGE', canvas=None),
+        vertex_paint=types.SimpleNamespace(brush=brush),
+    )
+    props = types.SimpleNamespace(
+        brush_spacing=20.0,
+        trace_distance=1000.0,
+        space_type="uv_space",
+        object=None,
+        paint_engine="direct",
+        flush_interval=0.0,
+        frame_budget=0.0,
+        smooth_stroke=False,
+        record_strokes=False,
+        record_path="//flowmap_strokes.npz",
+        spacing_mode="screen",
+        texel_spacing=25.0,
+        collect_timings=False,
+        seam_splatting=True,
+        background_compositing=False,
+        undo_memory=256,
+        scratch_buffer=False,
+        scratch_channels="3",
+        udim_tile_cache=4,
+        udim_save_changes=False,
+        bake_image=None,
+        bake_blend_distance=0.1,
+        post_padding=16,
+        post_blur_radius=4,
+    )
+    scene = types.SimpleNamespace(flowmap_painter_props=props, tool_settings=tool_settings)
+
+    bpy = types.ModuleType("bpy")
+    bpy.context = types.SimpleNamespace(scene=scene, tool_settings=tool_settings, active_object=None, area=None)
+    bpy.data = types.SimpleNamespace(images=FakeImages())
+    bpy.path = types.SimpleNamespace(abspath=lambda path: path.replace("//", "", 1) if path.startswith("//") else path)
+    bpy.types = types.ModuleType("bpy.types")
+    bpy.app = types.SimpleNamespace(
+        handlers=types.SimpleNamespace(persistent=lambda function: function), timers=FakeTimers(), tempdir=""
+    )
+
+    bpy_extras = types.ModuleType("bpy_extras")
+    view3d_utils = types.ModuleType("bpy_extras.view3d_utils")
+    view3d_utils.region_2d_to_vector_3d = region_2d_to_vector_3d
+    view3d_utils.region_2d_to_origin_3d = region_2d_to_origin_3d
+    view3d_utils.region_2d_to_location_3d = region_2d_to_location_3d
+    bpy_extras.view3d_utils = view3d_utils
+
+    sys.modules["bpy"] = bpy
+    sys.modules["bpy.types"] = bpy.types
+    sys.modules["bpy_extras"] = bpy_extras
+    sys.modules["bpy_extras.view3d_utils"] = view3d_utils
+    return bpy
@@ -0,0 +1,340 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""headless benchmarks of the paint hot paths | per event latency percentiles per stage
+
+outside of blender, with numpy and mathutils installed (bpy is replaced by benchmarks/fakebpy.py):
+    python benchmarks/run.py [--full] [--output bench_output.txt]
+with blender, or bpy as a module:
+    blender -b --factory-startup --python benchmarks/run.py -- [--full]
+"""
+
+import argparse
+import contextlib
+import importlib
+import importlib.util
+import os
+import sys
+import time
+import types
+
+import numpy
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCHMARK_DIR)
+ADDON_NAME = "flow_map_painter"
+
+sys.path.insert(0, BENCHMARK_DIR)
+
+try:
+    import bpy
+    IN_BLENDER = True
+except ImportError:
+    import fakebpy
+    bpy = fakebpy.install()
+    IN_BLENDER = False
+
+import synthetic  # noqa: E402
+
+MESH_TRIANGLES = (10_000, 100_000, 1_000_000)
+FULL_MESH_TRIANGLES = MESH_TRIANGLES + (5_000_000,)
+TEXTURE_SIZES = (1024, 2048, 4096)
+FULL_TEXTURE_SIZES = TEXTURE_SIZES + (8192, 16384)
+# texture of the uv dabs in the mesh benchmarks
+MESH_TEXTURE_SIZE = 2048
+SPACE_TYPES = ("uv_space", "object_space", "world_space")
+PERCENTILES = (50, 95, 99)
+
+
+class Timings:
+    """per event durations of every stage"""
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        yield
+        self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def report(self):
+        lines = ["%-26s %7s %9s %9s %9s %9s" % ("stage", "events", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+        for stage, samples in self.samples.items():
+            milliseconds = numpy.array(samples) * 1000
+            p50, p95, p99 = numpy.percentile(milliseconds, PERCENTILES)
+            lines.append("%-26s %7d %9.3f %9.3f %9.3f %9.3f" % (stage, len(samples), p50, p95, p99, milliseconds.max()))
+        return lines
+
+
+def load_addon():
+    """import the add-on package | in blender it is registered, outside only the paint modules are loaded"""
+
+    if IN_BLENDER:
+        spec = importlib.util.spec_from_file_location(
+            ADDON_NAME, os.path.join(ADDON_DIR, "__init__.py"), submodule_search_locations=[ADDON_DIR]
+        )
+        addon = importlib.util.module_from_spec(spec)
+        sys.modules[ADDON_NAME] = addon
+        spec.loader.exec_module(addon)
+        addon.register()
+    else:
+        # the package init registers ui classes, the paint modules do not need it
+        addon = types.ModuleType(ADDON_NAME)
+        addon.__path__ = [ADDON_DIR]
+        sys.modules[ADDON_NAME] = addon
+
+    return types.SimpleNamespace(**{
+        name: importlib.import_module("%s.%s" % (ADDON_NAME, name))
+        for name in ("funcs", "raster", "record", "stroke", "trace", "vars", "vertcol")
+    })
+
+
+def make_object(name, triangle_count):
+    """synthetic grid object with a uv map and a corner color attribute, set as active object"""
+
+    vertices, quads, uvs = synthetic.grid(triangle_count)
+
+    if not IN_BLENDER:
+        obj = fakebpy.FakeObject(name, fakebpy.FakeMesh(vertices, quads, uvs, name=name))
+        bpy.context.active_object = obj
+        return obj
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set("co", vertices.ravel())
+    mesh.loops.add(quads.size)
+    mesh.loops.foreach_set("vertex_index", quads.ravel())
+    mesh.polygons.add(len(quads))
+    mesh.polygons.foreach_set("loop_start", numpy.arange(0, quads.size, 4, dtype=numpy.int32))
+    mesh.update()
+    mesh.uv_layers.new().uv.foreach_set("vector", uvs.ravel())
+    mesh.color_attributes.active_color = mesh.color_attributes.new("flow", 'FLOAT_COLOR', 'CORNER')
+
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+    bpy.context.view_layer.objects.active = obj
+    return obj
+
+
+def remove_object(obj):
+    if IN_BLENDER:
+        mesh = obj.data
+        bpy.data.objects.remove(obj)
+        bpy.data.meshes.remove(mesh)
+    return None
+
+
+def make_image(name, size):
+    return bpy.data.images.new(name, size, size, alpha=True, float_buffer=True)
+
+
+def remove_image(image):
+    if IN_BLENDER:
+        bpy.data.images.remove(image)
+    return None
+
+
+def get_depsgraph():
+    if IN_BLENDER:
+        return bpy.context.evaluated_depsgraph_get()
+    return None
+
+
+def view_context(addon, width=synthetic.REGION_WIDTH, height=synthetic.REGION_HEIGHT):
+    """3D view context without ui, the same stand-ins the stroke replay uses"""
+
+    perspective_matrix, view_matrix = synthetic.view_matrices(width, height)
+    region = addon.record.RecordedRegion(0, 0, width, height)
+    region_data = addon.record.RecordedRegionView3D(perspective_matrix, view_matrix, is_perspective=True, is_camera=False)
+    area = addon.record.RecordedArea('VIEW_3D', 0, 0, [region])
+    return addon.record.ReplayContext(bpy.context.scene, area, region, region_data, None)
+
+
+def bench_mesh(addon, triangle_count, event_count):
+    """trace, direction in every space type, substep trace and uv and vertex dabs along a stroke over the mesh
+
+    the dabs go through funcs.paint_dots_direct, the path the paint modes use, with seam splatting,
+    the stamp cache, undo tracking, write back and, if turned on, the dab worker
+    """
+
+    funcs = addon.funcs
+    props = bpy.context.scene.flowmap_painter_props
+
+    obj = make_object("flowmap_bench", triangle_count)
+    image = make_image("flowmap_bench_mesh", MESH_TEXTURE_SIZE)
+    bpy.context.scene.tool_settings.image_paint.canvas = image
+
+    start = time.perf_counter()
+    snapshot = addon.trace.MeshSnapshot(obj=obj, depsgraph=get_depsgraph())
+    snapshot_time = time.perf_counter() - start
+    start = time.perf_counter()
+    addon.vars.trace_session = addon.trace.TraceSession(obj=obj, snapshot=snapshot)
+    bvh_time = time.perf_counter() - start
+    start = time.perf_counter()
+    addon.vars.vertex_index = funcs.get_vertex_index(obj)
+    kdtree_time = time.perf_counter() - start
+
+    context = view_context(addon)
+    timings = Timings()
+    misses = 0
+
+    # one working buffer per mode, like a uv and a vertex paint stroke at the same time
+    addon.vars.mode = 'VERTEX_PAINT'
+    funcs.begin_direct_stroke(context)
+    color_buffer = addon.vars.color_buffer
+    addon.vars.mode = '3D_PAINT'
+    funcs.begin_direct_stroke(context)
+    addon.vars.color_buffer = color_buffer
+    addon.vars.pressing = True
+
+    positions, pressures = synthetic.stroke_trace(event_count)
+    stroke_input = addon.stroke.StrokeInput(anchor=positions[0])
+    for position, pressure in zip(positions[1:], pressures[1:]):
+        stroke_input.add(position, pressure)
+        paint_positions, _, paint_pressures = stroke_input.resample(spacing=props.brush_spacing)
+        if len(paint_positions) == 0:
+            continue
+        area_prev_pos = stroke_input.anchor
+        area_pos = (paint_positions[-1][0], paint_positions[-1][1])
+        stroke_input.advance()
+
+        with timings.measure("trace"):
+            hit, prev_hit = funcs.trace_hit_pair(context, area_pos, area_prev_pos)
+        if hit is None or prev_hit is None:
+            misses += 1
+            continue
+
+        for space_type in SPACE_TYPES:
+            props.space_type = space_type
+            with timings.measure("direction " + space_type):
+                color = funcs.get_direction_color(hit, prev_hit)
+        props.space_type = "uv_space"
+        if color is None:
+            color = (0.5, 0.5, 0.5)
+
+        with timings.measure("trace substeps"):
+            hits = funcs.trace_hits(
+                context, [(p[0], p[1]) for p in paint_positions[:-1]], hit=hit, prev_hit=prev_hit
+            ) + [hit]
+
+        mouse_positions = [(p[0], p[1]) for p in paint_positions]
+        colors = [color] * len(mouse_positions)
+        for mode, stage in (('3D_PAINT', "uv dabs"), ('VERTEX_PAINT', "vertex dabs")):
+            addon.vars.mode = mode
+            with timings.measure(stage):
+                funcs.paint_dots_direct(
+                    context, 'VIEW_3D', mouse_positions, list(paint_pressures), colors=colors, hits=hits
+                )
+
+    with timings.measure("end stroke"):
+        addon.vars.pressing = False
+        funcs.end_direct_stroke()
+
+    funcs.stop_dab_worker()
+    addon.vars.trace_session = None
+    addon.vars.vertex_index = None
+    addon.vars.undo_stack = None
+    bpy.context.scene.tool_settings.image_paint.canvas = None
+    remove_image(image)
+    remove_object(obj)
+
+    header = "mesh %d triangles | snapshot %.3f s, bvh %.3f s, kd tree %.3f s, %d missed events" % (
+        len(snapshot.triangles), snapshot_time, bvh_time, kdtree_time, misses
+    )
+    return [header] + timings.report()
+
+
+def bench_texture(addon, size, event_count):
+    """2D dabs and write back along a stroke over a square texture"""
+
+    props = bpy.context.scene.flowmap_painter_props
+    falloff = addon.raster.brush_falloff(types.SimpleNamespace(curve_preset='SMOOTH'))
+    image = make_image("flowmap_bench_texture", size)
+
+    start = time.perf_counter()
+    buffer = addon.raster.ImageBuffer(image)
+    read_time = time.perf_counter() - start
+    timings = Timings()
+
+    # spacing and radius scale with the texture, so every size paints the same stroke
+    spacing = props.brush_spacing * size / synthetic.REGION_HEIGHT
+    radius = bpy.context.scene.tool_settings.unified_paint_settings.size * size / synthetic.REGION_HEIGHT
+
+    positions, pressures = synthetic.stroke_trace(event_count, size, size)
+    stroke_input = addon.stroke.StrokeInput(anchor=positions[0])
+    for position, pressure in zip(positions[1:], pressures[1:]):
+        stroke_input.add(position, pressure)
+        paint_positions, tangents, paint_pressures = stroke_input.resample(spacing=spacing)
+        if len(paint_positions) == 0:
+            continue
+        stroke_input.advance()
+
+        with timings.measure("direction 2D"):
+            colors = [(c[0], c[1], 0) for c in (tangents + 1) * 0.5]
+        with timings.measure("dabs"):
+            buffer.paint_dabs(paint_positions, [radius] * len(paint_positions), colors, paint_pressures, falloff)
+        with timings.measure("flush"):
+            buffer.flush()
+
+    remove_image(image)
+
+    header = "texture %dx%d | read %.3f s" % (size, size, read_time)
+    return [header] + timings.report()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="also run 5M triangles and 8K and 16K textures")
+    parser.add_argument("--meshes", type=int, nargs="*", help="triangle counts of the synthetic meshes")
+    parser.add_argument("--textures", type=int, nargs="*", help="sizes of the synthetic textures")
+    parser.add_argument("--events", type=int, default=600, help="mouse events per stroke")
+    parser.add_argument("--spacing", type=float, default=4.0, help="brush spacing in pixels")
+    parser.add_argument("--background", action="store_true", help="composite the mesh dabs on the dab worker")
+    parser.add_argument("--output", help="also write the report into this file")
+    args = parser.parse_args(argv)
+
+    meshes = args.meshes if args.meshes is not None else (FULL_MESH_TRIANGLES if args.full else MESH_TRIANGLES)
+    textures = args.textures if args.textures is not None else (FULL_TEXTURE_SIZES if args.full else TEXTURE_SIZES)
+
+    addon = load_addon()
+    bpy.context.scene.flowmap_painter_props.brush_spacing = args.spacing
+    bpy.context.scene.flowmap_painter_props.flush_interval = 0.0
+    bpy.context.scene.flowmap_painter_props.background_compositing = args.background
+
+    lines = ["flow map painter benchmark | %s | %d events per stroke" % (
+        "blender %s" % bpy.app.version_string if IN_BLENDER else "bpy stand-in", args.events
+    )]
+    for triangle_count in meshes:
+        lines += [""] + bench_mesh(addon, triangle_count, args.events)
+    for size in textures:
+        lines += [""] + bench_texture(addon, size, args.events)
+
+    report = "\n".join(lines)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    # blender passes its own arguments, the benchmark ones follow after --
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
+    sys.exit(main(argv))
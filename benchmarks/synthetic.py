@@ -0,0 +1,74 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""synthetic meshes, views and stroke traces for the benchmarks"""
+
+import math
+
+import numpy
+from mathutils import Matrix
+
+REGION_WIDTH = 1920
+REGION_HEIGHT = 1080
+CAMERA_DISTANCE = 2.6
+CAMERA_FOV = math.radians(50)
+
+
+def grid(triangle_count):
+    """wavy grid over [-1, 1] with about triangle_count triangles | returns vertices, quads and per corner uvs"""
+
+    cells = max(int(math.ceil(math.sqrt(triangle_count / 2))), 1)
+    line = numpy.linspace(-1.0, 1.0, cells + 1, dtype=numpy.float32)
+    x, y = numpy.meshgrid(line, line)
+    z = 0.05 * numpy.sin(3 * x) * numpy.cos(3 * y)
+    vertices = numpy.stack((x, y, z), axis=-1).reshape(-1, 3)
+
+    rows, columns = numpy.meshgrid(numpy.arange(cells), numpy.arange(cells), indexing='ij')
+    first = (rows * (cells + 1) + columns).ravel()
+    quads = numpy.stack((first, first + 1, first + cells + 2, first + cells + 1), axis=1).astype(numpy.int32)
+
+    uvs = (vertices[quads][:, :, :2] + 1.0) * 0.5
+    return vertices, quads, uvs
+
+
+def view_matrices(width=REGION_WIDTH, height=REGION_HEIGHT):
+    """perspective and view matrix of a camera, that looks down onto the grid"""
+
+    near = 0.1
+    far = 100.0
+    focal = 1.0 / math.tan(CAMERA_FOV / 2)
+    window_matrix = Matrix((
+        (focal * height / width, 0, 0, 0),
+        (0, focal, 0, 0),
+        (0, 0, (far + near) / (near - far), 2 * far * near / (near - far)),
+        (0, 0, -1, 0),
+    ))
+    view_matrix = Matrix.Translation((0, 0, -CAMERA_DISTANCE))
+    return window_matrix @ view_matrix, view_matrix
+
+
+def stroke_trace(count, width=REGION_WIDTH, height=REGION_HEIGHT):
+    """mouse positions and pen pressures of a spiral stroke around the center of the region"""
+
+    t = numpy.linspace(0.0, 1.0, count)
+    angle = t * 4 * math.pi
+    radius = (0.1 + 0.3 * t) * min(width, height)
+    positions = numpy.column_stack((width * 0.5 + radius * numpy.cos(angle), height * 0.5 + radius * numpy.sin(angle)))
+    pressures = 0.5 + 0.5 * numpy.sin(t * math.pi)
+    return positions, pressures
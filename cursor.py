@@ -0,0 +1,106 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import math
+
+import bpy
+import gpu
+from gpu_extras.batch import batch_for_shader
+
+from . import stats
+
+# same segment estimation as gpu_extras.presets.draw_circle_2d
+MAX_PIXEL_ERROR = 0.25
+MIN_SEGMENTS = 8
+MAX_SEGMENTS = 1000
+
+
+def circle_segments(radius):
+    """how many segments a circle of this pixel radius needs to look round"""
+
+    if radius <= MAX_PIXEL_ERROR:
+        return MIN_SEGMENTS
+    segments = int(math.ceil(math.pi / math.acos(1.0 - MAX_PIXEL_ERROR / radius)))
+    return max(min(segments, MAX_SEGMENTS), MIN_SEGMENTS)
+
+
+class BrushCursor:
+    """brush circle with one draw handler per paint session, the modal only updates position, color and radius"""
+
+    def __init__(self, space_type):
+        self.space_type = space_type
+        self.position = (0, 0)
+        self.color = (0.5, 0.5, 0.5, 1)
+        self.radius = 0
+
+        self.shader = gpu.shader.from_builtin('UNIFORM_COLOR')
+        self.batch = None
+        self.segments = 0
+
+        self.handler = space_type.draw_handler_add(self.draw, (), 'WINDOW', 'POST_PIXEL')
+
+    def update(self, position, color, radius):
+        """set the state, that is drawn on the next redraw"""
+
+        self.position = position
+        self.color = color
+        self.radius = radius
+        return None
+
+    def get_batch(self, radius):
+        """unit circle batch, only rebuilt when the radius needs another segment count"""
+
+        segments = circle_segments(radius)
+        if self.batch is None or segments != self.segments:
+            mul = (1.0 / (segments - 1)) * (math.pi * 2)
+            verts = [(math.sin(i * mul), math.cos(i * mul)) for i in range(segments)]
+            self.batch = batch_for_shader(self.shader, 'LINE_STRIP', {"pos": verts})
+            self.segments = segments
+        return self.batch
+
+    def get_zoom(self):
+        """the image editor radius is in image pixels, so it follows the zoom of the editor, that is drawn right now"""
+
+        space = bpy.context.space_data
+        if self.space_type == bpy.types.SpaceImageEditor and space is not None:
+            return space.zoom[0]
+        return 1.0
+
+    @stats.timed("cursor draw")
+    def draw(self):
+        # the zoom is read at draw time, zooming with the wheel does not move the mouse
+        radius = self.radius * self.get_zoom()
+        if radius <= 0:
+            return None
+
+        batch = self.get_batch(radius)
+        with gpu.matrix.push_pop():
+            gpu.matrix.translate(self.position)
+            gpu.matrix.scale_uniform(radius)
+            self.shader.uniform_float("color", self.color)
+            batch.draw(self.shader)
+        return None
+
+    def remove(self):
+        """remove the draw handler at the end of the session"""
+
+        if self.handler is not None:
+            self.space_type.draw_handler_remove(self.handler, 'WINDOW')
+            self.handler = None
+        return None
@@ -17,66 +17,36 @@
 #
 # ##### END GPL LICENSE BLOCK #####
 
+import time
+
 import bpy
 import numpy
 import mathutils
 from bpy_extras import view3d_utils
-from gpu_extras.presets import draw_circle_2d
 
+from . import raster
+from . import record
+from . import scratch
+from . import seams
+from . import stats
+from . import stroke
+from . import trace
+from . import udim
+from . import undo
 from . import vars
+from . import vertcol
+from . import worker
 
+# texel spacing never gets below one texel, more dots would only paint the same texels again
+MIN_TEXEL_SPACING = 1.0
+# the flush timer of background compositing runs at most this often, even with an update interval of 0
+MIN_FLUSH_TIMER_INTERVAL = 1 / 30
+# share of the stroke time, that writing back may take at most
+MAX_FLUSH_SHARE = 0.2
 
-def lerp(mix, a, b):
-    """linear interpolation"""
-
-    return (b - a) * mix + a
-
-
-def remove_temp_obj():
-    """removes the temp object and data if it exists"""
-
-    if bpy.data.meshes.get("FLOWMAP_temp_mesh"):
-        bpy.data.meshes.remove(bpy.data.meshes["FLOWMAP_temp_mesh"])
-    if bpy.data.objects.get("FLOWMAP_temp_obj"):
-        bpy.data.objects.remove(bpy.data.objects["FLOWMAP_temp_obj"])
-    return None
-
-
-def triangulate_object(obj):
-    """triangulate incoming object and return it as a temporary copy"""
-
-    template_ob = obj
-
-    # first remove temp stuff, if it exists already
-    remove_temp_obj()
 
-    ob = template_ob.copy()
-    ob.data = ob.data.copy()
-    ob.modifiers.new("triangulate", 'TRIANGULATE')
-
-    # need to be in scnene, for depsgraph to work apparently
-    bpy.context.collection.objects.link(ob)
-
-    depsgraph = bpy.context.evaluated_depsgraph_get()
-    object_eval = ob.evaluated_get(depsgraph)
-    mesh_from_eval = bpy.data.meshes.new_from_object(object_eval)
-    ob.data = mesh_from_eval
-
-    new_ob = bpy.data.objects.new(name="FLOWMAP_temp_obj", object_data=mesh_from_eval)
-    bpy.context.collection.objects.link(new_ob)
-    new_ob.matrix_world = template_ob.matrix_world
-
-    # remove the depsgraph object
-    bpy.data.objects.remove(ob, do_unlink=True)
-
-    # hide temp obj
-    new_ob.hide_set(True)
-
-    return new_ob
-
-
-def _obj_ray_cast(context, area_pos, obj, matrix):
-    """Wrapper for ray casting that moves the ray into object space"""
+def _obj_ray_cast(context, area_pos):
+    """Wrapper for ray casting that moves the ray into object space and queries the session bvh"""
 
     # get the context arguments
     region = context.region
@@ -87,96 +57,130 @@ def _obj_ray_cast(context, area_pos, obj, matrix):
     view_vector = view3d_utils.region_2d_to_vector_3d(region, rv3d, coord)
     ray_origin = view3d_utils.region_2d_to_origin_3d(region, rv3d, coord)
 
-    ray_target = ray_origin + view_vector
-
-    # get the ray relative to the object
-    matrix_inv = matrix.inverted()
-    ray_origin_obj = matrix_inv @ ray_origin
-    ray_target_obj = matrix_inv @ ray_target
-    ray_direction_obj = ray_target_obj - ray_origin_obj
-
     # cast the ray
-    success, location, normal, face_index = obj.ray_cast(
-        origin=ray_origin_obj,
-        direction=ray_direction_obj,
+    location, normal, face_index = vars.trace_session.ray_cast(
+        ray_origin=ray_origin,
+        view_vector=view_vector,
         distance=bpy.context.scene.flowmap_painter_props.trace_distance
     )
 
-    if success:
+    if location is not None:
         return location, normal, face_index
     return None, None, None
 
 
-def line_trace_for_pos(context, area_pos):
-    """Trace at given position. Return hit in object and world space."""
-    obj = bpy.context.active_object
-    matrix = obj.matrix_world.copy()
-    hit_world = None
-    if obj.type == 'MESH':
-        hit, normal, face_index = _obj_ray_cast(context=context, area_pos=area_pos, obj=vars.tri_obj, matrix=matrix)
-        if hit is not None:
-            hit_world = matrix @ hit
-            return hit, hit_world
-        else:
-            return None, None
+def trace_hit(context, area_pos):
+    """Trace at given position. Looks the position up in the hit cache first, that is reset when the view or object moves."""
+
+    session = vars.trace_session
+    view_matrix = context.region_data.perspective_matrix
+    session.hit_cache.validate(view_matrix, session.obj.matrix_world)
+    cached, hit = session.hit_cache.get(area_pos)
+    if cached:
+        return hit
+
+    location, normal, face_index = _obj_ray_cast(context=context, area_pos=area_pos)
+    if location is not None:
+        hit = trace.TraceHit(
+            area_pos=area_pos,
+            location=location,
+            face_index=face_index,
+            world=session.matrix_world @ location,
+            view_matrix=view_matrix,
+            matrix_world=session.matrix_world,
+        )
+    session.hit_cache.put(area_pos, hit)
+    return hit
+
 
+@stats.timed("trace")
+def trace_hit_pair(context, area_pos, area_prev_pos):
+    """trace the current and previous position, the previous one is usually still in the hit cache"""
 
-def get_uv_space_direction_color(context, area_pos, area_prev_pos):
-    """combine area_pos and previouse linetrace into direction color"""
+    prev_hit = trace_hit(context=context, area_pos=area_prev_pos)
+    hit = trace_hit(context=context, area_pos=area_pos)
 
-    def line_trace_for_uv(context, area_pos):
-        """line trace into the scene, to find uv coordinates at the brush location at the object """
+    return hit, prev_hit
 
-        def pos_to_uv_co(obj, matrix_world, world_pos, face_index):
-            """translate 3D postion on a mesh into uv coordinates"""
 
-            face_verts = []
-            uv_verts = []
+def hit_uv(hit):
+    """uv coordinates of a trace hit, resolved once per hit"""
 
-            # uv"s are stored in loops
-            face = obj.data.polygons[face_index]
-            for vert_idx, loop_idx in zip(face.vertices, face.loop_indices):
-                uv_coords = obj.data.uv_layers.active.data[loop_idx].uv
+    if hit.uv is None:
+        uv_co = vars.trace_session.snapshot.uv_at(locations=hit.location, face_indices=hit.face_index)
+        if uv_co is not None:
+            hit.uv = uv_co[0]
+    return hit.uv
 
-                face_verts.append(matrix_world @ obj.data.vertices[vert_idx].co)
-                uv_verts.append(uv_coords.to_3d())
 
-                # print(f'face idx {face.index}, vert idx {vert_idx}, vert coords {ob.data.vertices[vert_idx].co},uv coords {uv_coords.x} {uv_coords.y}')
+@stats.timed("trace substeps")
+def trace_hits(context, area_positions, hit, prev_hit):
+    """trace a batch of area positions between two known hits at once | returns a TraceHit or None per position
 
-            # print("world_pos: ", world_pos)
-            # print("face_verts: ", face_verts[0], face_verts[1], face_verts[2])
-            # print("uv_verts: ", uv_verts[0], uv_verts[1], uv_verts[2])
+    positions in the hit cache are not traced again
+    """
+
+    session = vars.trace_session
+    if not len(area_positions):
+        return []
+
+    view_matrix = context.region_data.perspective_matrix
+    hit_cache = session.hit_cache
+    hit_cache.validate(view_matrix, session.obj.matrix_world)
+
+    hits = []
+    missing = []
+    for index, area_pos in enumerate(area_positions):
+        cached, cached_hit = hit_cache.get(area_pos)
+        hits.append(cached_hit)
+        if not cached:
+            missing.append(index)
+    if not missing:
+        return hits
+
+    ray_origins, view_vectors = trace.region_rays(
+        context.region, context.region_data, [area_positions[index] for index in missing]
+    )
 
-            # point, tri_a1, tri_a2, tri_a3, tri_b1, tri_b2, tri_b3
-            uv_co = mathutils.geometry.barycentric_transform(
-                world_pos, face_verts[0], face_verts[1], face_verts[2], uv_verts[0], uv_verts[1], uv_verts[2]
+    # the positions lie between both hits, so the triangles around them are the candidates
+    center = (hit.location + prev_hit.location) * 0.5
+    radius = max((hit.location - prev_hit.location).length, 1e-6)
+
+    locations, face_indices = session.ray_cast_batch(
+        ray_origins=ray_origins,
+        view_vectors=view_vectors,
+        distance=bpy.context.scene.flowmap_painter_props.trace_distance,
+        center=center,
+        radius=radius,
+    )
+
+    for index, location, face_index in zip(missing, locations, face_indices):
+        area_pos = area_positions[index]
+        if face_index >= 0:
+            location = mathutils.Vector(location)
+            hits[index] = trace.TraceHit(
+                area_pos=area_pos,
+                location=location,
+                face_index=int(face_index),
+                world=session.matrix_world @ location,
+                view_matrix=view_matrix,
+                matrix_world=session.matrix_world,
             )
+        hit_cache.put(area_pos, hits[index])
 
-            return uv_co
+    return hits
 
-        obj = bpy.context.active_object
-        matrix = obj.matrix_world.copy()
-        uv_co = None
-        hit = None
-        hit_world = None
-        if obj.type == 'MESH':
-            hit, normal, face_index = _obj_ray_cast(context=context, area_pos=area_pos, obj=vars.tri_obj, matrix=matrix)
-            if hit is not None:
-                hit_world = matrix @ hit
-                # enable for debug:
-                # bpy.context.scene.cursor.location = hit_world
-                uv_co = pos_to_uv_co(
-                    obj=vars.tri_obj, matrix_world=obj.matrix_world, world_pos=hit_world, face_index=face_index
-                )
 
-        return uv_co, hit
+@stats.timed("direction uv space")
+def get_uv_space_direction_color(hit, prev_hit):
+    """combine the uv coordinates of hit and previouse hit into direction color"""
 
     # finally get the uv coordinates
-    uv_pos, hit_world = line_trace_for_uv(context, area_pos)
-    uv_prev_pos, _ = line_trace_for_uv(context, area_prev_pos)
+    uv_pos = hit_uv(hit)
+    uv_prev_pos = hit_uv(prev_hit)
 
     if uv_pos is None or uv_prev_pos is None:
-        return None, None
+        return None
 
     # convert to numpy array for further math
     uv_pos = numpy.array([uv_pos[0], uv_pos[1]])
@@ -186,7 +190,7 @@ def get_uv_space_direction_color(context, area_pos, area_prev_pos):
     uv_direction_vector = uv_pos - uv_prev_pos
     norm_factor = numpy.linalg.norm(uv_direction_vector)
     if norm_factor == 0:
-        return None, None
+        return None
 
     norm_uv_direction_vector = uv_direction_vector / norm_factor
 
@@ -196,79 +200,678 @@ def get_uv_space_direction_color(context, area_pos, area_prev_pos):
 
     # enable for uv position debug:
     # print([uv_pos[0], uv_pos[1], 0])
-    return direction_color, hit_world
+    return direction_color
 
 
-def get_obj_space_direction_color(context, area_pos, area_prev_pos):
-    """get the normalized vector color from brush and previous location in object space"""
+@stats.timed("direction object space")
+def get_obj_space_direction_color(hit, prev_hit):
+    """get the normalized vector color from hit and previous hit in object space"""
 
-    # get world hit and previus
-    location, hit_world = line_trace_for_pos(context=context, area_pos=area_pos)
-    _, prev_hit_world = line_trace_for_pos(context=context, area_pos=area_prev_pos)
+    obj = bpy.context.scene.flowmap_painter_props.object
+    if obj is None:
+        obj = bpy.context.active_object
+
+    matrix = obj.matrix_world.inverted().copy()
+    hit_obj = matrix @ hit.world
+    prev_hit_obj = matrix @ prev_hit.world
+
+    # convert to numpy array for further math
+    obj_pos = numpy.array([hit_obj[0], hit_obj[1], hit_obj[2]])
+    obj_prev_pos = numpy.array([prev_hit_obj[0], prev_hit_obj[1], prev_hit_obj[2]])
+
+    # calculate direction vector and normalize it
+    world_direction_vector = obj_pos - obj_prev_pos
+    norm_factor = numpy.linalg.norm(world_direction_vector)
+    if norm_factor == 0:
+        return None
+
+    norm_world_direction_vector = world_direction_vector / norm_factor
+
+    # map the range to the color range, so 0.5 ist the middle
+    color_range_vector = (norm_world_direction_vector + 1) * 0.5
+    # color_range_vector = norm_world_direction_vector #debug original color
+    direction_color = [color_range_vector[0], color_range_vector[1], color_range_vector[2]]
+
+    return direction_color
+
+
+@stats.timed("direction world space")
+def get_world_space_direction_color(hit, prev_hit):
+    """get the normalized vector color from hit and previous hit in world space"""
+
+    # convert to numpy array for further math
+    world_pos = numpy.array([hit.world[0], hit.world[1], hit.world[2]])
+    world_prev_pos = numpy.array([prev_hit.world[0], prev_hit.world[1], prev_hit.world[2]])
+
+    # calculate direction vector and normalize it
+    world_direction_vector = world_pos - world_prev_pos
+    norm_factor = numpy.linalg.norm(world_direction_vector)
+    if norm_factor == 0:
+        return None
+
+    norm_world_direction_vector = world_direction_vector / norm_factor
+
+    # map the range to the color range, so 0.5 ist the middle
+    color_range_vector = (norm_world_direction_vector + 1) * 0.5
+    # color_range_vector = norm_world_direction_vector #debug original color
+    direction_color = [color_range_vector[0], color_range_vector[1], color_range_vector[2]]
+
+    return direction_color
+
+
+def get_direction_color(hit, prev_hit):
+    """direction color between two hits in the selected space type, None if there is no valid direction"""
+
+    if hit is None or prev_hit is None:
+        return None
+
+    # finding the direction vector, from UV Coordinates, from 3D location | object space | world space
+    direction_color = None
+    if bpy.context.scene.flowmap_painter_props.space_type == "uv_space":
+        direction_color = get_uv_space_direction_color(hit, prev_hit)
+    elif bpy.context.scene.flowmap_painter_props.space_type == "object_space":
+        direction_color = get_obj_space_direction_color(hit, prev_hit)
+    elif bpy.context.scene.flowmap_painter_props.space_type == "world_space":
+        direction_color = get_world_space_direction_color(hit, prev_hit)
+
+    # check for nan (fucked value, when direction didnt work)
+    if direction_color is None or any(numpy.isnan(val) for val in direction_color):
+        return None
+    return direction_color
+
+
+def get_active_brush():
+    """return the brush of the current paint mode"""
+
+    if vars.mode == 'VERTEX_PAINT':
+        return bpy.context.tool_settings.vertex_paint.brush
+    elif vars.mode == '2D_PAINT' or vars.mode == '3D_PAINT':
+        return bpy.context.tool_settings.image_paint.brush
+    return None
+
+
+def get_paint_image(context, mode=None):
+    """return the image, that gets painted in the current mode or the given one"""
+
+    if (mode or vars.mode) == '2D_PAINT':
+        return context.space_data.image
+
+    image_paint = bpy.context.scene.tool_settings.image_paint
+    if image_paint.mode == 'IMAGE':
+        return image_paint.canvas
+
+    # material mode, the active paint slot of the active material
+    material = bpy.context.active_object.active_material
+    if material is None or material.paint_active_slot >= len(material.texture_paint_images):
+        return None
+    return material.texture_paint_images[material.paint_active_slot]
+
+
+def get_window_region(area):
+    """return the main region of the area, the modal context region can be the side panel"""
+
+    for region in area.regions:
+        if region.type == 'WINDOW':
+            return region
+    return None
+
+
+def use_direct_engine():
+    """is the direct buffer paint engine active?"""
+
+    return bpy.context.scene.flowmap_painter_props.paint_engine == "direct"
+
+
+def begin_direct_stroke(context):
+    """read the paint image or color attribute into the working buffer at the start of a stroke"""
+
+    vars.image_buffer = None
+    vars.color_buffer = None
+
+    if vars.mode == 'VERTEX_PAINT':
+        obj = bpy.context.active_object
+        if obj.data.color_attributes.active_color is None:
+            return None
+        # normally built on invoke, unless the engine was switched during the session
+        if vars.vertex_index is None:
+            vars.vertex_index = get_vertex_index(obj)
+        vars.color_buffer = vertcol.ColorAttributeBuffer(obj.data, vars.vertex_index)
+        if get_undo_budget() > 0:
+            vars.color_buffer.track_undo()
+        begin_dab_worker()
+        return None
+
+    image = get_paint_image(context)
+    if image is None or image.size[0] == 0:
+        return None
+
+    vars.image_buffer = open_image_buffer(image)
+    if vars.image_buffer is None:
+        return None
+    if get_undo_budget() > 0:
+        vars.image_buffer.track_undo()
+    begin_dab_worker()
+    return None
+
+
+def open_image_buffer(image):
+    """working buffer of the image, udim images get a buffer, that loads their tiles on demand
+
+    returns None for udim images without tile files, blender only exposes the first tile of those,
+    and for udim images with unsaved changes, unless saving them is turned on
+    """
+
+    if image.source == 'TILED':
+        if not udim.is_file_tiled(image):
+            return None
+        # strokes read the tile files, painting would lose the unsaved changes or has to save them
+        if image.is_dirty and not bpy.context.scene.flowmap_painter_props.udim_save_changes:
+            return None
+        return udim.TiledImageBuffer(image, capacity=bpy.context.scene.flowmap_painter_props.udim_tile_cache)
+    if bpy.context.scene.flowmap_painter_props.scratch_buffer:
+        return get_scratch_buffer(image)
+    return raster.ImageBuffer(image)
+
+
+def get_scratch_buffer(image):
+    """disk scratch buffer of the image, it stays open over the strokes of a paint session"""
+
+    channels = int(bpy.context.scene.flowmap_painter_props.scratch_channels)
+    buffer = vars.scratch_buffers.get(image.name)
+    if buffer is not None:
+        if buffer.image == image and (buffer.width, buffer.height) == tuple(image.size) and buffer.channels == channels:
+            return buffer
+        buffer.close()
+
+    buffer = scratch.ScratchBuffer(image, channels, directory=bpy.app.tempdir)
+    vars.scratch_buffers[image.name] = buffer
+    return buffer
+
+
+def close_scratch_buffers():
+    """write back and remove all scratch buffers, the next stroke reads the images again"""
+
+    for buffer in vars.scratch_buffers.values():
+        buffer.close()
+    vars.scratch_buffers = {}
+    return None
+
+
+@stats.timed("write back")
+def flush_buffer(buffer, interval=None):
+    """write the working buffer back into the image or color attribute | without an interval, the write is forced"""
+
+    return buffer.flush(interval=interval)
+
+
+def end_direct_stroke(operator=None):
+    """drop the working buffers, the next stroke reads the image or colors again | the stroke becomes one undo step
+
+    the operator, if given, reports an error of the dab worker and a stroke, that is too big for the undo memory.
+    without one, the error is raised, after the stroke was written back and its buffers were dropped
+    """
+
+    if bpy.app.timers.is_registered(flush_timer):
+        bpy.app.timers.unregister(flush_timer)
+    worker_error = None
+    if vars.dab_worker is not None:
+        try:
+            vars.dab_worker.wait()
+        except Exception as error:
+            # the dabs after the error are lost, the ones before it are still written back
+            worker_error = error
+
+    undone = True
+    try:
+        if vars.image_buffer is not None:
+            flush_buffer(vars.image_buffer)
+            image = vars.image_buffer.image
+            undone = push_undo_step(vars.image_buffer, 'IMAGE', image.name, "", tuple(image.size))
+            if image.source == 'TILED':
+                vars.image_buffer.close()
+        if vars.color_buffer is not None:
+            flush_buffer(vars.color_buffer)
+            undone = push_undo_step(
+                vars.color_buffer,
+                'COLOR_ATTRIBUTE',
+                vars.color_buffer.mesh.name,
+                vars.color_buffer.attribute.name,
+                len(vars.color_buffer.colors)
+            ) and undone
+    finally:
+        vars.image_buffer = None
+        vars.color_buffer = None
+
+    if worker_error is not None:
+        if operator is None:
+            raise worker_error
+        operator.report({'ERROR'}, "Background compositing failed, the rest of the stroke is lost: %s" % worker_error)
+    if not undone and operator is not None:
+        operator.report({'WARNING'}, "The stroke is bigger than the Undo Memory and can not be undone")
+    return None
+
+
+def get_undo_budget():
+    """undo memory budget in bytes, 0 turns stroke undo off"""
+
+    return bpy.context.scene.flowmap_painter_props.undo_memory * 1024 * 1024
+
+
+def push_undo_step(buffer, target_type, target_name, attribute_name, size):
+    """turn the tiles, that the buffer stored during the stroke, into one undo step
+
+    returns False, if the step alone is bigger than the undo memory and was dropped
+    """
+
+    if buffer.undo_tiles is None or len(buffer.undo_tiles) == 0:
+        return True
+
+    if vars.undo_stack is None:
+        vars.undo_stack = undo.UndoStack()
+    step = undo.UndoStep(target_type, target_name, attribute_name, size, buffer.undo_tiles)
+    buffer.undo_tiles = None
+    return vars.undo_stack.push(step, budget=get_undo_budget())
+
+
+def undo_stroke(redo=False):
+    """undo or redo the last direct engine stroke | returns False, if there was nothing to undo"""
+
+    if vars.undo_stack is None or vars.pressing:
+        return False
+
+    # the step stays on the stack, until its target is known to still fit
+    step = vars.undo_stack.peek(redo=redo)
+    if step is None:
+        return False
+
+    if step.target_type == 'IMAGE':
+        image = bpy.data.images.get(step.target_name)
+        if image is None or tuple(image.size) != step.size:
+            return False
+        buffer = open_image_buffer(image)
+        if buffer is None:
+            return False
 
-    if hit_world is None or prev_hit_world is None:
-        return None, None
     else:
+        mesh = bpy.data.meshes.get(step.target_name)
+        if mesh is None:
+            return False
+        attribute = mesh.color_attributes.get(step.attribute_name)
+        if attribute is None or len(attribute.data) != step.size:
+            return False
+        buffer = vertcol.ColorAttributeBuffer(mesh, vertex_index=None, attribute=attribute)
+
+    vars.undo_stack.pop(redo=redo)
+    replaced = buffer.swap_tiles(step.snapshot)
+    buffer.flush()
+    if step.target_type == 'IMAGE' and image.source == 'TILED':
+        buffer.close()
+    vars.undo_stack.push_inverse(step.inverse(replaced), redo=redo)
+    return True
 
-        obj = bpy.context.scene.flowmap_painter_props.object
-        if obj is None:
-            obj = bpy.context.active_object
 
-        matrix = obj.matrix_world.inverted().copy()
-        hit_obj = matrix @ hit_world
-        prev_hit_obj = matrix @ prev_hit_world
+def get_brush_size_and_strength(brush, pressure):
+    """brush radius in pixels and strength, with pen pressure applied"""
 
-        # convert to numpy array for further math
-        obj_pos = numpy.array([hit_obj[0], hit_obj[1], hit_obj[2]])
-        obj_prev_pos = numpy.array([prev_hit_obj[0], prev_hit_obj[1], prev_hit_obj[2]])
+    unified_paint_settings = bpy.context.scene.tool_settings.unified_paint_settings
+
+    size = unified_paint_settings.size
+    if brush.use_pressure_size is True:
+        size = size * pressure
+
+    strength = unified_paint_settings.strength
+    if brush.use_pressure_strength is True:
+        strength = strength * pressure
 
-        # calculate direction vector and normalize it
-        world_direction_vector = obj_pos - obj_prev_pos
-        norm_factor = numpy.linalg.norm(world_direction_vector)
-        if norm_factor == 0:
-            return None, None
+    return size, strength
 
-        norm_world_direction_vector = world_direction_vector / norm_factor
 
-        # map the range to the color range, so 0.5 ist the middle
-        color_range_vector = (norm_world_direction_vector + 1) * 0.5
-        # color_range_vector = norm_world_direction_vector #debug original color
-        direction_color = [color_range_vector[0], color_range_vector[1], color_range_vector[2]]
+def get_world_radius(context, area_pos, size, hit):
+    """project the screen space brush radius onto the surface at the hit"""
 
-        return direction_color, location
+    edge_world = view3d_utils.region_2d_to_location_3d(
+        context.region, context.region_data, (area_pos[0] + size, area_pos[1]), hit.world
+    )
+    return (edge_world - hit.world).length
 
 
-def get_world_space_direction_color(context, area_pos, area_prev_pos):
-    """get the normalized vector color from brush and previous location in world space"""
+def get_dab_uv(context, area_pos, size, hit=None):
+    """uv coordinates of a dab and its radius in uv units, traces if no hit is given"""
 
-    # get world hit and previus
-    location, hit_world = line_trace_for_pos(context=context, area_pos=area_pos)
-    _, prev_hit_world = line_trace_for_pos(context=context, area_pos=area_prev_pos)
+    # the dab at the mouse position reuses the hit of the direction trace
+    if hit is None:
+        hit = trace_hit(context=context, area_pos=area_pos)
+    if hit is None:
+        return None, None
 
-    if hit_world is None or prev_hit_world is None:
+    uv_co = hit_uv(hit)
+    if uv_co is None:
         return None, None
+
+    # project the screen space brush radius onto the surface, then into uv space
+    world_radius = get_world_radius(context, area_pos, size, hit)
+    uv_scale = vars.trace_session.snapshot.uv_scale(face_indices=hit.face_index, matrix_world=hit.matrix_world)
+    uv_radius = world_radius * uv_scale[0]
+
+    return uv_co, uv_radius
+
+
+def begin_timings(mode):
+    """start a new timing session, if timing is turned on | the last session stays readable after the mode is left"""
+
+    vars.stage_timings = None
+    if bpy.context.scene.flowmap_painter_props.collect_timings:
+        vars.stage_timings = stats.StageTimings(mode=mode)
+    return None
+
+
+@stats.timed("mesh snapshot")
+def begin_trace_session(context, obj):
+    """take the trace session for a paint session from the mesh cache"""
+
+    vars.trace_session = get_trace_session(context, obj)
+    return None
+
+
+def get_trace_session(context, obj):
+    """trace session of the object from the mesh cache | copies the mesh and builds the bvh only if it really changed"""
+
+    if vars.mesh_cache is None:
+        vars.mesh_cache = trace.MeshCache()
+
+    session, changed = vars.mesh_cache.get(obj)
+    if session is not None and not changed:
+        return session
+
+    snapshot = trace.MeshSnapshot(obj=obj, depsgraph=context.evaluated_depsgraph_get())
+    if session is None or not session.snapshot.same_geometry(snapshot):
+        session = trace.TraceSession(obj=obj, snapshot=snapshot)
+    vars.mesh_cache.put(obj, session)
+    return session
+
+
+def get_vertex_index(obj):
+    """vertex kd tree of vertex paint, kept in the trace session while the object does not move"""
+
+    session = vars.trace_session
+    if session is None or session.obj != obj:
+        return vertcol.VertexIndex(obj=obj)
+
+    if session.vertex_index is None or session.vertex_index_matrix != obj.matrix_world:
+        session.vertex_index = vertcol.VertexIndex(obj=obj)
+        session.vertex_index_matrix = obj.matrix_world.copy()
+    return session.vertex_index
+
+
+@bpy.app.handlers.persistent
+def mesh_cache_depsgraph_update(scene, depsgraph):
+    """mark cached meshes, whose geometry was updated"""
+
+    if not vars.mesh_cache:
+        return None
+
+    for update in depsgraph.updates:
+        if update.is_updated_geometry:
+            vars.mesh_cache.mark_changed(update.id.original.as_pointer())
+    return None
+
+
+@bpy.app.handlers.persistent
+def mesh_cache_load_post(*args):
+    """a new file has other objects, drop the whole cache"""
+
+    vars.mesh_cache = None
+    return None
+
+
+def begin_recording(mode):
+    """start a stroke recorder for the paint session, if recording is turned on"""
+
+    vars.recorder = None
+    if bpy.context.scene.flowmap_painter_props.record_strokes:
+        vars.recorder = record.StrokeRecorder(mode=mode)
+    return None
+
+
+def begin_recorded_stroke(context, stroke_input):
+    """start recording a stroke with the current view and brush settings"""
+
+    if vars.recorder is None:
+        return None
+
+    if vars.mode == '2D_PAINT':
+        vars.recorder.begin_stroke(
+            context, get_window_region(context.area), stroke_input, image=get_paint_image(context)
+        )
+    else:
+        vars.recorder.begin_stroke(context, context.region, stroke_input)
+    return None
+
+
+def end_recording(operator):
+    """save the strokes of the paint session, at the end of the session"""
+
+    recorder = vars.recorder
+    vars.recorder = None
+    if recorder is None or recorder.stroke_count == 0:
+        return None
+
+    filepath = bpy.path.abspath(bpy.context.scene.flowmap_painter_props.record_path)
+    try:
+        recorder.save(filepath)
+    except OSError as error:
+        operator.report({'ERROR'}, "Could not save the stroke recording: %s" % error)
+        return None
+    operator.report({'INFO'}, "Recorded %d strokes to %s" % (recorder.stroke_count, filepath))
+    return None
+
+
+@stats.timed("direct paint")
+def paint_dots_direct(context, area_type, mouse_positions, pressures, colors=None, hits=None):
+    """paint all dots of a stroke segment into the working buffer and write it back once | works 2D, 3D and vertex paint
+
+    pressures are per dot, colors and hits are optional per dot lists, by default the brush color is used and 3D dots are traced
+    """
+
+    if context.area.type != area_type:
+        return None
+
+    if vars.mode == 'VERTEX_PAINT':
+        buffer = vars.color_buffer
     else:
-        # convert to numpy array for further math
-        world_pos = numpy.array([hit_world[0], hit_world[1], hit_world[2]])
-        world_prev_pos = numpy.array([prev_hit_world[0], prev_hit_world[1], prev_hit_world[2]])
+        buffer = vars.image_buffer
+    if buffer is None:
+        return None
+
+    brush = get_active_brush()
+    if brush is None:
+        return None
+
+    if colors is None:
+        colors = [tuple(bpy.context.scene.tool_settings.unified_paint_settings.color)] * len(mouse_positions)
+    if hits is None:
+        hits = [None] * len(mouse_positions)
+
+    centers = []
+    uvs = []
+    radii = []
+    dab_colors = []
+    strengths = []
+    # uv triangles per dab, only the copies of seam splatting are clipped
+    clips = None
+    if vars.mode == '2D_PAINT':
+        # view space of the image editor is uv space, the brush size is given in image pixels
+        region = get_window_region(context.area)
+        for mouse_position, pressure, color in zip(mouse_positions, pressures, colors):
+            size, strength = get_brush_size_and_strength(brush, pressure)
+            uvs.append(region.view2d.region_to_view(mouse_position[0] - region.x, mouse_position[1] - region.y))
+            radii.append(size / buffer.width)
+            dab_colors.append(color)
+            strengths.append(strength)
+
+    elif vars.mode == 'VERTEX_PAINT':
+        # vertex dabs are world space spheres
+        for mouse_position, pressure, color, hit in zip(mouse_positions, pressures, colors, hits):
+            area_pos = (mouse_position[0] - context.area.x, mouse_position[1] - context.area.y)
+            if hit is None:
+                hit = trace_hit(context=context, area_pos=area_pos)
+            if hit is None:
+                continue
+            size, strength = get_brush_size_and_strength(brush, pressure)
+            centers.append(hit.world)
+            radii.append(get_world_radius(context, area_pos, size, hit))
+            dab_colors.append(color)
+            strengths.append(strength)
+
+    else:
+        face_indices = []
+        for mouse_position, pressure, color, hit in zip(mouse_positions, pressures, colors, hits):
+            area_pos = (mouse_position[0] - context.area.x, mouse_position[1] - context.area.y)
+            if hit is None:
+                hit = trace_hit(context=context, area_pos=area_pos)
+            if hit is None:
+                continue
+            size, strength = get_brush_size_and_strength(brush, pressure)
+            uv_co, uv_radius = get_dab_uv(context, area_pos, size, hit=hit)
+            if uv_co is None:
+                continue
+            uvs.append((uv_co[0], uv_co[1]))
+            radii.append(uv_radius)
+            dab_colors.append(color)
+            strengths.append(strength)
+            face_indices.append(hit.face_index)
+
+        if uvs and bpy.context.scene.flowmap_painter_props.seam_splatting:
+            clips = [None] * len(uvs)
+            add_seam_dabs(face_indices, uvs, radii, dab_colors, strengths, clips)
+
+    if vars.mode == 'VERTEX_PAINT':
+        paint = buffer.paint_dabs
+        dabs = dict(centers=centers, radii=radii, colors=dab_colors, strengths=strengths)
+    elif uvs:
+        # uv dabs, so udim images can sort them into their tiles
+        if vars.stamp_cache is None:
+            vars.stamp_cache = raster.StampCache()
+        paint = buffer.paint_dabs_uv
+        dabs = dict(uvs=uvs, radii=radii, colors=dab_colors, strengths=strengths, stamps=vars.stamp_cache, clips=clips)
+    else:
+        return None
+
+    if use_dab_worker(buffer):
+        # the worker blends, the flush timer writes back
+        vars.dab_worker.submit(composite_dabs, paint, falloff=raster.brush_falloff(brush), **dabs)
+        return None
+
+    composite_dabs(paint, falloff=raster.brush_falloff(brush), **dabs)
+    flush_buffer(buffer, interval=get_flush_interval(buffer))
+
+    return None
+
+
+def get_seam_index():
+    """uv seam index of the trace session, built on demand and kept with the session in the mesh cache"""
+
+    session = vars.trace_session
+    if session.seam_index is None and session.snapshot.triangle_uvs is not None:
+        session.seam_index = seams.SeamIndex(session.snapshot)
+    return session.seam_index
+
+
+@stats.timed("seam dabs")
+def add_seam_dabs(face_indices, uvs, radii, colors, strengths, clips):
+    """append a copy of every dab, that crosses an uv seam of its triangle, in the island on the other side
+
+    uv space directions are turned into the frame of the other island, the other space types keep their color.
+    the copies are clipped to the triangles of the other island around the seam, so they stay out of other islands
+    """
+
+    seam_index = get_seam_index()
+    if seam_index is None:
+        return None
+
+    dab_indices, mapped_uvs, mapped_radii, linear, mapped_clips = seam_index.crossings(face_indices, uvs, radii)
+    if dab_indices.size == 0:
+        return None
+
+    mapped_colors = [colors[index] for index in dab_indices]
+    if bpy.context.scene.flowmap_painter_props.space_type == "uv_space":
+        directions = numpy.array([color[:2] for color in mapped_colors], dtype=numpy.float64) * 2 - 1
+        directions = numpy.einsum('nij,nj->ni', linear, directions)
+        lengths = numpy.linalg.norm(directions, axis=1)[:, numpy.newaxis]
+        directions = numpy.divide(directions, lengths, out=numpy.zeros_like(directions), where=lengths > 0)
+        mapped_colors = [
+            (x, y) + tuple(color[2:]) for (x, y), color in zip(((directions + 1) * 0.5).tolist(), mapped_colors)
+        ]
+
+    uvs.extend(map(tuple, mapped_uvs.tolist()))
+    radii.extend(mapped_radii.tolist())
+    colors.extend(mapped_colors)
+    strengths.extend(strengths[index] for index in dab_indices.tolist())
+    clips.extend(mapped_clips)
+    return None
+
+
+@stats.timed("composite")
+def composite_dabs(paint, **dabs):
+    """blend the dabs into the working buffer, on the main thread or the dab worker"""
+
+    return paint(**dabs)
+
+
+def use_dab_worker(buffer):
+    """composite in the background? udim buffers load their tiles through bpy, so they stay on the main thread"""
+
+    return vars.dab_worker is not None and not isinstance(buffer, udim.TiledImageBuffer)
+
+
+def flush_timer():
+    """write back, what the dab worker composited | runs on the main thread, while a stroke is painted in the background"""
+
+    buffer = vars.image_buffer if vars.image_buffer is not None else vars.color_buffer
+    if buffer is None or vars.dab_worker is None:
+        return None
+
+    with vars.dab_worker.lock:
+        flush_buffer(buffer, interval=0.0)
+    return max(get_flush_interval(buffer), MIN_FLUSH_TIMER_INTERVAL)
+
+
+def get_flush_interval(buffer):
+    """update interval during a stroke, stretched so writing back takes at most MAX_FLUSH_SHARE of the time
+
+    a write back copies the whole image or color attribute, so big images are written back less often
+    """
 
-        # calculate direction vector and normalize it
-        world_direction_vector = world_pos - world_prev_pos
-        norm_factor = numpy.linalg.norm(world_direction_vector)
-        if norm_factor == 0:
-            return None, None
+    return max(bpy.context.scene.flowmap_painter_props.flush_interval, buffer.flush_cost / MAX_FLUSH_SHARE)
 
-        norm_world_direction_vector = world_direction_vector / norm_factor
 
-        # map the range to the color range, so 0.5 ist the middle
-        color_range_vector = (norm_world_direction_vector + 1) * 0.5
-        # color_range_vector = norm_world_direction_vector #debug original color
-        direction_color = [color_range_vector[0], color_range_vector[1], color_range_vector[2]]
+def begin_dab_worker():
+    """start the dab worker and the flush timer, if background compositing is turned on"""
 
-        return direction_color, location
+    if not bpy.context.scene.flowmap_painter_props.background_compositing:
+        stop_dab_worker()
+        return None
+
+    if vars.dab_worker is None:
+        vars.dab_worker = worker.DabWorker()
+    if not bpy.app.timers.is_registered(flush_timer):
+        bpy.app.timers.register(flush_timer, first_interval=MIN_FLUSH_TIMER_INTERVAL)
+    return None
 
 
-def paint_a_dot(context, area_type, mouse_position, event, location=None):
+def stop_dab_worker():
+    """stop the dab worker thread and the flush timer, queued dabs are still composited first"""
+
+    if bpy.app.timers.is_registered(flush_timer):
+        bpy.app.timers.unregister(flush_timer)
+    if vars.dab_worker is not None:
+        vars.dab_worker.stop()
+        vars.dab_worker = None
+    return None
+
+
+@stats.timed("blender paint")
+def paint_a_dot(context, area_type, mouse_position, pressure, location=None):
     """paint one dot | works 2D, as well as 3D and also for vertex paint"""
 
     if context.area.type != area_type:
@@ -278,22 +881,19 @@ def paint_a_dot(context, area_type, mouse_position, event, location=None):
     area_position_y = bpy.context.area.y
 
     # get the active brush
-    if vars.mode == 'VERTEX_PAINT':
-        brush = bpy.context.tool_settings.vertex_paint.brush
-    elif vars.mode == '2D_PAINT' or vars.mode == '3D_PAINT':
-        brush = bpy.context.tool_settings.image_paint.brush
-    else:
+    brush = get_active_brush()
+    if brush is None:
         return None
 
     # pressure and dynamic pen pressure
-    pressure = bpy.context.scene.tool_settings.unified_paint_settings.use_unified_strength
+    stroke_pressure = bpy.context.scene.tool_settings.unified_paint_settings.use_unified_strength
     if brush.use_pressure_strength is True:
-        pressure = pressure * event.pressure
+        stroke_pressure = stroke_pressure * pressure
 
     # size and dynamic pen pressure size
     size = bpy.context.scene.tool_settings.unified_paint_settings.size
     if brush.use_pressure_size is True:
-        size = size * event.pressure
+        size = size * pressure
 
     if location is None:
         loc = (0, 0, 0)
@@ -307,7 +907,7 @@ def paint_a_dot(context, area_type, mouse_position, event, location=None):
             "location": loc,
             "mouse": (mouse_position[0] - area_position_x, mouse_position[1] - area_position_y),
             "mouse_event": (mouse_position[0] - area_position_x, mouse_position[1] - area_position_y),
-            "pressure": pressure,
+            "pressure": stroke_pressure,
             "size": size,
             "time": 1,
             "x_tilt": 0,
@@ -325,116 +925,355 @@ def paint_a_dot(context, area_type, mouse_position, event, location=None):
     return None
 
 
+def get_dab_limit(stroke_input):
+    """how many dots the next tick may paint within the frame budget, None is unlimited"""
+
+    if not vars.pressing:
+        return None
+    return stroke_input.dab_limit(bpy.context.scene.flowmap_painter_props.frame_budget)
+
+
+def get_brush_spacing(context, stroke_input):
+    """dot spacing in screen pixels | in texel mode, the texel spacing converted with the texel density at the anchor
+
+    vertex paint has no texels and keeps the screen spacing, as does texel mode, when nothing is under the anchor
+    """
+
+    props = bpy.context.scene.flowmap_painter_props
+    if props.spacing_mode == "screen" or vars.mode == 'VERTEX_PAINT':
+        return props.brush_spacing
+
+    image = get_paint_image(context)
+    if image is None or image.size[0] == 0:
+        return props.brush_spacing
+
+    size = bpy.context.scene.tool_settings.unified_paint_settings.size
+    if vars.mode == '2D_PAINT':
+        # the brush size is given in image pixels, the view is a scale from region pixels to uv space
+        view2d = get_window_region(context.area).view2d
+        texels_per_pixel = (view2d.region_to_view(1, 0)[0] - view2d.region_to_view(0, 0)[0]) * image.size[0]
+        radius_texels = size
+    else:
+        area_pos = (stroke_input.anchor[0] - context.area.x, stroke_input.anchor[1] - context.area.y)
+        _, uv_radius = get_dab_uv(context, area_pos, size)
+        if uv_radius is None:
+            return props.brush_spacing
+        radius_texels = uv_radius * image.size[0]
+        texels_per_pixel = radius_texels / max(size, 1)
+
+    if texels_per_pixel <= 0:
+        return props.brush_spacing
+    spacing_texels = max(radius_texels * props.texel_spacing / 100, MIN_TEXEL_SPACING)
+    return spacing_texels / texels_per_pixel
+
+
+@stats.timed("paint tick")
+def paint_stroke_input_two_d(stroke_input, context):
+    """resample the mouse moves into dots and paint them with the direction of the stroke | 2D only"""
+
+    if vars.recorder is not None:
+        vars.recorder.add_tick(dab_limit=None)
+
+    # if mouse has traveled enough distance, get evenly spaced dots along the stroke
+    paint_positions, tangents, paint_pressures = stroke_input.resample(
+        spacing=get_brush_spacing(context, stroke_input),
+        smooth=bpy.context.scene.flowmap_painter_props.smooth_stroke
+    )
+    if len(paint_positions) == 0:
+        return None
+
+    stroke_input.advance()
+
+    # the tangents are the normalized direction vectors, map the range to the color range, so 0.5 ist the middle
+    color_range_vectors = (tangents + 1) * 0.5
+    paint_colors = [(color_range_vector[0], color_range_vector[1], 0) for color_range_vector in color_range_vectors]
+
+    # set paint brush color to the direction at the mouse
+    bpy.context.scene.tool_settings.unified_paint_settings.color = paint_colors[-1]
+
+    if vars.pressing:
+        # paint the actual dots with the selected brush spacing
+        if use_direct_engine():
+            paint_dots_direct(
+                context,
+                area_type='IMAGE_EDITOR',
+                mouse_positions=paint_positions,
+                pressures=paint_pressures,
+                colors=paint_colors
+            )
+        else:
+            for paint_position, paint_pressure, paint_color in zip(paint_positions, paint_pressures, paint_colors):
+                bpy.context.scene.tool_settings.unified_paint_settings.color = paint_color
+                paint_a_dot(context, area_type='IMAGE_EDITOR', mouse_position=paint_position, pressure=paint_pressure)
+
+    return None
+
+
+@stats.timed("paint tick")
+def paint_stroke_input(stroke_input, context, dab_limit=None):
+    """resample the coalesced mouse moves into dots and paint them, at most dab_limit dots in one modal tick"""
+
+    stroke_input.begin_tick()
+    if vars.recorder is not None:
+        vars.recorder.add_tick(dab_limit=dab_limit)
+
+    # get area position
+    area_position_x = context.area.x
+    area_position_y = context.area.y
+
+    # the stroke starts at the last painted position, under load the dots get spread wider
+    paint_positions, _, paint_pressures = stroke_input.resample(
+        spacing=get_brush_spacing(context, stroke_input),
+        max_count=dab_limit,
+        smooth=bpy.context.scene.flowmap_painter_props.smooth_stroke
+    )
+
+    # if mouse has not traveled enough distance, keep collecting
+    if len(paint_positions) == 0:
+        stroke_input.end_tick(dab_count=0)
+        return None
+
+    mouse_prev_position = stroke_input.anchor
+    mouse_position = paint_positions[-1]
+    stroke_input.advance()
+
+    # get area mouse positions
+    area_pos = (mouse_position[0] - area_position_x, mouse_position[1] - area_position_y)
+    area_prev_pos = (mouse_prev_position[0] - area_position_x, mouse_prev_position[1] - area_position_y)
+
+    # finding the direction vector, from UV Coordinates, from 3D location | object space | world space
+    hit, prev_hit = trace_hit_pair(context, area_pos, area_prev_pos)
+    direction_color = get_direction_color(hit, prev_hit)
+    location = None
+    if hit is not None:
+        location = hit.location
+
+    # set paint brush color, if the direction worked
+    if direction_color is not None:
+        bpy.context.scene.tool_settings.unified_paint_settings.color = direction_color
+
+    if vars.pressing:
+        # the last dot is the mouse itself, the others are substeps along the polyline
+        substep_positions = list(paint_positions[:-1])
+        substep_hits = [None] * len(substep_positions)
+        if substep_positions and hit is not None and prev_hit is not None:
+            # every substep gets its own surface hit, all traced in one batch
+            substep_hits = trace_hits(
+                context,
+                area_positions=[
+                    (position[0] - area_position_x, position[1] - area_position_y) for position in substep_positions
+                ],
+                hit=hit,
+                prev_hit=prev_hit
+            )
+
+        paint_hits = substep_hits + [hit]
+
+        # the direction follows the curve from substep to substep
+        paint_colors = []
+        last_hit = prev_hit
+        last_color = tuple(bpy.context.scene.tool_settings.unified_paint_settings.color)
+        for paint_hit in paint_hits:
+            substep_color = get_direction_color(paint_hit, last_hit)
+            if substep_color is not None:
+                last_color = tuple(substep_color)
+            paint_colors.append(last_color)
+            if paint_hit is not None:
+                last_hit = paint_hit
+
+        if use_direct_engine():
+            paint_dots_direct(
+                context,
+                area_type='VIEW_3D',
+                mouse_positions=paint_positions,
+                pressures=paint_pressures,
+                colors=paint_colors,
+                hits=paint_hits
+            )
+        else:
+            for paint_position, paint_pressure, paint_hit, paint_color in zip(
+                paint_positions, paint_pressures, paint_hits, paint_colors
+            ):
+                bpy.context.scene.tool_settings.unified_paint_settings.color = paint_color
+                paint_a_dot(
+                    context,
+                    area_type='VIEW_3D',
+                    mouse_position=paint_position,
+                    pressure=paint_pressure,
+                    location=paint_hit.location if paint_hit is not None else location
+                )
+
+    stroke_input.end_tick(dab_count=len(paint_positions) if vars.pressing else 0)
+
+    return None
+
+
+def update_tick_timer(self, context):
+    """run the tick timer only while moves are held back, an idle timer would wake the modal handler for nothing"""
+
+    if self.stroke_input.pending and self.timer is None:
+        self.timer = context.window_manager.event_timer_add(stroke.TICK_INTERVAL, window=context.window)
+    elif not self.stroke_input.pending and self.timer is not None:
+        context.window_manager.event_timer_remove(self.timer)
+        self.timer = None
+    return None
+
+
 def modal_paint_three_d(self, context, event):
     """The internal of the modal 3D operators. Its used for 3D_PAINT and VERTEX_PAINT."""
 
+    # moves that were held back, because the last tick was slow
+    if event.type == 'TIMER':
+        if self.stroke_input.pending and self.stroke_input.due():
+            paint_stroke_input(self.stroke_input, context, dab_limit=get_dab_limit(self.stroke_input))
+            context.area.tag_redraw()
+        update_tick_timer(self, context)
+        return {'PASS_THROUGH'}
+
     context.area.tag_redraw()
 
     # this is necessary, to find out if left mouse is pressed down (so no other keypress ist taken into account to trigger painting)
     if event.type == 'LEFTMOUSE' and event.value == 'PRESS':
-        # set first position of stroke
-        self.furthest_position = numpy.array([event.mouse_x, event.mouse_y])
+        # start the stroke at the last position, without the moves collected while hovering
+        self.stroke_input.clear()
         vars.pressing = True
+        if use_direct_engine():
+            begin_direct_stroke(context)
+        begin_recorded_stroke(context, self.stroke_input)
 
-    if event.type == 'LEFTMOUSE' and event.value == 'RELEASE':
-        vars.pressing = False
+    # ctrl z and ctrl shift z undo the strokes of the direct engine, blenders undo does not know them
+    if event.type == 'Z' and event.value == 'PRESS' and (event.ctrl or event.oskey):
+        if undo_stroke(redo=event.shift):
+            return {'RUNNING_MODAL'}
+        return {'PASS_THROUGH'}
 
     if event.type == 'MOUSEMOVE' or event.type == 'LEFTMOUSE':
-        # get mouse positions
-        mouse_position = numpy.array([event.mouse_x, event.mouse_y])
-
-        # get area position
-        area_position_x = bpy.context.area.x
-        area_position_y = bpy.context.area.y
-
-        # get area mouse positions
-        area_pos = (mouse_position[0] - area_position_x, mouse_position[1] - area_position_y)
-        area_prev_pos = (self.mouse_prev_position[0] - area_position_x, self.mouse_prev_position[1] - area_position_y)
-
-        # if mouse has traveled enough distance and mouse is pressed, get color, draw a dot
-        distance = numpy.linalg.norm(self.furthest_position - mouse_position)
-        if distance >= bpy.context.scene.flowmap_painter_props.brush_spacing:
-            # reset threshold
-            self.furthest_position = mouse_position
-
-            # finding the direction vector, from UV Coordinates, from 3D location | object space | world space
-            direction_color = None
-            location = None
-            if bpy.context.scene.flowmap_painter_props.space_type == "uv_space":
-                direction_color, location = get_uv_space_direction_color(context, area_pos, area_prev_pos)
-            elif bpy.context.scene.flowmap_painter_props.space_type == "object_space":
-                direction_color, location = get_obj_space_direction_color(context, area_pos, area_prev_pos)
-            elif bpy.context.scene.flowmap_painter_props.space_type == "world_space":
-                direction_color, location = get_world_space_direction_color(context, area_pos, area_prev_pos)
-
-            # set paint brush color, but check for nan first (fucked value, when direction didnt work)
-            if not direction_color is None:
-                if not any(numpy.isnan(val) for val in direction_color):
-                    bpy.context.scene.tool_settings.unified_paint_settings.color = direction_color
-
-            if vars.pressing:
-                # paint the actual dots with the selected brush spacing
-                # if mouse moved more than double of the brush_spacing -> draw substeps
-                substeps_float = distance / bpy.context.scene.flowmap_painter_props.brush_spacing
-                substeps_int = int(substeps_float)
-                if distance > 2 * bpy.context.scene.flowmap_painter_props.brush_spacing:
-                    # substep_count = substeps_int
-                    substep_count = substeps_int
-                    while substep_count > 0:
-                        # lerp_mix = 1 / (substeps_int + 1) * substep_count
-                        lerp_mix = 1 / (substeps_int) * substep_count
-                        lerp_paint_position = numpy.array(
-                            [
-                                lerp(lerp_mix, self.mouse_prev_position[0], mouse_position[0]),
-                                lerp(lerp_mix, self.mouse_prev_position[1], mouse_position[1])
-                            ]
-                        )
-                        paint_a_dot(
-                            context,
-                            area_type='VIEW_3D',
-                            mouse_position=lerp_paint_position,
-                            event=event,
-                            location=location
-                        )
-                        substep_count = substep_count - 1
-
-                else:
-                    paint_a_dot(
-                        context, area_type='VIEW_3D', mouse_position=mouse_position, event=event, location=location
-                    )
-
-            self.mouse_prev_position = mouse_position
-
-        # remove circle
-        if vars.circle:
-            bpy.types.SpaceView3D.draw_handler_remove(vars.circle, 'WINDOW')
-            vars.circle = None
-
-        vars.circle_pos = (event.mouse_region_x, event.mouse_region_y)
-
-        # draw circle
-        def draw():
-            pos = vars.circle_pos
+        # idle timer ticks are not timed, they would hide the events that do work
+        start = time.perf_counter()
+
+        # collect the mouse position, paint right away unless events are backing up
+        self.stroke_input.add((event.mouse_x, event.mouse_y), event.pressure)
+        if vars.recorder is not None:
+            vars.recorder.add_point((event.mouse_x, event.mouse_y), event.pressure)
+        releasing = event.type == 'LEFTMOUSE' and event.value == 'RELEASE'
+        if self.stroke_input.due() or releasing:
+            paint_stroke_input(self.stroke_input, context, dab_limit=get_dab_limit(self.stroke_input))
+
+        if releasing:
+            vars.pressing = False
+            end_direct_stroke(self)
+            if vars.recorder is not None:
+                vars.recorder.end_stroke()
+
+        # update circle
+        if vars.cursor:
             brush_col = bpy.context.scene.tool_settings.unified_paint_settings.color
-            col = (brush_col[0], brush_col[1], brush_col[2], 1)
-            size = bpy.context.scene.tool_settings.unified_paint_settings.size
-
-            draw_circle_2d(pos, col, size)
-
-        vars.circle = bpy.types.SpaceView3D.draw_handler_add(draw, (), 'WINDOW', 'POST_PIXEL')
+            vars.cursor.update(
+                position=(event.mouse_region_x, event.mouse_region_y),
+                color=(brush_col[0], brush_col[1], brush_col[2], 1),
+                radius=bpy.context.scene.tool_settings.unified_paint_settings.size
+            )
 
+        update_tick_timer(self, context)
+        if vars.stage_timings is not None:
+            vars.stage_timings.add("modal event", time.perf_counter() - start)
         return {'RUNNING_MODAL'}
 
     if event.type == 'ESC':
         # clean brush color from nan shit
         bpy.context.scene.tool_settings.unified_paint_settings.color = (0.5, 0.5, 0.5)
         # remove circle
-        if vars.circle:
-            bpy.types.SpaceView3D.draw_handler_remove(vars.circle, 'WINDOW')
-            context.area.tag_redraw()
-            vars.circle = None
+        if vars.cursor:
+            vars.cursor.remove()
+            vars.cursor = None
+        if self.timer:
+            context.window_manager.event_timer_remove(self.timer)
+            self.timer = None
         context.area.tag_redraw()
-        remove_temp_obj()
+        end_direct_stroke(self)
+        close_scratch_buffers()
+        end_recording(self)
+        vars.trace_session = None
+        vars.vertex_index = None
         return {'FINISHED'}
 
     return {'PASS_THROUGH'}
+
+
+def replay_recording(context, recording):
+    """paint every stroke of a recording again, as fast as possible and without the ui
+
+    the direct engine is used, the ticks of the recording are painted with their recorded dot limits,
+    so the result matches the session. scene settings and paint state are restored afterwards
+    """
+
+    props = bpy.context.scene.flowmap_painter_props
+    unified_paint_settings = bpy.context.scene.tool_settings.unified_paint_settings
+
+    saved_props = {
+        key: getattr(props, key)
+        for key in ("paint_engine", "brush_spacing", "spacing_mode", "texel_spacing", "smooth_stroke", "space_type")
+    }
+    saved_unified = {
+        "size": unified_paint_settings.size,
+        "strength": unified_paint_settings.strength,
+        "color": tuple(unified_paint_settings.color),
+    }
+    saved_vars = (vars.mode, vars.pressing, vars.trace_session, vars.vertex_index, vars.recorder)
+
+    image = None
+    if recording.mode == '2D_PAINT':
+        image = bpy.data.images.get(recording.image_name)
+    vars.mode = recording.mode
+    vars.recorder = None
+    vars.trace_session = None
+    vars.vertex_index = None
+
+    try:
+        props.paint_engine = "direct"
+        if recording.mode != '2D_PAINT':
+            begin_trace_session(context, bpy.data.objects[recording.object_name])
+
+        for index in range(recording.stroke_count):
+            settings = recording.stroke_settings(index)
+            props.brush_spacing = settings["brush_spacing"]
+            props.spacing_mode = settings["spacing_mode"]
+            props.texel_spacing = settings["texel_spacing"]
+            props.smooth_stroke = settings["smooth_stroke"]
+            props.space_type = settings["space_type"]
+            unified_paint_settings.size = settings["size"]
+            unified_paint_settings.strength = settings["strength"]
+
+            stroke_context = recording.stroke_context(index, scene=bpy.context.scene, image=image)
+            anchor, anchor_pressure, lead_in = recording.stroke_anchor(index)
+            stroke_input = stroke.StrokeInput(anchor=anchor)
+            stroke_input.anchor_pressure = anchor_pressure
+            stroke_input.lead_in = lead_in
+
+            vars.pressing = True
+            begin_direct_stroke(stroke_context)
+            kinds, positions, pressures, dab_limits = recording.stroke_events(index)
+            for kind, position, pressure, dab_limit in zip(kinds, positions, pressures, dab_limits):
+                if kind == record.KIND_POINT:
+                    stroke_input.add(position, float(pressure))
+                elif recording.mode == '2D_PAINT':
+                    paint_stroke_input_two_d(stroke_input, stroke_context)
+                else:
+                    paint_stroke_input(
+                        stroke_input,
+                        stroke_context,
+                        dab_limit=None if dab_limit == record.NO_DAB_LIMIT else int(dab_limit)
+                    )
+            vars.pressing = False
+            end_direct_stroke()
+
+    finally:
+        end_direct_stroke()
+        close_scratch_buffers()
+        for key, value in saved_props.items():
+            setattr(props, key, value)
+        for key, value in saved_unified.items():
+            setattr(unified_paint_settings, key, value)
+        vars.mode, vars.pressing, vars.trace_session, vars.vertex_index, vars.recorder = saved_vars
+
+    return recording.stroke_count
@@ -17,11 +17,16 @@
 #
 # ##### END GPL LICENSE BLOCK #####
 
+import time
+
 import bpy
-import numpy
-from gpu_extras.presets import draw_circle_2d
 
+from . import bake
+from . import cursor
 from . import funcs
+from . import postprocess
+from . import record
+from . import stroke
 from . import vars
 
 
@@ -31,105 +36,63 @@ class FLOWMAP_OT_FLOW_MAP_PAINT_2D(bpy.types.Operator):
     bl_idname = "flowmap.flow_map_paint_two_d"
     bl_label = "Flowmap 2D Paint Mode"
 
-    furthest_position = numpy.array([0, 0])
-    mouse_prev_position = (0, 0)
+    stroke_input = None
 
     def modal(self, context: bpy.types.Context, event: bpy.types.Event):
         context.area.tag_redraw()
 
         # this is necessary, to find out if left mouse is pressed down (so no other keypress ist taken into account to trigger painting)
         if event.type == 'LEFTMOUSE' and event.value == 'PRESS':
-            # set first position of stroke
-            self.furthest_position = numpy.array([event.mouse_x, event.mouse_y])
+            # start the stroke at the last position, without the moves collected while hovering
+            self.stroke_input.clear()
             vars.pressing = True
+            if funcs.use_direct_engine():
+                funcs.begin_direct_stroke(context)
+            funcs.begin_recorded_stroke(context, self.stroke_input)
 
-        if event.type == 'LEFTMOUSE' and event.value == 'RELEASE':
-            vars.pressing = False
+        # ctrl z and ctrl shift z undo the strokes of the direct engine, blenders undo does not know them
+        if event.type == 'Z' and event.value == 'PRESS' and (event.ctrl or event.oskey):
+            if funcs.undo_stroke(redo=event.shift):
+                return {'RUNNING_MODAL'}
+            return {'PASS_THROUGH'}
 
         if event.type == 'MOUSEMOVE' or event.type == 'LEFTMOUSE':
-            # get mouse positions
-            mouse_position = numpy.array([event.mouse_x, event.mouse_y])
-
-            # if mouse has traveled enough distance and mouse is pressed, draw a dot
-            distance = numpy.linalg.norm(self.furthest_position - mouse_position)
-            if distance >= bpy.context.scene.flowmap_painter_props.brush_spacing:
-                # reset threshold
-                self.furthest_position = mouse_position
-
-                # calculate direction vector and normalize it
-                mouse_direction_vector = mouse_position - self.mouse_prev_position
-                norm_factor = numpy.linalg.norm(mouse_direction_vector)
-                if norm_factor == 0:
-                    norm_mouse_direction_vector = numpy.array([0, 0])
-                else:
-                    norm_mouse_direction_vector = mouse_direction_vector / norm_factor
-
-                # map the range to the color range, so 0.5 ist the middle
-                color_range_vector = (norm_mouse_direction_vector + 1) * 0.5
-                direction_color = [color_range_vector[0], color_range_vector[1], 0]
-
-                # set paint brush color, but check for nan first (fucked value, when direction didnt work)
-                if any(numpy.isnan(val) for val in direction_color):
-                    pass
-                else:
-                    bpy.context.scene.tool_settings.unified_paint_settings.color = direction_color
-
-                if vars.pressing:
-                    # paint the actual dots with the selected brush spacing
-                    # if mouse moved more than double of the brush_spacing -> draw substeps
-                    substeps_float = distance / bpy.context.scene.flowmap_painter_props.brush_spacing
-                    substeps_int = int(substeps_float)
-                    if distance > 2 * bpy.context.scene.flowmap_painter_props.brush_spacing:
-                        # substep_count = substeps_int
-                        substep_count = substeps_int
-                        while substep_count > 0:
-                            # lerp_mix = 1 / (substeps_int + 1) * substep_count
-                            lerp_mix = 1 / (substeps_int) * substep_count
-                            lerp_paint_position = numpy.array(
-                                [
-                                    funcs.lerp(lerp_mix, self.mouse_prev_position[0], mouse_position[0]),
-                                    funcs.lerp(lerp_mix, self.mouse_prev_position[1], mouse_position[1])
-                                ]
-                            )
-                            funcs.paint_a_dot(
-                                context, area_type='IMAGE_EDITOR', mouse_position=lerp_paint_position, event=event
-                            )
-                            substep_count = substep_count - 1
-
-                    else:
-                        funcs.paint_a_dot(context, area_type='IMAGE_EDITOR', mouse_position=mouse_position, event=event)
-
-                self.mouse_prev_position = mouse_position
-
-            # remove circle
-            if vars.circle:
-                bpy.types.SpaceImageEditor.draw_handler_remove(vars.circle, 'WINDOW')
-                vars.circle = None
-
-            vars.circle_pos = (event.mouse_region_x, event.mouse_region_y)
-
-            # draw circle
-            def draw():
-                pos = vars.circle_pos
+            start = time.perf_counter()
+            self.stroke_input.add((event.mouse_x, event.mouse_y), event.pressure)
+            if vars.recorder is not None:
+                vars.recorder.add_point((event.mouse_x, event.mouse_y), event.pressure)
+            funcs.paint_stroke_input_two_d(self.stroke_input, context)
+
+            if event.type == 'LEFTMOUSE' and event.value == 'RELEASE':
+                vars.pressing = False
+                funcs.end_direct_stroke(self)
+                if vars.recorder is not None:
+                    vars.recorder.end_stroke()
+
+            # update circle
+            if vars.cursor:
                 brush_col = bpy.context.scene.tool_settings.unified_paint_settings.color
-                col = (brush_col[0], brush_col[1], 0, 1)
-
-                size = bpy.context.scene.tool_settings.unified_paint_settings.size * bpy.context.space_data.zoom[0]
-
-                draw_circle_2d(pos, col, size)
-
-            vars.circle = bpy.types.SpaceImageEditor.draw_handler_add(draw, (), 'WINDOW', 'POST_PIXEL')
-
+                vars.cursor.update(
+                    position=(event.mouse_region_x, event.mouse_region_y),
+                    color=(brush_col[0], brush_col[1], 0, 1),
+                    radius=bpy.context.scene.tool_settings.unified_paint_settings.size
+                )
+
+            if vars.stage_timings is not None:
+                vars.stage_timings.add("modal event", time.perf_counter() - start)
             return {'RUNNING_MODAL'}
 
         if event.type == 'ESC':
             # print("stop")
             bpy.context.scene.tool_settings.unified_paint_settings.color = (0.5, 0.5, 0.5)
             # remove circle
-            if vars.circle:
-                bpy.types.SpaceImageEditor.draw_handler_remove(vars.circle, 'WINDOW')
-                vars.circle = None
+            if vars.cursor:
+                vars.cursor.remove()
+                vars.cursor = None
             context.area.tag_redraw()
+            funcs.end_direct_stroke(self)
+            funcs.close_scratch_buffers()
+            funcs.end_recording(self)
 
             return {'FINISHED'}
 
@@ -139,11 +102,17 @@ class FLOWMAP_OT_FLOW_MAP_PAINT_2D(bpy.types.Operator):
     def invoke(self, context, event):
 
         context.window_manager.modal_handler_add(self)
+        self.stroke_input = stroke.StrokeInput(anchor=(event.mouse_x, event.mouse_y))
         # turn on unified settings (so its easier to get values for 2D and 3D paint)
         bpy.context.scene.tool_settings.unified_paint_settings.use_unified_color = True
         bpy.context.scene.tool_settings.unified_paint_settings.use_unified_strength = True
         bpy.context.scene.tool_settings.unified_paint_settings.use_unified_size = True
         vars.mode = '2D_PAINT'
+        funcs.begin_timings(mode=vars.mode)
+        funcs.begin_recording(mode=vars.mode)
+        if vars.cursor:
+            vars.cursor.remove()
+        vars.cursor = cursor.BrushCursor(bpy.types.SpaceImageEditor)
         bpy.context.window.cursor_set('PAINT_CROSS')
         return {'RUNNING_MODAL'}
 
@@ -154,8 +123,8 @@ class FLOWMAP_OT_FLOW_MAP_PAINT_3D(bpy.types.Operator):
     bl_idname = "flowmap.flow_map_paint_three_d"
     bl_label = "Flowmap 3D Paint Mode"
 
-    furthest_position = numpy.array([0, 0])
-    mouse_prev_position = (0, 0)
+    stroke_input = None
+    timer = None
 
     def modal(self, context=bpy.types.Context, event=bpy.types.Event):
 
@@ -165,12 +134,20 @@ class FLOWMAP_OT_FLOW_MAP_PAINT_3D(bpy.types.Operator):
     def invoke(self, context, event):
 
         context.window_manager.modal_handler_add(self)
+        self.stroke_input = stroke.StrokeInput(anchor=(event.mouse_x, event.mouse_y))
+        # the tick timer only runs while moves are held back
+        self.timer = None
         # turn on unified settings (so its easier to get values for 2D and 3D paint)
         bpy.context.scene.tool_settings.unified_paint_settings.use_unified_color = True
         bpy.context.scene.tool_settings.unified_paint_settings.use_unified_strength = True
         bpy.context.scene.tool_settings.unified_paint_settings.use_unified_size = True
-        vars.tri_obj = funcs.triangulate_object(obj=bpy.context.active_object)
         vars.mode = '3D_PAINT'
+        funcs.begin_timings(mode=vars.mode)
+        funcs.begin_recording(mode=vars.mode)
+        funcs.begin_trace_session(context, bpy.context.active_object)
+        if vars.cursor:
+            vars.cursor.remove()
+        vars.cursor = cursor.BrushCursor(bpy.types.SpaceView3D)
         bpy.context.window.cursor_set('PAINT_CROSS')
         return {'RUNNING_MODAL'}
 
@@ -181,8 +158,8 @@ class FLOWMAP_OT_FLOW_MAP_PAINT_VERTCOL(bpy.types.Operator):
     bl_idname = "flowmap.flow_map_paint_vcol"
     bl_label = "Flowmap Vertex Paint Mode"
 
-    furthest_position = numpy.array([0, 0])
-    mouse_prev_position = (0, 0)
+    stroke_input = None
+    timer = None
 
     def modal(self, context=bpy.types.Context, event=bpy.types.Event):
         ret = funcs.modal_paint_three_d(self=self, context=context, event=event)
@@ -191,11 +168,258 @@ class FLOWMAP_OT_FLOW_MAP_PAINT_VERTCOL(bpy.types.Operator):
     def invoke(self, context, event):
 
         context.window_manager.modal_handler_add(self)
+        self.stroke_input = stroke.StrokeInput(anchor=(event.mouse_x, event.mouse_y))
+        # the tick timer only runs while moves are held back
+        self.timer = None
         # turn on unified settings (so its easier to get values for 2D and 3D paint)
         bpy.context.scene.tool_settings.unified_paint_settings.use_unified_color = True
         bpy.context.scene.tool_settings.unified_paint_settings.use_unified_strength = True
         bpy.context.scene.tool_settings.unified_paint_settings.use_unified_size = True
-        vars.tri_obj = funcs.triangulate_object(obj=bpy.context.active_object)
         vars.mode = 'VERTEX_PAINT'
+        funcs.begin_timings(mode=vars.mode)
+        funcs.begin_recording(mode=vars.mode)
+        funcs.begin_trace_session(context, bpy.context.active_object)
+        vars.vertex_index = None
+        if bpy.context.scene.flowmap_painter_props.paint_engine == "direct":
+            vars.vertex_index = funcs.get_vertex_index(bpy.context.active_object)
+        if vars.cursor:
+            vars.cursor.remove()
+        vars.cursor = cursor.BrushCursor(bpy.types.SpaceView3D)
         bpy.context.window.cursor_set('PAINT_CROSS')
         return {'RUNNING_MODAL'}
+
+
+class FLOWMAP_OT_REPLAY_STROKES(bpy.types.Operator):
+    """Replay Flowmap Strokes | Paint a stroke recording again, as fast as possible, with the direct paint engine"""
+
+    bl_idname = "flowmap.replay_strokes"
+    bl_label = "Replay Flowmap Strokes"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH')
+    filter_glob: bpy.props.StringProperty(default="*.npz", options={'HIDDEN'})
+
+    def execute(self, context):
+        try:
+            recording = record.StrokeRecording(bpy.path.abspath(self.filepath))
+        except (OSError, KeyError, ValueError) as error:
+            self.report({'ERROR'}, "Could not read the stroke recording: %s" % error)
+            return {'CANCELLED'}
+
+        if recording.mode == '2D_PAINT':
+            if bpy.data.images.get(recording.image_name) is None:
+                self.report({'ERROR'}, "The recorded image \"%s\" does not exist" % recording.image_name)
+                return {'CANCELLED'}
+        else:
+            obj = bpy.data.objects.get(recording.object_name)
+            if obj is None or obj.type != 'MESH':
+                self.report({'ERROR'}, "The recorded mesh object \"%s\" does not exist" % recording.object_name)
+                return {'CANCELLED'}
+            # the paint image, material slots and object space come from the active object
+            if obj != bpy.context.active_object:
+                self.report({'ERROR'}, "Make the recorded object \"%s\" active, to replay its strokes" % obj.name)
+                return {'CANCELLED'}
+
+        start = time.perf_counter()
+        stroke_count = funcs.replay_recording(context, recording)
+        self.report({'INFO'}, "Replayed %d strokes in %.2f s" % (stroke_count, time.perf_counter() - start))
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = context.scene.flowmap_painter_props.record_path
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
+class FLOWMAP_OT_EXPORT_TIMINGS(bpy.types.Operator):
+    """Export Flowmap Timings | Save the stage timings of the last paint session as JSON or CSV"""
+
+    bl_idname = "flowmap.export_timings"
+    bl_label = "Export Flowmap Timings"
+
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH')
+    file_format: bpy.props.EnumProperty(
+        name="format",
+        description="JSON keeps the durations of the rolling window, CSV only the percentiles per stage",
+        items=(
+            ("JSON", "JSON", "Percentiles and durations per stage"),
+            ("CSV", "CSV", "One row of percentiles per stage"),
+        ),
+        default="JSON"
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return vars.stage_timings is not None
+
+    def execute(self, context):
+        filepath = bpy.path.abspath(self.filepath)
+        extension = "." + self.file_format.lower()
+        if not filepath.lower().endswith(extension):
+            filepath += extension
+
+        try:
+            if self.file_format == "CSV":
+                vars.stage_timings.export_csv(filepath)
+            else:
+                vars.stage_timings.export_json(filepath)
+        except OSError as error:
+            self.report({'ERROR'}, "Could not export the timings: %s" % error)
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, "Exported the timings to %s" % filepath)
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = "//flowmap_timings"
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
+class FLOWMAP_OT_UNDO_STROKE(bpy.types.Operator):
+    """Undo Flowmap Stroke | Undo or redo the last stroke of the Direct Buffer paint engine"""
+
+    bl_idname = "flowmap.undo_stroke"
+    bl_label = "Undo Flowmap Stroke"
+
+    redo: bpy.props.BoolProperty(name="redo", default=False)
+
+    @classmethod
+    def poll(cls, context):
+        return vars.undo_stack is not None
+
+    def execute(self, context):
+        undone = funcs.undo_stroke(redo=self.redo)
+        # the buttons can be used outside of a paint session, so no scratch buffer is left open
+        if not vars.pressing:
+            funcs.close_scratch_buffers()
+        if not undone:
+            self.report({'WARNING'}, "Nothing to %s" % ("redo" if self.redo else "undo"))
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+
+class FLOWMAP_OT_BAKE_CURVE_FLOW(bpy.types.Operator):
+    """Bake Curve Flow | Bake the direction of the selected curves into the bake image, in uv space of the active mesh"""
+
+    bl_idname = "flowmap.bake_curve_flow"
+    bl_label = "Bake Curve Flow"
+
+    @classmethod
+    def poll(cls, context):
+        return context.active_object is not None and context.active_object.type == 'MESH'
+
+    def execute(self, context):
+        props = context.scene.flowmap_painter_props
+        obj = context.active_object
+
+        curve_objects = [selected for selected in context.selected_objects if selected.type in {'CURVE', 'CURVES'}]
+        if not curve_objects:
+            self.report({'ERROR'}, "Select the curves, that guide the flow")
+            return {'CANCELLED'}
+
+        image = props.bake_image
+        if image is None or image.size[0] == 0:
+            self.report({'ERROR'}, "Choose an image to bake into")
+            return {'CANCELLED'}
+        if image.source == 'TILED':
+            self.report({'ERROR'}, "Baking into UDIM images is not supported")
+            return {'CANCELLED'}
+
+        start = time.perf_counter()
+        depsgraph = context.evaluated_depsgraph_get()
+        snapshot = funcs.get_trace_session(context, obj).snapshot
+        if snapshot.triangle_uvs is None:
+            self.report({'ERROR'}, "The mesh needs a UV Map")
+            return {'CANCELLED'}
+
+        segments = bake.CurveSegments(curve_objects, depsgraph)
+        if len(segments) == 0:
+            self.report({'ERROR'}, "The selected curves have no segments")
+            return {'CANCELLED'}
+
+        buffer = funcs.open_image_buffer(image)
+        if funcs.get_undo_budget() > 0:
+            buffer.track_undo()
+        texel_count = bake.bake_curve_flow(
+            buffer, snapshot, obj.matrix_world, segments, blend_distance=props.bake_blend_distance
+        )
+        funcs.flush_buffer(buffer)
+        if not funcs.push_undo_step(buffer, 'IMAGE', image.name, "", tuple(image.size)):
+            self.report({'WARNING'}, "The bake is bigger than the Undo Memory and can not be undone")
+        funcs.close_scratch_buffers()
+
+        self.report({'INFO'}, "Baked %d texels in %.2f s" % (texel_count, time.perf_counter() - start))
+        return {'FINISHED'}
+
+
+class FLOWMAP_OT_POST_PROCESS(bpy.types.Operator):
+    """Post Process Flowmap | Renormalize, dilate or blur the flow directions of the paint image"""
+
+    bl_idname = "flowmap.post_process"
+    bl_label = "Post Process Flowmap"
+
+    process_items = (
+        ("renormalize", "Renormalize", "Scale every flow direction back to unit length"),
+        ("dilate", "Dilate", "Spread the colors of the uv islands of the active mesh into the pixels around them"),
+        ("blur", "Blur", "Blur the flow directions, only inside the uv islands, if the active mesh has a UV Map"),
+    )
+
+    process: bpy.props.EnumProperty(name="process", items=process_items, default="renormalize")
+
+    def execute(self, context):
+        props = context.scene.flowmap_painter_props
+        mode = '2D_PAINT' if context.area is not None and context.area.type == 'IMAGE_EDITOR' else '3D_PAINT'
+
+        image = funcs.get_paint_image(context, mode=mode)
+        if image is None or image.size[0] == 0:
+            self.report({'ERROR'}, "There is no image to post process")
+            return {'CANCELLED'}
+        if image.source == 'TILED':
+            self.report({'ERROR'}, "Post processing UDIM images is not supported")
+            return {'CANCELLED'}
+
+        start = time.perf_counter()
+        mask = None
+        obj = context.active_object
+        if self.process != "renormalize" and obj is not None and obj.type == 'MESH':
+            snapshot = funcs.get_trace_session(context, obj).snapshot
+            if snapshot.triangle_uvs is not None:
+                mask = postprocess.coverage_mask(snapshot, image.size[0], image.size[1])
+        if self.process == "dilate" and mask is None:
+            self.report({'ERROR'}, "Dilating needs an active mesh with a UV Map")
+            return {'CANCELLED'}
+
+        buffer = funcs.open_image_buffer(image)
+        # uv space flow only lives in red and green
+        components = 2 if mode == '2D_PAINT' or props.space_type == "uv_space" else 3
+        components = min(components, buffer.channels)
+        # every tile is stored, uncompressed that is the whole image, it has to fit into the undo memory
+        undo_budget = funcs.get_undo_budget()
+        if 0 < undo_budget and buffer.pixels.nbytes <= undo_budget:
+            buffer.track_undo()
+            buffer.save_tiles(0, buffer.width, 0, buffer.height)
+        elif undo_budget > 0:
+            self.report({'WARNING'}, "The image is bigger than the Undo Memory, post processing can not be undone")
+
+        if self.process == "renormalize":
+            postprocess.renormalize(buffer, components)
+            message = "Renormalized"
+        elif self.process == "dilate":
+            texel_count = postprocess.dilate(buffer, mask, props.post_padding)
+            message = "Dilated %d texels" % texel_count
+        else:
+            postprocess.blur(buffer, components, props.post_blur_radius, mask=mask)
+            message = "Blurred"
+
+        funcs.flush_buffer(buffer)
+        if not funcs.push_undo_step(buffer, 'IMAGE', image.name, "", tuple(image.size)):
+            self.report({'WARNING'}, "The image is bigger than the Undo Memory, post processing can not be undone")
+        # the buttons can be used during a paint session, that keeps its scratch buffer open
+        if not vars.pressing:
+            funcs.close_scratch_buffers()
+
+        self.report({'INFO'}, "%s in %.2f s" % (message, time.perf_counter() - start))
+        return {'FINISHED'}
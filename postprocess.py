@@ -0,0 +1,264 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from . import bake
+
+# edge length of the tiles, that run in parallel, big enough that numpy and not python does the work
+TILE_SIZE = 512
+# decoded vectors shorter than this have no direction, they become the neutral middle color
+LENGTH_EPSILON = 1e-6
+
+
+def image_tiles(width, height, tile_size=TILE_SIZE):
+    """x0, x1, y0, y1 of every tile of the image"""
+
+    return [
+        (x0, min(x0 + tile_size, width), y0, min(y0 + tile_size, height))
+        for y0 in range(0, height, tile_size)
+        for x0 in range(0, width, tile_size)
+    ]
+
+
+def run_tiles(function, tiles, workers=None):
+    """call the function with every tile on a thread pool | returns the results in the order of the tiles
+
+    numpy releases the gil in the heavy parts, so threads run the tiles in parallel
+    """
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(function, *tile) for tile in tiles]
+        return [future.result() for future in futures]
+
+
+def decode(colors, components):
+    """direction vectors of the flow colors, the inverse of (v + 1) * 0.5"""
+
+    return colors[..., :components].astype(numpy.float32) * 2 - 1
+
+
+def encode(vectors):
+    return (vectors + 1) * 0.5
+
+
+def normalized(vectors):
+    """unit length vectors, vectors without a direction become 0"""
+
+    lengths = numpy.linalg.norm(vectors, axis=-1, keepdims=True)
+    return numpy.divide(vectors, lengths, out=numpy.zeros_like(vectors), where=lengths > LENGTH_EPSILON)
+
+
+def coverage_mask(snapshot, width, height, workers=None):
+    """which texel centers lie inside a uv triangle of the mesh, as height x width bools"""
+
+    # only the uv part of the raster is used, so the world matrix does not matter
+    uv_raster = bake.UvRaster(snapshot, numpy.identity(4), width, height)
+    mask = numpy.zeros((height, width), dtype=bool)
+
+    def cover_tile(x0, x1, y0, y1):
+        rasterized = uv_raster.rasterize(x0, x1, y0, y1)
+        if rasterized is not None:
+            x, y = rasterized[:2]
+            mask[y, x] = True
+        return None
+
+    run_tiles(cover_tile, image_tiles(width, height), workers)
+    return mask
+
+
+def renormalize(buffer, components, workers=None):
+    """scale the decoded direction of every texel back to unit length"""
+
+    def renormalize_tile(x0, x1, y0, y1):
+        colors = buffer.pixels[y0:y1, x0:x1]
+        colors[..., :components] = encode(normalized(decode(colors, components)))
+        return None
+
+    run_tiles(renormalize_tile, image_tiles(buffer.width, buffer.height), workers)
+    buffer.mark_dirty(0, buffer.width, 0, buffer.height)
+    return None
+
+
+def distance_type(index_type):
+    """integer type, that holds the squared distance of any two texels"""
+
+    return numpy.int32 if index_type == numpy.int16 else numpy.int64
+
+
+def jump_tile(seed_y, seed_x, next_y, next_x, step, x0, x1, y0, y1):
+    """one jump flooding pass over the tile, every texel takes the nearest seed of its neighbours a step away"""
+
+    height, width = seed_y.shape
+    value_type = distance_type(seed_y.dtype)
+    rows = numpy.arange(y0, y1, dtype=value_type)[:, numpy.newaxis]
+    columns = numpy.arange(x0, x1, dtype=value_type)[numpy.newaxis, :]
+
+    best_y = seed_y[y0:y1, x0:x1].astype(value_type)
+    best_x = seed_x[y0:y1, x0:x1].astype(value_type)
+    best_distances = numpy.where(
+        best_y >= 0, (rows - best_y) ** 2 + (columns - best_x) ** 2, numpy.iinfo(value_type).max
+    )
+
+    for dy in (-step, 0, step):
+        for dx in (-step, 0, step):
+            if dy == 0 and dx == 0:
+                continue
+            # the neighbours a step away, clipped at the image border
+            source_y0, source_y1 = max(y0 + dy, 0), min(y1 + dy, height)
+            source_x0, source_x1 = max(x0 + dx, 0), min(x1 + dx, width)
+            if source_y0 >= source_y1 or source_x0 >= source_x1:
+                continue
+            local_y = slice(source_y0 - dy - y0, source_y1 - dy - y0)
+            local_x = slice(source_x0 - dx - x0, source_x1 - dx - x0)
+
+            candidate_y = seed_y[source_y0:source_y1, source_x0:source_x1].astype(value_type)
+            candidate_x = seed_x[source_y0:source_y1, source_x0:source_x1].astype(value_type)
+            distances = (rows[local_y] - candidate_y) ** 2 + (columns[:, local_x] - candidate_x) ** 2
+            better = (candidate_y >= 0) & (distances < best_distances[local_y, local_x])
+
+            numpy.copyto(best_y[local_y, local_x], candidate_y, where=better)
+            numpy.copyto(best_x[local_y, local_x], candidate_x, where=better)
+            numpy.copyto(best_distances[local_y, local_x], distances, where=better)
+
+    next_y[y0:y1, x0:x1] = best_y
+    next_x[y0:y1, x0:x1] = best_x
+    return None
+
+
+def dilate(buffer, mask, padding, workers=None):
+    """copy the colors of the covered texels into the uncovered ones, up to padding texels away | returns the texel count
+
+    the nearest covered texel comes from a jump flooding distance transform, that needs only log2(padding) passes
+    """
+
+    height, width = mask.shape
+    tiles = image_tiles(width, height)
+    index_type = numpy.int16 if max(width, height) < numpy.iinfo(numpy.int16).max else numpy.int32
+
+    # coordinates of the nearest covered texel, -1 where none was found yet
+    seed_y = numpy.where(mask, numpy.arange(height, dtype=index_type)[:, numpy.newaxis], -1).astype(index_type)
+    seed_x = numpy.where(mask, numpy.arange(width, dtype=index_type)[numpy.newaxis, :], -1).astype(index_type)
+    next_y = numpy.empty_like(seed_y)
+    next_x = numpy.empty_like(seed_x)
+
+    # the first jump is the smallest power of two, that reaches the padding
+    step = 1 << max(int(padding) - 1, 0).bit_length()
+    while step >= 1:
+        run_tiles(lambda *tile: jump_tile(seed_y, seed_x, next_y, next_x, step, *tile), tiles, workers)
+        seed_y, next_y = next_y, seed_y
+        seed_x, next_x = next_x, seed_x
+        step //= 2
+
+    def fill_tile(x0, x1, y0, y1):
+        value_type = distance_type(seed_y.dtype)
+        tile_y = seed_y[y0:y1, x0:x1].astype(value_type)
+        tile_x = seed_x[y0:y1, x0:x1].astype(value_type)
+        rows = numpy.arange(y0, y1, dtype=value_type)[:, numpy.newaxis]
+        columns = numpy.arange(x0, x1, dtype=value_type)[numpy.newaxis, :]
+        distances = (rows - tile_y) ** 2 + (columns - tile_x) ** 2
+        fill = ~mask[y0:y1, x0:x1] & (tile_y >= 0) & (distances <= padding * padding)
+
+        # the sources are covered texels, no tile writes them, so the tiles do not race
+        colors = buffer.pixels[y0:y1, x0:x1]
+        colors[fill] = buffer.pixels[tile_y[fill], tile_x[fill]]
+        return int(numpy.count_nonzero(fill))
+
+    counts = run_tiles(fill_tile, tiles, workers)
+    for (x0, x1, y0, y1), count in zip(tiles, counts):
+        if count:
+            buffer.mark_dirty(x0, x1, y0, y1)
+    return sum(counts)
+
+
+def gaussian_kernel(radius):
+    """normalized weights of a 1d gaussian, that falls to about 1 / 7 at the radius"""
+
+    offsets = numpy.arange(-radius, radius + 1, dtype=numpy.float32)
+    sigma = max(radius, 1) * 0.5
+    kernel = numpy.exp(-0.5 * (offsets / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def convolve(window, kernel, start, length, axis):
+    """convolve length samples of the window from start on along the axis, samples outside the window count as 0"""
+
+    radius = len(kernel) // 2
+    size = window.shape[axis]
+    shape = list(window.shape)
+    shape[axis] = length
+    result = numpy.zeros(shape, dtype=numpy.float32)
+
+    for offset, weight in zip(range(-radius, radius + 1), kernel.tolist()):
+        first = max(start + offset, 0)
+        last = min(start + offset + length, size)
+        if first >= last:
+            continue
+        target = [slice(None)] * window.ndim
+        target[axis] = slice(first - start - offset, last - start - offset)
+        source = [slice(None)] * window.ndim
+        source[axis] = slice(first, last)
+        result[tuple(target)] += weight * window[tuple(source)]
+    return result
+
+
+def blur(buffer, components, radius, mask=None, workers=None):
+    """gaussian blur of the flow directions, the blurred vectors are normalized again
+
+    blurring unit vectors instead of colors keeps opposite directions from fading into a neutral grey
+    early. with a mask, only covered texels are blurred and only covered texels blend in
+    """
+
+    width, height = buffer.width, buffer.height
+    tiles = image_tiles(width, height)
+    kernel = gaussian_kernel(radius)
+    # weighted vectors after the horizontal pass, the last channel is the sum of the weights
+    rows_blurred = numpy.empty((height, width, components + 1), dtype=numpy.float32)
+
+    def blur_rows_tile(x0, x1, y0, y1):
+        window_x0, window_x1 = max(x0 - radius, 0), min(x1 + radius, width)
+        vectors = normalized(decode(buffer.pixels[y0:y1, window_x0:window_x1], components))
+        if mask is None:
+            weights = numpy.ones(vectors.shape[:2], dtype=numpy.float32)
+        else:
+            weights = mask[y0:y1, window_x0:window_x1].astype(numpy.float32)
+        window = numpy.concatenate((vectors * weights[..., numpy.newaxis], weights[..., numpy.newaxis]), axis=2)
+        rows_blurred[y0:y1, x0:x1] = convolve(window, kernel, x0 - window_x0, x1 - x0, axis=1)
+        return None
+
+    def blur_columns_tile(x0, x1, y0, y1):
+        window_y0, window_y1 = max(y0 - radius, 0), min(y1 + radius, height)
+        blurred = convolve(rows_blurred[window_y0:window_y1, x0:x1], kernel, y0 - window_y0, y1 - y0, axis=0)
+
+        # the sum of the weights is only needed to find texels, that got any covered neighbour
+        write = blurred[..., components] > 0
+        if mask is not None:
+            write &= mask[y0:y1, x0:x1]
+        colors = buffer.pixels[y0:y1, x0:x1, :components]
+        colors[write] = encode(normalized(blurred[..., :components]))[write]
+        return None
+
+    # the column pass reads the rows of the neighbour tiles, so it starts after the whole row pass
+    run_tiles(blur_rows_tile, tiles, workers)
+    run_tiles(blur_columns_tile, tiles, workers)
+    buffer.mark_dirty(0, width, 0, height)
+    return None
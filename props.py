@@ -32,6 +32,25 @@ class FlowmapPainterProperties(bpy.types.PropertyGroup):
         subtype='PIXEL'
     )
 
+    spacing_mode: bpy.props.EnumProperty(
+        name="spacing mode",
+        description="Is the brush spacing measured on the screen or in texels of the paint image?",
+        items=[
+            ("screen", "Screen", "spacing in screen pixels, the same at every zoom level"),
+            ("texel", "Texel", "spacing as a share of the brush radius in texels of the paint image, at least one texel, so the dot count follows the image resolution instead of the zoom"),
+        ],
+        default="screen"
+    )
+
+    texel_spacing: bpy.props.FloatProperty(
+        name="texel spacing",
+        description="How far apart are the dots, in percent of the brush radius in texels?",
+        default=25,
+        min=1,
+        max=200,
+        subtype='PERCENTAGE'
+    )
+
     trace_distance: bpy.props.FloatProperty(
         name="trace distance",
         description="How deep reaches your object into the scene?",
@@ -77,3 +96,155 @@ class FlowmapPainterProperties(bpy.types.PropertyGroup):
         description="Which object is used for the object space? Default is the active object itself.",
         type=bpy.types.Object
     )
+
+    paint_engine_items = (
+        (
+            "operator",
+            "Blender Brush",
+            "Every dot is painted by blenders own paint operator. Supports all brush features, but is slow on big images",
+            'BRUSH_DATA',
+            0,
+        ),
+        (
+            "direct",
+            "Direct Buffer",
+            "Dots are blended straight into the image pixels or color attribute. Much faster on big images and dense meshes, uses size, strength and falloff of the brush",
+            'IMAGE_DATA',
+            1,
+        ),
+    )
+
+    paint_engine: bpy.props.EnumProperty(
+        name="paint engine",
+        description="How are the dots painted into the image?",
+        items=paint_engine_items,
+        default=0
+    )
+
+    flush_interval: bpy.props.FloatProperty(
+        name="update interval",
+        description="How many seconds pass at least, bevor painted dots are written back into the image? Every write back copies the whole image, so on big images the interval is stretched, until writing back takes at most a fifth of the time. The rest is written at the end of the stroke",
+        default=0.05,
+        min=0,
+        soft_max=1,
+        subtype='TIME_ABSOLUTE',
+        unit='TIME_ABSOLUTE'
+    )
+
+    frame_budget: bpy.props.FloatProperty(
+        name="frame budget",
+        description="How many seconds may painting take per update? Under load, mouse moves are collected and the dots get spread wider, so the brush keeps up with the pen. 0 is unlimited",
+        default=1 / 60,
+        min=0,
+        soft_max=0.1,
+        subtype='TIME_ABSOLUTE',
+        unit='TIME_ABSOLUTE'
+    )
+
+    smooth_stroke: bpy.props.BoolProperty(
+        name="smooth stroke",
+        description="Should the dots follow a smooth spline through the mouse positions, instead of straight lines?",
+        default=False
+    )
+
+    record_strokes: bpy.props.BoolProperty(
+        name="record strokes",
+        description="Should the strokes of a paint session be recorded into a file, when the paint mode is left? The recording can be replayed later",
+        default=False
+    )
+
+    record_path: bpy.props.StringProperty(
+        name="record path",
+        description="Where is the stroke recording saved?",
+        default="//flowmap_strokes.npz",
+        subtype='FILE_PATH'
+    )
+
+    collect_timings: bpy.props.BoolProperty(
+        name="collect timings",
+        description="Should the time of every paint stage be measured? Shows the percentiles in the panel, costs a little performance",
+        default=False
+    )
+
+    seam_splatting: bpy.props.BoolProperty(
+        name="seam splatting",
+        description="Paint dots, that cross an uv seam, also into the uv island on the other side, with the direction turned into that island? Only for 3D painting with the Direct Buffer engine",
+        default=True
+    )
+
+    background_compositing: bpy.props.BoolProperty(
+        name="background compositing",
+        description="Blend the dots of the Direct Buffer engine on a background thread? The mouse input stays responsive while big dots are blended, the image is updated by a timer",
+        default=False
+    )
+
+    undo_memory: bpy.props.IntProperty(
+        name="undo memory",
+        description="How many megabytes may the stroke undo of the Direct Buffer engine use? The oldest strokes are dropped first, a stroke bigger than all of it can not be undone. 0 turns it off",
+        default=256,
+        min=0,
+        soft_max=4096
+    )
+
+    scratch_buffer: bpy.props.BoolProperty(
+        name="scratch buffer",
+        description="Keep the Direct Buffer working copy as half floats in a file on disk, instead of a float copy in memory? For very large flow maps, the image is read and written in bands",
+        default=False
+    )
+
+    scratch_channels: bpy.props.EnumProperty(
+        name="scratch channels",
+        description="Which channels does the scratch buffer keep? The others stay as they are in the image",
+        items=[
+            ("2", "RG", "red and green, enough for uv space flow"),
+            ("3", "RGB", "red, green and blue, for object and world space flow"),
+        ],
+        default="3"
+    )
+
+    udim_tile_cache: bpy.props.IntProperty(
+        name="udim tile cache",
+        description="How many tiles of an UDIM image may the Direct Buffer engine keep in memory during a stroke? The least recently painted tile is saved to its file and dropped first",
+        default=4,
+        min=1,
+        soft_max=32
+    )
+
+    udim_save_changes: bpy.props.BoolProperty(
+        name="save udim changes",
+        description="Direct Buffer strokes read and overwrite the tile files of an UDIM image. May a stroke save an UDIM image with unsaved changes first? Without it, such an image is not painted",
+        default=False
+    )
+
+    bake_image: bpy.props.PointerProperty(
+        name="bake image",
+        description="Which image gets the flow of the curves?",
+        type=bpy.types.Image
+    )
+
+    bake_blend_distance: bpy.props.FloatProperty(
+        name="blend distance",
+        description="Curves, that are at most this much further away than the nearest one, are blended in by distance. 0 takes only the nearest curve",
+        default=0.1,
+        min=0,
+        soft_max=10,
+        unit='LENGTH'
+    )
+
+    post_padding: bpy.props.IntProperty(
+        name="padding",
+        description="How many pixels around the uv islands get the color of the nearest island pixel, when dilating? Keeps mip maps from bleeding the background into the flow",
+        default=16,
+        min=1,
+        soft_max=64,
+        subtype='PIXEL'
+    )
+
+    post_blur_radius: bpy.props.IntProperty(
+        name="blur radius",
+        description="How many pixels reaches the blur of the flow directions?",
+        default=4,
+        min=1,
+        soft_max=32,
+        subtype='PIXEL'
+    )
@@ -0,0 +1,362 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import math
+import time
+from collections import OrderedDict
+
+import numpy
+
+from . import undo
+
+FALLOFF_SAMPLES = 256
+TILE_SIZE = 64
+# stamp cache: memory cap, sub texel positions per axis, and radius buckets,
+# linear below STAMP_LINEAR_RADIUS texels, above that in steps of about one percent
+STAMP_CACHE_BYTES = 32 * 1024 * 1024
+STAMP_SUBTEXEL_STEPS = 4
+STAMP_LINEAR_RADIUS = 16.0
+STAMP_RADIUS_STEPS = 8
+
+
+def brush_falloff(brush, samples=FALLOFF_SAMPLES):
+    """sample the brush falloff into a lookup table, indexed by the normalized distance to the dab center"""
+
+    distance = numpy.linspace(0.0, 1.0, samples, dtype=numpy.float32)
+    # same formulas as blenders brush curve presets, p is 1 at the center and 0 at the border
+    p = 1.0 - distance
+
+    preset = brush.curve_preset
+    if preset == 'CUSTOM':
+        curve = brush.curve
+        curve.initialize()
+        strength = numpy.array([curve.evaluate(curve.curves[0], d) for d in distance], dtype=numpy.float32)
+    elif preset == 'SHARP':
+        strength = p * p
+    elif preset == 'SMOOTHER':
+        strength = p * p * p * (p * (p * 6.0 - 15.0) + 10.0)
+    elif preset == 'ROOT':
+        strength = numpy.sqrt(p)
+    elif preset == 'LIN':
+        strength = p
+    elif preset == 'CONSTANT':
+        strength = numpy.ones_like(p)
+    elif preset == 'SPHERE':
+        strength = numpy.sqrt(2.0 * p - p * p)
+    elif preset == 'POW4':
+        strength = p * p * p * p
+    elif preset == 'INVSQUARE':
+        strength = p * (2.0 - p)
+    else:
+        # SMOOTH is blenders default
+        strength = 3.0 * p * p - 2.0 * p * p * p
+
+    return numpy.clip(strength, 0.0, 1.0).astype(numpy.float32)
+
+
+def falloff_mask(offset_x, offset_y, falloff):
+    """falloff of the texels at the offsets from the dab center, in units of the radius"""
+
+    distance = numpy.sqrt(offset_x[numpy.newaxis, :]**2 + offset_y[:, numpy.newaxis]**2)
+    lut_max = len(falloff) - 1
+    lut_index = numpy.minimum(distance * lut_max, lut_max).astype(numpy.intp)
+    return falloff[lut_index] * (distance < 1.0)
+
+
+def stamp_mask(radius, fraction_x, fraction_y, falloff):
+    """falloff mask of a dab, whose center lies fraction texels right of and above a texel corner
+
+    returns the mask, trimmed to its non zero texels, and its offset to the texel of the center
+    """
+
+    half = int(math.ceil(radius)) + 1
+    coords = numpy.arange(-half, half + 1, dtype=numpy.float32) + 0.5
+    mask = falloff_mask(
+        (coords - numpy.float32(fraction_x)) / numpy.float32(radius),
+        (coords - numpy.float32(fraction_y)) / numpy.float32(radius),
+        falloff
+    )
+
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    columns = numpy.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return numpy.zeros((0, 0), dtype=numpy.float32), 0, 0
+    mask = numpy.ascontiguousarray(mask[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1], dtype=numpy.float32)
+    return mask, int(columns[0]) - half, int(rows[0]) - half
+
+
+def dab_stamp(center_x, center_y, radius, falloff):
+    """exact falloff mask of a dab over its bounding box, and the texel of its lower left corner"""
+
+    x0 = int(math.floor(center_x - radius))
+    x1 = int(math.ceil(center_x + radius)) + 1
+    y0 = int(math.floor(center_y - radius))
+    y1 = int(math.ceil(center_y + radius)) + 1
+    mask = falloff_mask(
+        (numpy.arange(x0, x1, dtype=numpy.float32) + 0.5 - center_x) / radius,
+        (numpy.arange(y0, y1, dtype=numpy.float32) + 0.5 - center_y) / radius,
+        falloff
+    )
+    return mask, x0, y0
+
+
+def triangle_coverage(triangles, x0, x1, y0, y1):
+    """which texel centers of the rectangle [x0, x1) x [y0, y1) lie inside any of the triangles | triangles in texels"""
+
+    x = numpy.arange(x0, x1, dtype=numpy.float32) + 0.5
+    y = numpy.arange(y0, y1, dtype=numpy.float32) + 0.5
+    triangles = numpy.asarray(triangles, dtype=numpy.float32).reshape(-1, 3, 2)
+    covered = numpy.zeros((y1 - y0, x1 - x0), dtype=bool)
+    for corners in triangles:
+        # edge functions, with the sign of the winding, so both windings count as inside
+        winding = numpy.sign(
+            (corners[1, 0] - corners[0, 0]) * (corners[2, 1] - corners[0, 1])
+            - (corners[1, 1] - corners[0, 1]) * (corners[2, 0] - corners[0, 0])
+        )
+        if winding == 0:
+            continue
+        inside = numpy.ones_like(covered)
+        for start, end in ((corners[0], corners[1]), (corners[1], corners[2]), (corners[2], corners[0])):
+            edge = (
+                (end[0] - start[0]) * (y[:, numpy.newaxis] - start[1])
+                - (end[1] - start[1]) * (x[numpy.newaxis, :] - start[0])
+            )
+            inside &= edge * winding >= 0
+        covered |= inside
+    return covered
+
+
+class StampCache:
+    """falloff masks of dabs, keyed by radius bucket, sub texel position and falloff curve
+
+    size, pressure and falloff only take a few values in a stroke, so most dabs reuse a mask.
+    the least recently used masks are dropped, when they take more than max_bytes
+    """
+
+    def __init__(self, max_bytes=STAMP_CACHE_BYTES, subtexel_steps=STAMP_SUBTEXEL_STEPS):
+        self.max_bytes = max_bytes
+        self.subtexel_steps = subtexel_steps
+        self.stamps = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.stamps)
+
+    @staticmethod
+    def radius_bucket(radius):
+        if radius < STAMP_LINEAR_RADIUS:
+            return max(round(radius * STAMP_RADIUS_STEPS), 1) / STAMP_RADIUS_STEPS
+        steps = round(math.log2(radius / STAMP_LINEAR_RADIUS) * STAMP_RADIUS_STEPS * 8)
+        return STAMP_LINEAR_RADIUS * 2.0**(steps / (STAMP_RADIUS_STEPS * 8))
+
+    @staticmethod
+    def falloff_key(falloff):
+        """identity of a falloff curve, by its values"""
+
+        return hash(falloff.tobytes())
+
+    def stamp(self, center_x, center_y, radius, falloff, falloff_key):
+        """cached falloff mask of a dab and the texel of its lower left corner"""
+
+        steps = self.subtexel_steps
+        base_x, subtexel_x = divmod(int(round(center_x * steps)), steps)
+        base_y, subtexel_y = divmod(int(round(center_y * steps)), steps)
+        key = (self.radius_bucket(radius), subtexel_x, subtexel_y, falloff_key)
+
+        entry = self.stamps.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = stamp_mask(key[0], subtexel_x / steps, subtexel_y / steps, falloff)
+            self.stamps[key] = entry
+            self.nbytes += entry[0].nbytes
+            while self.nbytes > self.max_bytes and len(self.stamps) > 1:
+                _, (dropped, _, _) = self.stamps.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+        else:
+            self.hits += 1
+            self.stamps.move_to_end(key)
+
+        mask, offset_x, offset_y = entry
+        return mask, base_x + offset_x, base_y + offset_y
+
+
+class ImageBuffer:
+    """float32 working copy of a blender image, dabs are blended into it and it is written back, once tiles are dirty
+
+    the dirty tiles also decide, which tiles an undo step stores
+    """
+
+    def __init__(self, image, tile_size=TILE_SIZE):
+        self.image = image
+        self.width, self.height = image.size
+        self.channels = image.channels
+
+        pixels = numpy.empty(self.width * self.height * self.channels, dtype=numpy.float32)
+        image.pixels.foreach_get(pixels)
+        # blender stores the rows bottom to top, so the array is indexed [y, x, channel] like uv space
+        self.pixels = pixels.reshape(self.height, self.width, self.channels)
+        self.init_tiles(tile_size)
+
+    def init_tiles(self, tile_size):
+        self.tile_size = tile_size
+        self.dirty_tiles = numpy.zeros(
+            (math.ceil(self.height / tile_size), math.ceil(self.width / tile_size)), dtype=bool
+        )
+        self.last_flush = time.monotonic()
+        # seconds the last write back took, it costs the image size, not the painted area
+        self.flush_cost = 0.0
+
+        # tiles as they were before the stroke, only with undo tracking
+        self.undo_tiles = None
+        self.saved_tiles = None
+
+    @property
+    def dirty(self):
+        return bool(self.dirty_tiles.any())
+
+    def mark_dirty(self, x0, x1, y0, y1):
+        """flag every tile, that overlaps the texel rectangle [x0, x1) x [y0, y1)"""
+
+        tile_size = self.tile_size
+        self.dirty_tiles[y0 // tile_size:(y1 - 1) // tile_size + 1, x0 // tile_size:(x1 - 1) // tile_size + 1] = True
+        return None
+
+    def track_undo(self):
+        """from now on, every tile is stored before it is painted the first time"""
+
+        self.undo_tiles = undo.TileSnapshot()
+        self.saved_tiles = numpy.zeros_like(self.dirty_tiles)
+        return None
+
+    def save_tiles(self, x0, x1, y0, y1):
+        """store the tiles overlapping the texel rectangle, that were not stored yet"""
+
+        tile_size = self.tile_size
+        tile_y0 = y0 // tile_size
+        tile_x0 = x0 // tile_size
+        saved = self.saved_tiles[tile_y0:(y1 - 1) // tile_size + 1, tile_x0:(x1 - 1) // tile_size + 1]
+        if saved.all():
+            return None
+
+        for tile_y, tile_x in zip(*numpy.nonzero(~saved)):
+            tile_y += tile_y0
+            tile_x += tile_x0
+            self.undo_tiles.store(
+                (int(tile_y), int(tile_x)),
+                self.pixels[tile_y * tile_size:(tile_y + 1) * tile_size, tile_x * tile_size:(tile_x + 1) * tile_size]
+            )
+        saved[:] = True
+        return None
+
+    def swap_tiles(self, snapshot):
+        """write the tiles of the snapshot into the buffer | returns a snapshot of the tiles they replaced"""
+
+        tile_size = self.tile_size
+        replaced = undo.TileSnapshot()
+        for (tile_y, tile_x), tile in snapshot.items():
+            y0 = tile_y * tile_size
+            x0 = tile_x * tile_size
+            window = self.pixels[y0:y0 + tile.shape[0], x0:x0 + tile.shape[1]]
+            replaced.store((tile_y, tile_x), window)
+            window[...] = tile
+            self.mark_dirty(x0, x0 + tile.shape[1], y0, y0 + tile.shape[0])
+        return replaced
+
+    def uv_to_texel(self, uvs):
+        """convert uv coordinates into continuous texel coordinates"""
+
+        return numpy.asarray(uvs, dtype=numpy.float32)[:, :2] * numpy.array([self.width, self.height], dtype=numpy.float32)
+
+    def paint_dabs_uv(self, uvs, radii, colors, strengths, falloff, stamps=None, clips=None):
+        """paint_dabs with centers in uv coordinates and radii in uv units of the image width, clips in uv too"""
+
+        radii = numpy.asarray(radii, dtype=numpy.float32) * self.width
+        if clips is not None:
+            scale = numpy.array([self.width, self.height], dtype=numpy.float32)
+            clips = [None if clip is None else numpy.asarray(clip, dtype=numpy.float32) * scale for clip in clips]
+        return self.paint_dabs(self.uv_to_texel(uvs), radii, colors, strengths, falloff, stamps=stamps, clips=clips)
+
+    def paint_dabs(self, centers, radii, colors, strengths, falloff, stamps=None, clips=None):
+        """blend round dabs into the buffer | centers and radii are in texels, dabs are applied in order
+
+        with a StampCache, the falloff masks are snapped to its radius buckets and sub texel positions and reused.
+        clips are optional per dab triangles in texels, a dab with clip triangles only paints inside them
+        """
+
+        color_channels = min(self.channels, 3)
+        falloff_key = StampCache.falloff_key(falloff) if stamps is not None else None
+        if clips is None:
+            clips = [None] * len(radii)
+
+        for (center_x, center_y), radius, color, strength, clip in zip(centers, radii, colors, strengths, clips):
+            if radius <= 0 or strength <= 0:
+                continue
+
+            if stamps is not None:
+                mask, mask_x0, mask_y0 = stamps.stamp(center_x, center_y, radius, falloff, falloff_key)
+            else:
+                mask, mask_x0, mask_y0 = dab_stamp(center_x, center_y, radius, falloff)
+
+            # bounding box of the dab, clipped to the image
+            x0 = max(mask_x0, 0)
+            x1 = min(mask_x0 + mask.shape[1], self.width)
+            y0 = max(mask_y0, 0)
+            y1 = min(mask_y0 + mask.shape[0], self.height)
+            if x0 >= x1 or y0 >= y1:
+                continue
+
+            alpha = mask[y0 - mask_y0:y1 - mask_y0, x0 - mask_x0:x1 - mask_x0] * numpy.float32(strength)
+            if clip is not None:
+                alpha *= triangle_coverage(clip, x0, x1, y0, y1)
+
+            if self.undo_tiles is not None:
+                self.save_tiles(x0, x1, y0, y1)
+
+            window = self.pixels[y0:y1, x0:x1, :color_channels]
+            dab_color = numpy.asarray(color[:color_channels], dtype=numpy.float32)
+            window += (dab_color - window) * alpha[:, :, numpy.newaxis]
+
+            self.mark_dirty(x0, x1, y0, y1)
+
+        return None
+
+    def flush(self, interval=None):
+        """write the whole buffer back into the blender image, if any tile is dirty
+
+        during a stroke, writes are skipped until the interval has passed, without an interval the write is forced
+        """
+
+        now = time.monotonic()
+        if interval is not None and now - self.last_flush < interval:
+            return False
+
+        if not self.dirty_tiles.any():
+            return False
+
+        # a slice assignment of image.pixels round trips the whole rna array and a python list of the slice,
+        # so one foreach_set of the whole buffer is the cheapest write, see funcs.get_flush_interval
+        start = time.perf_counter()
+        self.image.pixels.foreach_set(self.pixels.ravel())
+        self.image.update()
+        self.flush_cost = time.perf_counter() - start
+        self.dirty_tiles[:] = False
+        self.last_flush = now
+        return True
@@ -0,0 +1,348 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import time
+
+import numpy
+import mathutils
+
+FORMAT_VERSION = 1
+
+# event kinds | a point is a mouse position, a tick is where the modal resampled and painted the collected points
+KIND_POINT = 0
+KIND_TICK = 1
+# dab limit of a tick without frame budget
+NO_DAB_LIMIT = -1
+
+SPACE_TYPES = ("uv_space", "object_space", "world_space")
+SPACING_MODES = ("screen", "texel")
+
+
+class StrokeRecorder:
+    """collects the raw events of every stroke in a paint session, saved as struct of arrays into a npz file
+
+    a stroke keeps the view and the brush settings of its start, so it can be replayed without the ui
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.start_time = time.monotonic()
+        self.recording = False
+        self.object_name = ""
+        self.image_name = ""
+
+        # one entry per event
+        self.kinds = []
+        self.positions = []
+        self.pressures = []
+        self.times = []
+        self.dab_limits = []
+
+        # one entry per stroke
+        self.strokes = {
+            "stroke_start": [],
+            "stroke_end": [],
+            "stroke_anchor": [],
+            "stroke_anchor_pressure": [],
+            "stroke_lead_in": [],
+            "stroke_size": [],
+            "stroke_strength": [],
+            "stroke_spacing": [],
+            "stroke_smooth": [],
+            "stroke_spacing_mode": [],
+            "stroke_texel_spacing": [],
+            "stroke_space_type": [],
+            "stroke_area": [],
+            "stroke_region": [],
+            "stroke_view2d": [],
+            "stroke_perspective_matrix": [],
+            "stroke_view_matrix": [],
+            "stroke_is_perspective": [],
+            "stroke_is_camera": [],
+        }
+
+    @property
+    def stroke_count(self):
+        return len(self.strokes["stroke_start"])
+
+    def begin_stroke(self, context, region, stroke_input, image=None):
+        """start a stroke | stores where the stroke input starts, the view and the brush settings"""
+
+        props = context.scene.flowmap_painter_props
+        unified_paint_settings = context.scene.tool_settings.unified_paint_settings
+        strokes = self.strokes
+
+        if context.active_object is not None:
+            self.object_name = context.active_object.name
+        if image is not None:
+            self.image_name = image.name
+
+        strokes["stroke_start"].append(len(self.kinds))
+        strokes["stroke_end"].append(len(self.kinds))
+        strokes["stroke_anchor"].append(stroke_input.anchor)
+        strokes["stroke_anchor_pressure"].append(stroke_input.anchor_pressure)
+        strokes["stroke_lead_in"].append(stroke_input.lead_in if stroke_input.lead_in is not None else (numpy.nan, numpy.nan))
+        strokes["stroke_size"].append(unified_paint_settings.size)
+        strokes["stroke_strength"].append(unified_paint_settings.strength)
+        strokes["stroke_spacing"].append(props.brush_spacing)
+        strokes["stroke_smooth"].append(props.smooth_stroke)
+        strokes["stroke_spacing_mode"].append(SPACING_MODES.index(props.spacing_mode))
+        strokes["stroke_texel_spacing"].append(props.texel_spacing)
+        strokes["stroke_space_type"].append(SPACE_TYPES.index(props.space_type))
+        strokes["stroke_area"].append((context.area.x, context.area.y))
+        strokes["stroke_region"].append((region.x, region.y, region.width, region.height))
+
+        # the image editor view is a scale and offset from region to uv space
+        view2d = (0.0, 0.0, 0.0, 0.0)
+        if self.mode == '2D_PAINT':
+            origin = region.view2d.region_to_view(0, 0)
+            corner = region.view2d.region_to_view(region.width, region.height)
+            view2d = (
+                origin[0],
+                origin[1],
+                (corner[0] - origin[0]) / max(region.width, 1),
+                (corner[1] - origin[1]) / max(region.height, 1),
+            )
+        strokes["stroke_view2d"].append(view2d)
+
+        rv3d = context.region_data if self.mode != '2D_PAINT' else None
+        if rv3d is not None:
+            strokes["stroke_perspective_matrix"].append(numpy.array(rv3d.perspective_matrix, dtype=numpy.float64))
+            strokes["stroke_view_matrix"].append(numpy.array(rv3d.view_matrix, dtype=numpy.float64))
+            strokes["stroke_is_perspective"].append(rv3d.is_perspective)
+            strokes["stroke_is_camera"].append(rv3d.view_perspective == 'CAMERA')
+        else:
+            strokes["stroke_perspective_matrix"].append(numpy.identity(4))
+            strokes["stroke_view_matrix"].append(numpy.identity(4))
+            strokes["stroke_is_perspective"].append(False)
+            strokes["stroke_is_camera"].append(False)
+
+        self.recording = True
+        return None
+
+    def add_point(self, position, pressure):
+        if not self.recording:
+            return None
+        self.kinds.append(KIND_POINT)
+        self.positions.append((position[0], position[1]))
+        self.pressures.append(pressure)
+        self.times.append(time.monotonic() - self.start_time)
+        self.dab_limits.append(NO_DAB_LIMIT)
+        return None
+
+    def add_tick(self, dab_limit):
+        if not self.recording:
+            return None
+        self.kinds.append(KIND_TICK)
+        self.positions.append((numpy.nan, numpy.nan))
+        self.pressures.append(numpy.nan)
+        self.times.append(time.monotonic() - self.start_time)
+        self.dab_limits.append(NO_DAB_LIMIT if dab_limit is None else dab_limit)
+        return None
+
+    def end_stroke(self):
+        if not self.recording:
+            return None
+        self.strokes["stroke_end"][-1] = len(self.kinds)
+        self.recording = False
+        return None
+
+    def save(self, filepath):
+        """write all finished strokes into a compressed npz file"""
+
+        self.end_stroke()
+        strokes = self.strokes
+        numpy.savez_compressed(
+            filepath,
+            version=numpy.array(FORMAT_VERSION),
+            mode=numpy.array(self.mode),
+            object_name=numpy.array(self.object_name),
+            image_name=numpy.array(self.image_name),
+            kind=numpy.array(self.kinds, dtype=numpy.uint8),
+            position=numpy.array(self.positions, dtype=numpy.float32).reshape(-1, 2),
+            pressure=numpy.array(self.pressures, dtype=numpy.float32),
+            time=numpy.array(self.times, dtype=numpy.float64),
+            dab_limit=numpy.array(self.dab_limits, dtype=numpy.int32),
+            stroke_start=numpy.array(strokes["stroke_start"], dtype=numpy.int64),
+            stroke_end=numpy.array(strokes["stroke_end"], dtype=numpy.int64),
+            stroke_anchor=numpy.array(strokes["stroke_anchor"], dtype=numpy.float64).reshape(-1, 2),
+            stroke_anchor_pressure=numpy.array(strokes["stroke_anchor_pressure"], dtype=numpy.float32),
+            stroke_lead_in=numpy.array(strokes["stroke_lead_in"], dtype=numpy.float64).reshape(-1, 2),
+            stroke_size=numpy.array(strokes["stroke_size"], dtype=numpy.float32),
+            stroke_strength=numpy.array(strokes["stroke_strength"], dtype=numpy.float32),
+            stroke_spacing=numpy.array(strokes["stroke_spacing"], dtype=numpy.float32),
+            stroke_smooth=numpy.array(strokes["stroke_smooth"], dtype=bool),
+            stroke_spacing_mode=numpy.array(strokes["stroke_spacing_mode"], dtype=numpy.int8),
+            stroke_texel_spacing=numpy.array(strokes["stroke_texel_spacing"], dtype=numpy.float32),
+            stroke_space_type=numpy.array(strokes["stroke_space_type"], dtype=numpy.uint8),
+            stroke_area=numpy.array(strokes["stroke_area"], dtype=numpy.int32).reshape(-1, 2),
+            stroke_region=numpy.array(strokes["stroke_region"], dtype=numpy.int32).reshape(-1, 4),
+            stroke_view2d=numpy.array(strokes["stroke_view2d"], dtype=numpy.float64).reshape(-1, 4),
+            stroke_perspective_matrix=numpy.array(strokes["stroke_perspective_matrix"], dtype=numpy.float64).reshape(-1, 4, 4),
+            stroke_view_matrix=numpy.array(strokes["stroke_view_matrix"], dtype=numpy.float64).reshape(-1, 4, 4),
+            stroke_is_perspective=numpy.array(strokes["stroke_is_perspective"], dtype=bool),
+            stroke_is_camera=numpy.array(strokes["stroke_is_camera"], dtype=bool),
+        )
+        return None
+
+
+class RecordedView2D:
+    """stand-in for the image editor view2d, maps region coordinates to uv space"""
+
+    def __init__(self, origin, scale):
+        self.origin = origin
+        self.scale = scale
+
+    def region_to_view(self, x, y):
+        return (self.origin[0] + x * self.scale[0], self.origin[1] + y * self.scale[1])
+
+
+class RecordedRegion:
+    """stand-in for the window region of a recorded stroke"""
+
+    def __init__(self, x, y, width, height, view2d=None):
+        self.type = 'WINDOW'
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.view2d = view2d
+
+
+class RecordedRegionView3D:
+    """stand-in for the 3D view of a recorded stroke, enough for view3d_utils and the batch trace"""
+
+    def __init__(self, perspective_matrix, view_matrix, is_perspective, is_camera):
+        self.perspective_matrix = perspective_matrix
+        self.view_matrix = view_matrix
+        self.is_perspective = is_perspective
+        self.view_perspective = 'CAMERA' if is_camera else ('PERSP' if is_perspective else 'ORTHO')
+
+
+class RecordedArea:
+    def __init__(self, type, x, y, regions):
+        self.type = type
+        self.x = x
+        self.y = y
+        self.regions = regions
+
+
+class RecordedSpace:
+    def __init__(self, image):
+        self.image = image
+
+
+class ReplayContext:
+    """the parts of the modal context, that the paint functions read, rebuilt from a recorded stroke"""
+
+    def __init__(self, scene, area, region, region_data, space_data):
+        self.scene = scene
+        self.area = area
+        self.region = region
+        self.region_data = region_data
+        self.space_data = space_data
+
+
+class StrokeRecording:
+    """a loaded stroke recording | events and strokes stay numpy arrays"""
+
+    def __init__(self, filepath):
+        with numpy.load(filepath, allow_pickle=False) as data:
+            self.data = {key: data[key] for key in data.files}
+
+        if int(self.data["version"]) != FORMAT_VERSION:
+            raise ValueError("unsupported stroke recording version %d" % int(self.data["version"]))
+
+        self.mode = str(self.data["mode"])
+        self.object_name = str(self.data["object_name"])
+        self.image_name = str(self.data["image_name"])
+
+    @property
+    def stroke_count(self):
+        return len(self.data["stroke_start"])
+
+    def stroke_settings(self, index):
+        """spacing, smoothing, space type, size and strength of the stroke"""
+
+        data = self.data
+        # recordings from before texel spacing always used screen spacing
+        spacing_mode = "screen"
+        texel_spacing = 25.0
+        if "stroke_spacing_mode" in data:
+            spacing_mode = SPACING_MODES[int(data["stroke_spacing_mode"][index])]
+            texel_spacing = float(data["stroke_texel_spacing"][index])
+        return {
+            "brush_spacing": float(data["stroke_spacing"][index]),
+            "spacing_mode": spacing_mode,
+            "texel_spacing": texel_spacing,
+            "smooth_stroke": bool(data["stroke_smooth"][index]),
+            "space_type": SPACE_TYPES[int(data["stroke_space_type"][index])],
+            "size": int(round(float(data["stroke_size"][index]))),
+            "strength": float(data["stroke_strength"][index]),
+        }
+
+    def stroke_anchor(self, index):
+        """anchor, anchor pressure and lead in, that the stroke input had at the start of the stroke"""
+
+        data = self.data
+        lead_in = data["stroke_lead_in"][index]
+        if numpy.isnan(lead_in).any():
+            lead_in = None
+        else:
+            lead_in = (float(lead_in[0]), float(lead_in[1]))
+        anchor = data["stroke_anchor"][index]
+        return (float(anchor[0]), float(anchor[1])), float(data["stroke_anchor_pressure"][index]), lead_in
+
+    def stroke_context(self, index, scene, image=None):
+        """rebuild the view of the stroke, so the paint functions can run without the ui"""
+
+        data = self.data
+        region_x, region_y, width, height = (int(value) for value in data["stroke_region"][index])
+        area_x, area_y = (int(value) for value in data["stroke_area"][index])
+
+        if self.mode == '2D_PAINT':
+            view2d = data["stroke_view2d"][index]
+            region = RecordedRegion(
+                region_x, region_y, width, height, view2d=RecordedView2D(origin=view2d[:2], scale=view2d[2:])
+            )
+            area = RecordedArea('IMAGE_EDITOR', area_x, area_y, [region])
+            return ReplayContext(scene, area, region, None, RecordedSpace(image))
+
+        region = RecordedRegion(region_x, region_y, width, height)
+        region_data = RecordedRegionView3D(
+            perspective_matrix=mathutils.Matrix(data["stroke_perspective_matrix"][index].tolist()),
+            view_matrix=mathutils.Matrix(data["stroke_view_matrix"][index].tolist()),
+            is_perspective=bool(data["stroke_is_perspective"][index]),
+            is_camera=bool(data["stroke_is_camera"][index]),
+        )
+        area = RecordedArea('VIEW_3D', area_x, area_y, [region])
+        return ReplayContext(scene, area, region, region_data, None)
+
+    def stroke_events(self, index):
+        """kinds, positions, pressures and dab limits of the events of the stroke"""
+
+        data = self.data
+        start = int(data["stroke_start"][index])
+        end = int(data["stroke_end"][index])
+        return (
+            data["kind"][start:end],
+            data["position"][start:end],
+            data["pressure"][start:end],
+            data["dab_limit"][start:end],
+        )
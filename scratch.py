@@ -0,0 +1,105 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import os
+import tempfile
+
+import numpy
+
+from . import raster
+
+# pixel values per band, that is converted between the float32 copy and the scratch file at once
+CONVERT_BAND_VALUES = 1 << 22
+
+
+class ScratchBuffer(raster.ImageBuffer):
+    """half float working copy of a blender image with only two or three channels, in a memory mapped file
+
+    reading and writing back go through one float32 copy of the whole image, the rna array only supports
+    foreach_get and foreach_set without round tripping it. the copy only lives during the read or write,
+    while painting only the scratch file is held. so the image is only written back, when the stroke ends,
+    and the channels, that the scratch file does not keep, are read again then and written back unchanged
+    """
+
+    def __init__(self, image, channels, directory=None, tile_size=raster.TILE_SIZE):
+        self.image = image
+        self.width, self.height = image.size
+        self.channels = channels
+        self.image_channels = image.channels
+
+        handle, self.filepath = tempfile.mkstemp(prefix="flowmap_", suffix=".scratch", dir=directory or None)
+        os.close(handle)
+        self.pixels = numpy.memmap(
+            self.filepath, dtype=numpy.float16, mode="w+", shape=(self.height, self.width, self.channels)
+        )
+        self.init_tiles(tile_size)
+        self.read_image()
+
+    def band_rows(self):
+        """rows per conversion band"""
+
+        return max(CONVERT_BAND_VALUES // (self.width * self.image_channels), 1)
+
+    def read_image(self):
+        """read the image with one foreach_get and convert it into the scratch file, band by band"""
+
+        image_pixels = numpy.empty(self.width * self.height * self.image_channels, dtype=numpy.float32)
+        self.image.pixels.foreach_get(image_pixels)
+        image_pixels = image_pixels.reshape(self.height, self.width, self.image_channels)
+
+        channels = min(self.channels, self.image_channels)
+        band_rows = self.band_rows()
+        for y0 in range(0, self.height, band_rows):
+            y1 = min(y0 + band_rows, self.height)
+            self.pixels[y0:y1, :, :channels] = image_pixels[y0:y1, :, :channels]
+            self.pixels[y0:y1, :, channels:] = 0
+        return None
+
+    def flush(self, interval=None):
+        """write the scratch file back into the blender image, if any tile is dirty | only forced writes, not during a stroke
+
+        the image is read with foreach_get, only the kept channels are replaced and it is written with foreach_set
+        """
+
+        if interval is not None or not self.dirty_tiles.any():
+            return False
+
+        image_pixels = numpy.empty(self.width * self.height * self.image_channels, dtype=numpy.float32)
+        self.image.pixels.foreach_get(image_pixels)
+        image_pixels = image_pixels.reshape(self.height, self.width, self.image_channels)
+
+        channels = min(self.channels, self.image_channels)
+        band_rows = self.band_rows()
+        for y0 in range(0, self.height, band_rows):
+            y1 = min(y0 + band_rows, self.height)
+            image_pixels[y0:y1, :, :channels] = self.pixels[y0:y1, :, :channels]
+
+        self.image.pixels.foreach_set(image_pixels.ravel())
+        self.image.update()
+        self.dirty_tiles[:] = False
+        return True
+
+    def close(self):
+        """drop the scratch file, the blender image keeps everything, that was flushed"""
+
+        self.flush()
+        # the memory map closes with its last reference, the file can only be removed after that
+        self.pixels = None
+        os.remove(self.filepath)
+        return None
@@ -0,0 +1,190 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import numpy
+
+# uv distance, below which the corners of two triangles count as the same uv vertex
+SEAM_EPSILON = 1e-6
+# most triangles of the other island, that a dab copied across a seam is clipped to
+MAX_CLIP_TRIANGLES = 64
+
+
+class SeamIndex:
+    """uv seam edges of every triangle, with the map from its uv island into the island across the seam
+
+    edge k of a triangle runs from corner k to corner k + 1. across a seam, the neighbour island is mapped
+    with the similarity transform, that lays the shared edge of both islands onto each other.
+    the edges inside an island link its triangles, so the dabs copied across can be clipped to the island
+    """
+
+    def __init__(self, snapshot):
+        triangles = snapshot.triangles.astype(numpy.int64)
+        uvs = snapshot.triangle_uvs.astype(numpy.float64)
+        triangle_count = len(triangles)
+
+        # every triangle edge, keyed by its two mesh vertices
+        starts = triangles
+        ends = numpy.roll(triangles, -1, axis=1)
+        vertex_count = int(triangles.max()) + 1 if triangle_count else 0
+        keys = (numpy.minimum(starts, ends) * vertex_count + numpy.maximum(starts, ends)).ravel()
+
+        # manifold edges are shared by exactly two triangles
+        order = numpy.argsort(keys, kind='stable')
+        _, first, counts = numpy.unique(keys[order], return_index=True, return_counts=True)
+        pairs = first[counts == 2]
+        edges_a = order[pairs]
+        edges_b = order[pairs + 1]
+
+        uv_starts = uvs.reshape(-1, 2)
+        uv_ends = numpy.roll(uvs, -1, axis=1).reshape(-1, 2)
+        b_starts, b_ends = self.matching_ends(edges_a, edges_b, starts, uv_starts, uv_ends)
+
+        seam = (
+            (numpy.abs(uv_starts[edges_a] - b_starts).max(axis=1) > SEAM_EPSILON)
+            | (numpy.abs(uv_ends[edges_a] - b_ends).max(axis=1) > SEAM_EPSILON)
+        )
+        # per triangle and edge, the triangle of the same island across the edge, -1 at seams and borders
+        self.island_neighbours = numpy.full(triangle_count * 3, -1, dtype=numpy.int64)
+        self.island_neighbours[edges_a[~seam]] = edges_b[~seam] // 3
+        self.island_neighbours[edges_b[~seam]] = edges_a[~seam] // 3
+        self.triangle_uvs = uvs
+
+        edges_a = edges_a[seam]
+        edges_b = edges_b[seam]
+        b_starts = b_starts[seam]
+        b_ends = b_ends[seam]
+
+        # per triangle and edge, -1 where the edge is no seam
+        self.neighbours = numpy.full(triangle_count * 3, -1, dtype=numpy.int64)
+        self.edge_starts = uv_starts
+        self.edge_vectors = uv_ends - uv_starts
+        lengths_squared = numpy.einsum('ij,ij->i', self.edge_vectors, self.edge_vectors)
+        self.inv_lengths_squared = numpy.divide(
+            1.0, lengths_squared, out=numpy.zeros_like(lengths_squared), where=lengths_squared > 0
+        )
+        self.linear = numpy.zeros((triangle_count * 3, 2, 2))
+        self.offsets = numpy.zeros((triangle_count * 3, 2))
+        self.scales = numpy.zeros(triangle_count * 3)
+
+        # the seam is stored for both sides
+        areas = uv_areas(uvs)
+        for edges_from, edges_to, to_starts, to_ends in (
+            (edges_a, edges_b, b_starts, b_ends),
+            (edges_b, edges_a, *self.matching_ends(edges_b, edges_a, starts, uv_starts, uv_ends)),
+        ):
+            mirrored = numpy.sign(areas[edges_from // 3]) != numpy.sign(areas[edges_to // 3])
+            linear, offsets = edge_similarities(uv_starts[edges_from], uv_ends[edges_from], to_starts, to_ends, mirrored)
+            self.neighbours[edges_from] = edges_to // 3
+            self.linear[edges_from] = linear
+            self.offsets[edges_from] = offsets
+            self.scales[edges_from] = numpy.sqrt(numpy.abs(numpy.linalg.det(linear)))
+
+    @staticmethod
+    def matching_ends(edges_from, edges_to, starts, uv_starts, uv_ends):
+        """uvs of the shared edge in the to triangles, in the direction of the from triangles
+
+        with consistent winding, both triangles run along the shared edge in opposite directions
+        """
+
+        same_direction = (starts.ravel()[edges_from] == starts.ravel()[edges_to])[:, numpy.newaxis]
+        to_starts = numpy.where(same_direction, uv_starts[edges_to], uv_ends[edges_to])
+        to_ends = numpy.where(same_direction, uv_ends[edges_to], uv_starts[edges_to])
+        return to_starts, to_ends
+
+    def crossings(self, face_indices, uvs, radii):
+        """dabs, whose circle crosses a seam edge of their triangle, mapped into the island across
+
+        returns the indices of the crossing dabs, their uvs and radii in the other island, the linear maps
+        and per mapped dab the uv triangles of the other island, that it has to be clipped to
+        """
+
+        face_indices = numpy.asarray(face_indices, dtype=numpy.int64)
+        uvs = numpy.asarray(uvs, dtype=numpy.float64).reshape(-1, 2)
+        radii = numpy.asarray(radii, dtype=numpy.float64)
+
+        # the three edges of every dab triangle, a constant amount of work per dab
+        edges = face_indices[:, numpy.newaxis] * 3 + numpy.arange(3)
+        is_seam = self.neighbours[edges] >= 0
+
+        offsets = uvs[:, numpy.newaxis] - self.edge_starts[edges]
+        t = numpy.clip(numpy.einsum('nkj,nkj->nk', offsets, self.edge_vectors[edges]) * self.inv_lengths_squared[edges], 0, 1)
+        distances = numpy.linalg.norm(offsets - self.edge_vectors[edges] * t[:, :, numpy.newaxis], axis=2)
+        crossing = is_seam & (distances < radii[:, numpy.newaxis])
+
+        dab_indices, edge_numbers = numpy.nonzero(crossing)
+        crossed = edges[dab_indices, edge_numbers]
+        linear = self.linear[crossed]
+        mapped_uvs = numpy.einsum('nij,nj->ni', linear, uvs[dab_indices]) + self.offsets[crossed]
+        mapped_radii = radii[dab_indices] * self.scales[crossed]
+        clips = [
+            self.island_triangles(triangle, center, radius)
+            for triangle, center, radius in zip(self.neighbours[crossed].tolist(), mapped_uvs, mapped_radii.tolist())
+        ]
+        return dab_indices, mapped_uvs, mapped_radii, linear, clips
+
+    def island_triangles(self, triangle, center, radius):
+        """uvs of the triangles of the island, that the circle may overlap, walking the island from the triangle
+
+        at most MAX_CLIP_TRIANGLES, only dabs near a seam are clipped, so the walk stays short
+        """
+
+        found = [triangle]
+        seen = {triangle}
+        index = 0
+        while index < len(found) and len(found) < MAX_CLIP_TRIANGLES:
+            for neighbour in self.island_neighbours[found[index] * 3:found[index] * 3 + 3].tolist():
+                if neighbour < 0 or neighbour in seen:
+                    continue
+                seen.add(neighbour)
+                corners = self.triangle_uvs[neighbour]
+                if (corners.min(axis=0) <= center + radius).all() and (corners.max(axis=0) >= center - radius).all():
+                    found.append(neighbour)
+            index += 1
+        return self.triangle_uvs[found[:MAX_CLIP_TRIANGLES]]
+
+
+def uv_areas(uvs):
+    """signed uv area of every triangle, the sign is the winding of the island"""
+
+    edges_a = uvs[:, 1] - uvs[:, 0]
+    edges_b = uvs[:, 2] - uvs[:, 0]
+    return 0.5 * (edges_a[:, 0] * edges_b[:, 1] - edges_a[:, 1] * edges_b[:, 0])
+
+
+def edge_similarities(from_starts, from_ends, to_starts, to_ends, mirrored):
+    """linear maps and offsets of the similarity transforms, that lay the from edges onto the to edges
+
+    as complex numbers z -> a * z + b, mirrored islands use the conjugate of z
+    """
+
+    from_vectors = from_ends - from_starts
+    to_vectors = to_ends - to_starts
+    from_complex = from_vectors[:, 0] + 1j * from_vectors[:, 1]
+    from_complex = numpy.where(mirrored, numpy.conj(from_complex), from_complex)
+    to_complex = to_vectors[:, 0] + 1j * to_vectors[:, 1]
+    a = numpy.divide(to_complex, from_complex, out=numpy.zeros_like(to_complex), where=from_complex != 0)
+
+    sign = numpy.where(mirrored, -1.0, 1.0)
+    linear = numpy.empty((len(a), 2, 2))
+    linear[:, 0, 0] = a.real
+    linear[:, 0, 1] = -a.imag * sign
+    linear[:, 1, 0] = a.imag
+    linear[:, 1, 1] = a.real * sign
+    offsets = to_starts - numpy.einsum('nij,nj->ni', linear, from_starts)
+    return linear, offsets
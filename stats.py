@@ -0,0 +1,142 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import csv
+import functools
+import json
+import threading
+import time
+
+import numpy
+
+from . import vars
+
+# durations kept per stage, the percentiles are taken over this rolling window
+WINDOW_SIZE = 1024
+PERCENTILES = (50, 95, 99)
+
+
+class StageTimings:
+    """rolling window of the durations of every paint stage in one paint session
+
+    the dab worker adds its stages from its own thread, the lock keeps the windows consistent
+    """
+
+    def __init__(self, mode, window_size=WINDOW_SIZE):
+        self.mode = mode
+        self.window_size = window_size
+        self.windows = {}
+        self.counts = {}
+        self.totals = {}
+        self.lock = threading.RLock()
+
+    def add(self, stage, duration):
+        with self.lock:
+            window = self.windows.get(stage)
+            if window is None:
+                window = self.windows[stage] = numpy.zeros(self.window_size, dtype=numpy.float64)
+                self.counts[stage] = 0
+                self.totals[stage] = 0.0
+
+            window[self.counts[stage] % self.window_size] = duration
+            self.counts[stage] += 1
+            self.totals[stage] += duration
+        return None
+
+    def samples(self, stage):
+        """durations in the window, oldest first"""
+
+        with self.lock:
+            count = self.counts[stage]
+            window = self.windows[stage]
+            if count <= self.window_size:
+                return window[:count].copy()
+            start = count % self.window_size
+            return numpy.concatenate((window[start:], window[:start]))
+
+    def summary(self):
+        """count, total, p50, p95, p99 and max in seconds for every stage, in the order they first ran"""
+
+        with self.lock:
+            stages = [(stage, self.samples(stage), self.counts[stage], self.totals[stage]) for stage in self.windows]
+
+        rows = []
+        for stage, samples, count, total in stages:
+            p50, p95, p99 = numpy.percentile(samples, PERCENTILES)
+            rows.append({
+                "stage": stage,
+                "count": count,
+                "total": total,
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "max": float(samples.max()),
+            })
+        return rows
+
+    def export_json(self, filepath):
+        """summary and the durations of the rolling window, in seconds"""
+
+        stages = []
+        for row in self.summary():
+            row["samples"] = self.samples(row["stage"]).tolist()
+            stages.append(row)
+        with open(filepath, "w") as file:
+            json.dump({"mode": self.mode, "window_size": self.window_size, "stages": stages}, file, indent=2)
+        return None
+
+    def export_csv(self, filepath):
+        """one row per stage, in milliseconds"""
+
+        with open(filepath, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(("stage", "count", "total_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"))
+            for row in self.summary():
+                writer.writerow((
+                    row["stage"],
+                    row["count"],
+                    "%.4f" % (row["total"] * 1000),
+                    "%.4f" % (row["p50"] * 1000),
+                    "%.4f" % (row["p95"] * 1000),
+                    "%.4f" % (row["p99"] * 1000),
+                    "%.4f" % (row["max"] * 1000),
+                ))
+        return None
+
+
+def timed(stage):
+    """decorator, that adds the duration of every call to the stage | without a timing session, it is a plain call"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            timings = vars.stage_timings
+            if timings is None:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings.add(stage, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
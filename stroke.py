@@ -0,0 +1,187 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import time
+
+import numpy
+
+# how often the modal gets a timer event, to paint moves that were held back
+TICK_INTERVAL = 0.01
+# weight of the newest measurement in the moving average of the dab cost
+DAB_COST_SMOOTHING = 0.2
+# spline samples per input segment, when the stroke is smoothed
+SPLINE_SUBDIVISIONS = 8
+
+
+def catmull_rom(points, pressures, lead_in=None, subdivisions=SPLINE_SUBDIVISIONS):
+    """sample a uniform catmull rom spline through the points, pressures are interpolated along"""
+
+    count = len(points)
+    first = points[0] * 2 - points[1] if lead_in is None else numpy.asarray(lead_in, dtype=numpy.float64)
+    last = points[-1] * 2 - points[-2]
+    controls = numpy.concatenate((first[numpy.newaxis], points, last[numpy.newaxis]))
+
+    # control points of every segment, shape (segments, 1, 2)
+    p0 = controls[:-3, numpy.newaxis]
+    p1 = controls[1:-2, numpy.newaxis]
+    p2 = controls[2:-1, numpy.newaxis]
+    p3 = controls[3:, numpy.newaxis]
+
+    t = (numpy.arange(subdivisions) / subdivisions)[numpy.newaxis, :, numpy.newaxis]
+    curve = 0.5 * (
+        2 * p1 + (p2 - p0) * t + (2 * p0 - 5 * p1 + 4 * p2 - p3) * t**2 + (3 * p1 - p0 - 3 * p2 + p3) * t**3
+    )
+    curve = numpy.concatenate((curve.reshape(-1, 2), points[-1:]))
+
+    parameters = numpy.concatenate(((numpy.arange(count - 1)[:, numpy.newaxis] + t[0, :, 0]).ravel(), [count - 1]))
+    return curve, numpy.interp(parameters, numpy.arange(count), pressures)
+
+
+def resample_stroke(points, pressures, spacing, max_count=None, smooth=False, lead_in=None):
+    """evenly spaced dab positions, unit tangents and pressures along the stroke, all in one call
+
+    the points start at the last painted position and the last dab lands on the last point.
+    returns empty arrays, if the stroke is shorter than spacing. with smooth, the points are
+    treated as a catmull rom spline, lead_in is the point before the first one for a smooth join
+    """
+
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    pressures = numpy.asarray(pressures, dtype=numpy.float64).reshape(-1)
+    if smooth and len(points) > 2:
+        points, pressures = catmull_rom(points, pressures, lead_in=lead_in)
+
+    segments = numpy.diff(points, axis=0)
+    segment_lengths = numpy.linalg.norm(segments, axis=1)
+
+    # drop repeated points, interpolation needs a strictly increasing arc length
+    moving = segment_lengths > 0
+    keep = numpy.concatenate(([True], moving))
+    points = points[keep]
+    pressures = pressures[keep]
+    segments = segments[moving]
+    segment_lengths = segment_lengths[moving]
+    arc_length = numpy.concatenate(([0.0], numpy.cumsum(segment_lengths)))
+    length = arc_length[-1]
+
+    if spacing > 0:
+        count = int(length // spacing)
+    else:
+        count = 1 if length > 0 else 0
+    if max_count is not None:
+        count = min(count, max_count)
+    if count == 0:
+        return numpy.empty((0, 2)), numpy.empty((0, 2)), numpy.empty(0)
+
+    targets = length * numpy.arange(1, count + 1) / count
+    positions = numpy.column_stack((
+        numpy.interp(targets, arc_length, points[:, 0]),
+        numpy.interp(targets, arc_length, points[:, 1]),
+    ))
+
+    # tangent of the segment, every dab lies on
+    segment_index = numpy.clip(numpy.searchsorted(arc_length, targets, side='right') - 1, 0, len(segments) - 1)
+    tangents = segments[segment_index] / segment_lengths[segment_index, numpy.newaxis]
+
+    return positions, tangents, numpy.interp(targets, arc_length, pressures)
+
+
+class StrokeInput:
+    """coalesces mouse moves into a polyline, that is resampled into dabs once per modal tick
+
+    while the last tick is still more recent than it took to paint, new moves are only collected,
+    so a slow brush paints fewer, longer segments instead of falling behind the pen
+    """
+
+    def __init__(self, anchor=(0, 0)):
+        # last painted position, every polyline starts there
+        self.anchor = (float(anchor[0]), float(anchor[1]))
+        self.anchor_pressure = 1.0
+        self.lead_in = None
+
+        self.points = []
+        self.pressures = []
+        self.tick_start = 0.0
+        self.tick_end = 0.0
+        self.tick_duration = 0.0
+        self.dab_cost = 0.0
+
+    @property
+    def pending(self):
+        return len(self.points) > 0
+
+    def add(self, position, pressure):
+        self.points.append((float(position[0]), float(position[1])))
+        self.pressures.append(pressure)
+        return None
+
+    def clear(self):
+        self.points = []
+        self.pressures = []
+        return None
+
+    def resample(self, spacing, max_count=None, smooth=False):
+        """resample the anchor and the collected moves into dab positions, tangents and pressures"""
+
+        return resample_stroke(
+            [self.anchor] + self.points,
+            [self.anchor_pressure] + self.pressures,
+            spacing=spacing,
+            max_count=max_count,
+            smooth=smooth,
+            lead_in=self.lead_in
+        )
+
+    def advance(self):
+        """the collected moves are painted, the last one becomes the new anchor"""
+
+        polyline = [self.anchor] + self.points
+        self.lead_in = polyline[-2]
+        self.anchor = polyline[-1]
+        self.anchor_pressure = self.pressures[-1]
+        self.clear()
+        return None
+
+    def due(self):
+        """process right away, unless the last tick ended more recently than it took"""
+
+        return time.monotonic() - self.tick_end >= self.tick_duration
+
+    def begin_tick(self):
+        self.tick_start = time.monotonic()
+        return None
+
+    def end_tick(self, dab_count):
+        """measure the tick and update the moving average of the time one dab takes"""
+
+        self.tick_end = time.monotonic()
+        self.tick_duration = self.tick_end - self.tick_start
+        if dab_count > 0:
+            cost = self.tick_duration / dab_count
+            if self.dab_cost == 0:
+                self.dab_cost = cost
+            else:
+                self.dab_cost += (cost - self.dab_cost) * DAB_COST_SMOOTHING
+        return None
+
+    def dab_limit(self, budget):
+        """how many dabs fit into the time budget of one tick, None without budget or measurement"""
+
+        if budget <= 0 or self.dab_cost <= 0:
+            return None
+        return max(int(budget / self.dab_cost), 1)
@@ -0,0 +1,417 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+from collections import OrderedDict
+
+import numpy
+from mathutils.bvhtree import BVHTree
+
+# rays x candidate triangles, above that a batch is cast ray by ray against the bvh
+MAX_BATCH_ELEMENTS = 4000000
+# half width of the thin triangles along the rays, that find occluders, relative to the ray length
+RAY_WIDTH = 1e-4
+# traced region positions kept per view, and the grid in region pixels, that positions are snapped to
+HIT_CACHE_SIZE = 4096
+HIT_CACHE_STEP = 0.25
+# objects, whose trace sessions are kept between paint sessions
+MESH_CACHE_SIZE = 4
+
+
+def region_rays(region, rv3d, coords):
+    """world space ray origins and normalized view vectors for many region coordinates at once
+
+    vectorized version of view3d_utils.region_2d_to_origin_3d and region_2d_to_vector_3d
+    """
+
+    coords = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2)
+    ndc = 2.0 * coords / numpy.array([region.width, region.height], dtype=numpy.float64) - 1.0
+
+    persinv = numpy.array(rv3d.perspective_matrix.inverted(), dtype=numpy.float64)
+    viewinv = numpy.array(rv3d.view_matrix.inverted(), dtype=numpy.float64)
+
+    if rv3d.is_perspective:
+        clip_points = numpy.column_stack((ndc, numpy.full(len(ndc), -0.5), numpy.ones(len(ndc))))
+        points = clip_points @ persinv.T
+        points = points[:, :3] / points[:, 3:]
+        origins = numpy.broadcast_to(viewinv[:3, 3], points.shape).copy()
+        view_vectors = points - origins
+    else:
+        origins = ndc[:, 0:1] * persinv[:3, 0] + ndc[:, 1:2] * persinv[:3, 1] + persinv[:3, 3]
+        view_vectors = numpy.broadcast_to(-viewinv[:3, 2], origins.shape).copy()
+
+    view_vectors /= numpy.linalg.norm(view_vectors, axis=1)[:, numpy.newaxis]
+    return origins, view_vectors
+
+
+class MeshSnapshot:
+    """triangulated copy of the evaluated mesh in contiguous arrays, no temporary datablocks needed"""
+
+    def __init__(self, obj, depsgraph):
+        obj_eval = obj.evaluated_get(depsgraph)
+        mesh = obj_eval.to_mesh()
+        try:
+            mesh.calc_loop_triangles()
+
+            vertices = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float32)
+            mesh.vertices.foreach_get("co", vertices)
+            self.vertices = vertices.reshape(-1, 3)
+
+            triangle_count = len(mesh.loop_triangles)
+            triangles = numpy.empty(triangle_count * 3, dtype=numpy.int32)
+            mesh.loop_triangles.foreach_get("vertices", triangles)
+            self.triangles = triangles.reshape(-1, 3)
+
+            triangle_loops = numpy.empty(triangle_count * 3, dtype=numpy.int32)
+            mesh.loop_triangles.foreach_get("loops", triangle_loops)
+            self.triangle_loops = triangle_loops.reshape(-1, 3)
+
+            # uvs per triangle corner, None if the mesh has no uv map (fine for object and world space)
+            self.triangle_uvs = None
+            uv_layer = mesh.uv_layers.active
+            if uv_layer is not None:
+                loop_uvs = numpy.empty(len(mesh.loops) * 2, dtype=numpy.float32)
+                uv_layer.uv.foreach_get("vector", loop_uvs)
+                self.triangle_uvs = loop_uvs.reshape(-1, 2)[self.triangle_loops]
+        finally:
+            obj_eval.to_mesh_clear()
+
+        # per triangle tables for barycentric lookups, so resolving a hit is one indexed evaluation
+        corners = self.vertices[self.triangles]
+        self.triangle_origins = corners[:, 0]
+        self.triangle_edges_a = corners[:, 1] - corners[:, 0]
+        self.triangle_edges_b = corners[:, 2] - corners[:, 0]
+        self.dot_aa = numpy.einsum('ij,ij->i', self.triangle_edges_a, self.triangle_edges_a)
+        self.dot_ab = numpy.einsum('ij,ij->i', self.triangle_edges_a, self.triangle_edges_b)
+        self.dot_bb = numpy.einsum('ij,ij->i', self.triangle_edges_b, self.triangle_edges_b)
+        denominator = self.dot_aa * self.dot_bb - self.dot_ab * self.dot_ab
+        # degenerate triangles get weight 0 for the second and third corner
+        self.inv_denominator = numpy.divide(
+            1.0, denominator, out=numpy.zeros_like(denominator), where=denominator != 0
+        )
+
+        self.uv_areas = None
+        if self.triangle_uvs is not None:
+            uv_edges_a = self.triangle_uvs[:, 1] - self.triangle_uvs[:, 0]
+            uv_edges_b = self.triangle_uvs[:, 2] - self.triangle_uvs[:, 0]
+            self.uv_areas = 0.5 * numpy.abs(uv_edges_a[:, 0] * uv_edges_b[:, 1] - uv_edges_a[:, 1] * uv_edges_b[:, 0])
+
+    def same_geometry(self, other):
+        """same triangles, positions and uvs? then the bvh and tables of this snapshot are still valid"""
+
+        if self.triangle_uvs is None or other.triangle_uvs is None:
+            same_uvs = self.triangle_uvs is None and other.triangle_uvs is None
+        else:
+            same_uvs = numpy.array_equal(self.triangle_uvs, other.triangle_uvs)
+        return (
+            same_uvs
+            and numpy.array_equal(self.vertices, other.vertices)
+            and numpy.array_equal(self.triangles, other.triangles)
+        )
+
+    def barycentric_weights(self, locations, face_indices):
+        """barycentric weights of object space points on their triangles, vectorized over a batch of hits"""
+
+        locations = numpy.asarray(locations, dtype=numpy.float32).reshape(-1, 3)
+        face_indices = numpy.asarray(face_indices, dtype=numpy.intp).reshape(-1)
+
+        offsets = locations - self.triangle_origins[face_indices]
+        dot_pa = numpy.einsum('ij,ij->i', offsets, self.triangle_edges_a[face_indices])
+        dot_pb = numpy.einsum('ij,ij->i', offsets, self.triangle_edges_b[face_indices])
+
+        dot_aa = self.dot_aa[face_indices]
+        dot_ab = self.dot_ab[face_indices]
+        dot_bb = self.dot_bb[face_indices]
+        inv_denominator = self.inv_denominator[face_indices]
+
+        weight_b = (dot_bb * dot_pa - dot_ab * dot_pb) * inv_denominator
+        weight_c = (dot_aa * dot_pb - dot_ab * dot_pa) * inv_denominator
+        weight_a = 1.0 - weight_b - weight_c
+
+        return numpy.stack((weight_a, weight_b, weight_c), axis=1)
+
+    def uv_at(self, locations, face_indices):
+        """uv coordinates of object space hits | returns an array of shape (n, 2), or None without uv map"""
+
+        if self.triangle_uvs is None:
+            return None
+
+        weights = self.barycentric_weights(locations, face_indices)
+        uvs = self.triangle_uvs[numpy.asarray(face_indices, dtype=numpy.intp).reshape(-1)]
+        return numpy.einsum('ij,ijk->ik', weights, uvs)
+
+    def uv_scale(self, face_indices, matrix_world):
+        """how many uv units is one world unit long on the given triangles"""
+
+        face_indices = numpy.asarray(face_indices, dtype=numpy.intp).reshape(-1)
+        matrix = numpy.array(matrix_world.to_3x3(), dtype=numpy.float32)
+
+        world_edges_a = self.triangle_edges_a[face_indices] @ matrix.T
+        world_edges_b = self.triangle_edges_b[face_indices] @ matrix.T
+        world_areas = 0.5 * numpy.linalg.norm(numpy.cross(world_edges_a, world_edges_b), axis=1)
+
+        return numpy.sqrt(
+            numpy.divide(self.uv_areas[face_indices], world_areas, out=numpy.zeros_like(world_areas), where=world_areas != 0)
+        )
+
+
+class TraceHit:
+    """result of one line trace, kept in the hit cache, so the same position is not traced again"""
+
+    def __init__(self, area_pos, location, face_index, world, view_matrix, matrix_world):
+        self.area_pos = (area_pos[0], area_pos[1])
+        self.location = location
+        self.face_index = face_index
+        self.world = world
+        self.uv = None
+        self.view_matrix = view_matrix.copy()
+        self.matrix_world = matrix_world.copy()
+
+
+class HitCache:
+    """lru cache of hits and misses by snapped region position | only valid for one view and object transform"""
+
+    def __init__(self, capacity=HIT_CACHE_SIZE, step=HIT_CACHE_STEP):
+        self.capacity = capacity
+        self.step = step
+        self.hits = OrderedDict()
+        self.view_state = None
+
+    def __len__(self):
+        return len(self.hits)
+
+    def validate(self, view_matrix, matrix_world):
+        """drop every entry, when the view or the object transform changed since the last call"""
+
+        view_state = (tuple(map(tuple, view_matrix)), tuple(map(tuple, matrix_world)))
+        if view_state != self.view_state:
+            self.hits.clear()
+            self.view_state = view_state
+        return None
+
+    def key(self, area_pos):
+        return (int(round(area_pos[0] / self.step)), int(round(area_pos[1] / self.step)))
+
+    def get(self, area_pos):
+        """returns if the position is cached and its hit, which is None for a cached miss"""
+
+        key = self.key(area_pos)
+        if key not in self.hits:
+            return False, None
+        self.hits.move_to_end(key)
+        return True, self.hits[key]
+
+    def put(self, area_pos, hit):
+        key = self.key(area_pos)
+        self.hits[key] = hit
+        self.hits.move_to_end(key)
+        if len(self.hits) > self.capacity:
+            self.hits.popitem(last=False)
+        return None
+
+
+class TraceSession:
+    """everything a paint session needs for tracing, built once when the operator is invoked"""
+
+    def __init__(self, obj, snapshot):
+        self.obj = obj
+        self.snapshot = snapshot
+
+        # the bvh is built in object space, so it stays valid while the object moves
+        # face indices of hits are loop triangle indices of the snapshot
+        self.bvh = BVHTree.FromPolygons(snapshot.vertices.tolist(), snapshot.triangles.tolist(), all_triangles=True)
+
+        self.matrix_world = None
+        self.update_matrix()
+
+        # hover and scrubbing over the same area trace the same positions again
+        self.hit_cache = HitCache()
+
+        # world space vertex kd tree of vertex paint, built on demand for one object transform
+        self.vertex_index = None
+        self.vertex_index_matrix = None
+        # uv seams of uv painting, built on demand
+        self.seam_index = None
+
+    def update_matrix(self):
+        """cache the object matrix and its inverse, only recalculate when the object was transformed"""
+
+        if self.matrix_world is not None and self.matrix_world == self.obj.matrix_world:
+            return None
+
+        self.matrix_world = self.obj.matrix_world.copy()
+        self.matrix_inv = self.matrix_world.inverted()
+        self.matrix_inv_3x3 = self.matrix_inv.to_3x3()
+        return None
+
+    def ray_cast(self, ray_origin, view_vector, distance):
+        """cast a world space ray against the mesh | returns object space location, normal and face index"""
+
+        self.update_matrix()
+
+        # get the ray relative to the object
+        ray_origin_obj = self.matrix_inv @ ray_origin
+        ray_direction_obj = self.matrix_inv_3x3 @ view_vector
+
+        location, normal, face_index, _ = self.bvh.ray_cast(ray_origin_obj, ray_direction_obj, distance)
+        return location, normal, face_index
+
+    def ray_cast_batch(self, ray_origins, view_vectors, distance, center, radius):
+        """cast many world space rays at once | returns object space locations and face indices, -1 for a miss
+
+        the rays are intersected in one go with the triangles within radius of the object space center.
+        a triangle outside of that sphere can still be in front of such a hit, so one bvh overlap collects
+        every triangle, that crosses a ray before its hit, and those are intersected as well.
+        rays that miss all candidates are cast against the bvh
+        """
+
+        self.update_matrix()
+
+        matrix_inv = numpy.array(self.matrix_inv, dtype=numpy.float64)
+        origins = numpy.asarray(ray_origins, dtype=numpy.float64) @ matrix_inv[:3, :3].T + matrix_inv[:3, 3]
+        directions = numpy.asarray(view_vectors, dtype=numpy.float64) @ matrix_inv[:3, :3].T
+        directions /= numpy.linalg.norm(directions, axis=1)[:, numpy.newaxis]
+
+        ray_count = len(origins)
+        locations = numpy.full((ray_count, 3), numpy.nan)
+        face_indices = numpy.full(ray_count, -1, dtype=numpy.intp)
+
+        candidates = numpy.array([item[2] for item in self.bvh.find_nearest_range(center, radius)], dtype=numpy.intp)
+        if 0 < candidates.size and ray_count * candidates.size <= MAX_BATCH_ELEMENTS:
+            nearest_t, nearest = self.intersect_triangles(origins, directions, candidates, distance)
+            hits = numpy.isfinite(nearest_t)
+
+            # a nearer triangle outside of the candidates, like a fin in front of the surface, hides the hit
+            if hits.any():
+                occluders = self.crossing_triangles(origins[hits], directions[hits], nearest_t[hits])
+                extra = numpy.setdiff1d(occluders, candidates)
+                if extra.size:
+                    candidates = numpy.concatenate((candidates, extra))
+                    if ray_count * candidates.size <= MAX_BATCH_ELEMENTS:
+                        nearest_t, nearest = self.intersect_triangles(origins, directions, candidates, distance)
+                        hits = numpy.isfinite(nearest_t)
+                    else:
+                        hits[:] = False
+
+            locations[hits] = origins[hits] + directions[hits] * nearest_t[hits, numpy.newaxis]
+            face_indices[hits] = candidates[nearest[hits]]
+
+        # whatever is not resolved by the candidates goes through the bvh
+        for ray_index in numpy.flatnonzero(face_indices < 0):
+            location, _, face_index, _ = self.bvh.ray_cast(origins[ray_index], directions[ray_index], distance)
+            if location is not None:
+                locations[ray_index] = location
+                face_indices[ray_index] = face_index
+
+        return locations, face_indices
+
+    def intersect_triangles(self, origins, directions, candidates, distance):
+        """moeller trumbore, rays x candidate triangles | returns the nearest distance, inf for a miss, and candidate"""
+
+        snapshot = self.snapshot
+        edges_a = snapshot.triangle_edges_a[candidates][numpy.newaxis]
+        edges_b = snapshot.triangle_edges_b[candidates][numpy.newaxis]
+        ray_directions = directions[:, numpy.newaxis]
+
+        p_vectors = numpy.cross(ray_directions, edges_b)
+        determinants = numpy.sum(edges_a * p_vectors, axis=2)
+        valid = numpy.abs(determinants) > 1e-12
+        inv_determinants = numpy.divide(1.0, determinants, out=numpy.zeros_like(determinants), where=valid)
+
+        t_vectors = origins[:, numpy.newaxis] - snapshot.triangle_origins[candidates][numpy.newaxis]
+        u = numpy.sum(t_vectors * p_vectors, axis=2) * inv_determinants
+        q_vectors = numpy.cross(t_vectors, edges_a)
+        v = numpy.sum(ray_directions * q_vectors, axis=2) * inv_determinants
+        t = numpy.sum(edges_b * q_vectors, axis=2) * inv_determinants
+
+        valid &= (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0) & (t <= distance)
+        t = numpy.where(valid, t, numpy.inf)
+
+        nearest = numpy.argmin(t, axis=1)
+        return t[numpy.arange(len(origins)), nearest], nearest
+
+    def crossing_triangles(self, origins, directions, lengths):
+        """all triangles, that touch one of the ray segments, with one bvh overlap
+
+        every segment becomes a thin triangle from its origin to a short edge across its end,
+        the segment runs through the inside of it, so a triangle crossing the segment overlaps it
+        """
+
+        # any direction perpendicular to the ray
+        sides = numpy.cross(directions, (0.0, 0.0, 1.0))
+        parallel = numpy.linalg.norm(sides, axis=1) < 0.5
+        sides[parallel] = numpy.cross(directions[parallel], (1.0, 0.0, 0.0))
+        sides /= numpy.linalg.norm(sides, axis=1)[:, numpy.newaxis]
+        sides *= numpy.maximum(lengths * RAY_WIDTH, RAY_WIDTH)[:, numpy.newaxis]
+
+        ends = origins + directions * lengths[:, numpy.newaxis]
+        ray_count = len(origins)
+        vertices = numpy.concatenate((origins, ends + sides, ends - sides))
+        polygons = numpy.arange(ray_count * 3).reshape(3, ray_count).T
+
+        ray_tree = BVHTree.FromPolygons(vertices.tolist(), polygons.tolist(), all_triangles=True)
+        return numpy.unique(numpy.array([pair[0] for pair in self.bvh.overlap(ray_tree)], dtype=numpy.intp))
+
+
+class MeshCache:
+    """trace sessions of the recently painted objects, least recently used ones are dropped first
+
+    depsgraph updates only mark an entry as changed, its geometry is compared when it is used again,
+    so updates that do not touch positions, triangles or uvs, like painted vertex colors, keep the bvh
+    """
+
+    def __init__(self, capacity=MESH_CACHE_SIZE):
+        self.capacity = capacity
+        self.sessions = OrderedDict()
+        self.changed = set()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @staticmethod
+    def key(obj):
+        # pointers can be reused by new datablocks, so the names are part of the identity
+        return (obj.as_pointer(), obj.data.as_pointer(), obj.name_full, obj.data.name_full)
+
+    def get(self, obj):
+        """cached session of the object and if it may have changed | None, False if there is none"""
+
+        key = self.key(obj)
+        session = self.sessions.get(key)
+        if session is None:
+            return None, False
+        self.sessions.move_to_end(key)
+        return session, key in self.changed
+
+    def put(self, obj, session):
+        key = self.key(obj)
+        self.sessions[key] = session
+        self.sessions.move_to_end(key)
+        self.changed.discard(key)
+        while len(self.sessions) > self.capacity:
+            dropped, _ = self.sessions.popitem(last=False)
+            self.changed.discard(dropped)
+        return None
+
+    def mark_changed(self, pointer):
+        """mark the entries of an object or mesh, given by its pointer"""
+
+        for key in self.sessions:
+            if pointer == key[0] or pointer == key[1]:
+                self.changed.add(key)
+        return None
@@ -0,0 +1,218 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import os
+from collections import OrderedDict
+
+import bpy
+import numpy
+
+from . import raster
+from . import undo
+
+UDIM_FIRST = 1001
+UDIM_ROW = 10
+
+
+def tile_numbers(uvs):
+    """udim tile number of every uv coordinate, 1001 is the 0 to 1 square"""
+
+    uvs = numpy.floor(numpy.asarray(uvs, dtype=numpy.float64).reshape(-1, 2)).astype(numpy.int64)
+    return UDIM_FIRST + uvs[:, 0] + UDIM_ROW * uvs[:, 1]
+
+
+def tile_filepath(image, number):
+    """absolute path of the file of one udim tile"""
+
+    filepath = image.filepath_raw or image.filepath
+    return bpy.path.abspath(filepath.replace("<UDIM>", str(number)), library=image.library)
+
+
+def is_file_tiled(image):
+    """can the tiles of the image be read and written one by one? needs tile files on disk"""
+
+    return image.source == 'TILED' and "<UDIM>" in (image.filepath_raw or image.filepath) and image.packed_file is None
+
+
+class TiledImageBuffer:
+    """udim image, every tile is its own ImageBuffer, loaded when a dab lands on it
+
+    blender only exposes the pixels of the first tile, so tiles are loaded from and saved to their files.
+    at most capacity tiles stay in memory, the least recently painted one is written back and dropped first
+    """
+
+    def __init__(self, image, capacity):
+        self.image = image
+        self.capacity = max(capacity, 1)
+        self.width, self.height = image.size
+        self.tile_numbers = {tile.number for tile in image.tiles}
+
+        self.buffers = OrderedDict()
+        self.changed = set()
+        # tiles as they were before the stroke, per tile number, only with undo tracking
+        self.undo_snapshots = None
+
+        # flush writes nothing, the tiles are written when they are dropped
+        self.flush_cost = 0.0
+
+        # blenders own painting may not be on disk yet, the tiles are read from the files.
+        # open_image_buffer only gets here with unsaved changes, if saving them is turned on
+        if image.is_dirty:
+            image.save()
+
+    @property
+    def dirty(self):
+        return any(buffer.dirty for buffer in self.buffers.values())
+
+    @property
+    def undo_tiles(self):
+        """all stored tiles of the stroke in one snapshot, keyed by tile number and tile"""
+
+        if self.undo_snapshots is None:
+            return None
+        for number, buffer in self.buffers.items():
+            if buffer.undo_tiles is not None:
+                self.undo_snapshots[number] = buffer.undo_tiles
+        merged = undo.TileSnapshot()
+        for number, snapshot in self.undo_snapshots.items():
+            merged.merge(snapshot, prefix=number)
+        return merged
+
+    @undo_tiles.setter
+    def undo_tiles(self, value):
+        # set to None, when the stroke became an undo step
+        if value is None:
+            self.undo_snapshots = None
+            for buffer in self.buffers.values():
+                buffer.undo_tiles = None
+
+    def track_undo(self):
+        self.undo_snapshots = {}
+        for buffer in self.buffers.values():
+            buffer.track_undo()
+        return None
+
+    def tile_buffer(self, number):
+        """buffer of the tile, loaded from its file if it is not in memory | None if the tile does not exist"""
+
+        buffer = self.buffers.get(number)
+        if buffer is not None:
+            self.buffers.move_to_end(number)
+            return buffer
+
+        filepath = tile_filepath(self.image, number)
+        if number not in self.tile_numbers or not os.path.exists(filepath):
+            return None
+
+        tile_image = bpy.data.images.load(filepath, check_existing=False)
+        tile_image.colorspace_settings.name = self.image.colorspace_settings.name
+        buffer = raster.ImageBuffer(tile_image)
+
+        if self.undo_snapshots is not None:
+            buffer.track_undo()
+            # a tile, that was dropped during the stroke, keeps the state from before the stroke
+            snapshot = self.undo_snapshots.get(number)
+            if snapshot is not None:
+                buffer.undo_tiles = snapshot
+                for tile_y, tile_x in snapshot.tiles:
+                    buffer.saved_tiles[tile_y, tile_x] = True
+
+        self.buffers[number] = buffer
+        while len(self.buffers) > self.capacity:
+            self.drop_tile(next(iter(self.buffers)))
+        return buffer
+
+    def write_tile(self, number, buffer):
+        """write the tile buffer into its image and file"""
+
+        buffer.flush()
+        if number in self.changed:
+            buffer.image.save()
+        return None
+
+    def drop_tile(self, number):
+        buffer = self.buffers.pop(number)
+        self.write_tile(number, buffer)
+        if self.undo_snapshots is not None and buffer.undo_tiles is not None:
+            self.undo_snapshots[number] = buffer.undo_tiles
+        bpy.data.images.remove(buffer.image)
+        return None
+
+    def paint_dabs_uv(self, uvs, radii, colors, strengths, falloff, stamps=None, clips=None):
+        """blend round dabs into the tiles under their centers | radii are in uv units, like on a 0 to 1 image
+
+        a dab is painted into the tile of its center and clipped at the tile border and to its clip triangles
+        """
+
+        uvs = numpy.asarray(uvs, dtype=numpy.float64).reshape(-1, 2)
+        radii = numpy.asarray(radii, dtype=numpy.float64)
+        numbers = tile_numbers(uvs)
+
+        for number in numpy.unique(numbers).tolist():
+            buffer = self.tile_buffer(number)
+            if buffer is None:
+                continue
+            selected = numpy.flatnonzero(numbers == number)
+            tile_origin = numpy.floor(uvs[selected[0]])
+            local_uvs = uvs[selected] - tile_origin
+            buffer.paint_dabs_uv(
+                local_uvs,
+                radii[selected],
+                [colors[index] for index in selected],
+                [strengths[index] for index in selected],
+                falloff,
+                stamps=stamps,
+                clips=None if clips is None else [
+                    None if clips[index] is None else clips[index] - tile_origin for index in selected
+                ]
+            )
+            self.changed.add(number)
+
+        return None
+
+    def swap_tiles(self, snapshot):
+        """write a merged snapshot back into the tiles | returns the merged snapshot of the replaced tiles"""
+
+        replaced = undo.TileSnapshot()
+        for number, tile_snapshot in snapshot.split().items():
+            buffer = self.tile_buffer(number)
+            if buffer is None:
+                continue
+            replaced.merge(buffer.swap_tiles(tile_snapshot), prefix=number)
+            self.changed.add(number)
+        return replaced
+
+    def flush(self, interval=None):
+        """nothing to do | the tile images are not shown, write_tile writes them, when they are dropped or closed
+
+        the udim image only shows the painted tiles after close, reloading it reads every tile file again
+        """
+
+        return False
+
+    def close(self):
+        """save and drop all tiles, then reload the udim image, so it shows them | only at the end of a stroke"""
+
+        changed = bool(self.changed)
+        for number in list(self.buffers):
+            self.drop_tile(number)
+        self.changed = set()
+        if changed:
+            self.image.reload()
+        return None
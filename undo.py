@@ -0,0 +1,141 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import zlib
+
+import numpy
+
+# fast compression, flow maps are smooth enough, that level 1 already gets most of it
+COMPRESSION_LEVEL = 1
+
+
+class TileSnapshot:
+    """zlib compressed copies of buffer tiles, keyed by tile | lossless, so undo restores the exact values"""
+
+    def __init__(self):
+        self.tiles = {}
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def store(self, key, array):
+        data = zlib.compress(numpy.ascontiguousarray(array).tobytes(), COMPRESSION_LEVEL)
+        self.tiles[key] = (data, array.shape, array.dtype.str)
+        self.nbytes += len(data)
+        return None
+
+    def items(self):
+        """keys and decompressed tiles"""
+
+        for key, (data, shape, dtype) in self.tiles.items():
+            yield key, numpy.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+
+    def merge(self, other, prefix):
+        """take over the tiles of another snapshot, with the prefix in front of their keys"""
+
+        for key, entry in other.tiles.items():
+            self.tiles[(prefix,) + key] = entry
+            self.nbytes += len(entry[0])
+        return None
+
+    def split(self):
+        """undo merge, one snapshot per key prefix"""
+
+        snapshots = {}
+        for key, entry in self.tiles.items():
+            snapshot = snapshots.get(key[0])
+            if snapshot is None:
+                snapshot = snapshots[key[0]] = TileSnapshot()
+            snapshot.tiles[key[1:]] = entry
+            snapshot.nbytes += len(entry[0])
+        return snapshots
+
+
+class UndoStep:
+    """tiles of one image or color attribute, as they were before a stroke"""
+
+    def __init__(self, target_type, target_name, attribute_name, size, snapshot):
+        # 'IMAGE' or 'COLOR_ATTRIBUTE', the name of the image or mesh and of the color attribute
+        self.target_type = target_type
+        self.target_name = target_name
+        self.attribute_name = attribute_name
+        # image size or color count, the tiles are only valid on the same size
+        self.size = size
+        self.snapshot = snapshot
+
+    @property
+    def nbytes(self):
+        return self.snapshot.nbytes
+
+    def inverse(self, snapshot):
+        """the step, that takes the target back to before this step was applied"""
+
+        return UndoStep(self.target_type, self.target_name, self.attribute_name, self.size, snapshot)
+
+
+class UndoStack:
+    """one undo step per stroke, the oldest steps are dropped when the memory budget is exceeded"""
+
+    def __init__(self):
+        self.undo_steps = []
+        self.redo_steps = []
+
+    @property
+    def nbytes(self):
+        return sum(step.nbytes for step in self.undo_steps) + sum(step.nbytes for step in self.redo_steps)
+
+    def push(self, step, budget):
+        """a new stroke, clears the redo steps | returns False, if the step alone exceeds the budget and was dropped"""
+
+        self.undo_steps.append(step)
+        self.redo_steps = []
+        self.evict(budget)
+        return len(self.undo_steps) > 0 and self.undo_steps[-1] is step
+
+    def peek(self, redo=False):
+        """the step, that pop would return, without removing it"""
+
+        steps = self.redo_steps if redo else self.undo_steps
+        if not steps:
+            return None
+        return steps[-1]
+
+    def pop(self, redo=False):
+        steps = self.redo_steps if redo else self.undo_steps
+        if not steps:
+            return None
+        return steps.pop()
+
+    def push_inverse(self, step, redo=False):
+        """after undo, the inverse goes onto the redo steps and the other way round"""
+
+        if redo:
+            self.undo_steps.append(step)
+        else:
+            self.redo_steps.append(step)
+        return None
+
+    def evict(self, budget):
+        """drop the oldest steps until the budget in bytes is met | a step bigger than the budget is dropped as well"""
+
+        total = self.nbytes
+        while total > budget and len(self.undo_steps) > 0:
+            total -= self.undo_steps.pop(0).nbytes
+        return None
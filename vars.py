@@ -17,8 +17,17 @@
 #
 # ##### END GPL LICENSE BLOCK #####
 
-circle = None
-circle_pos = (0, 0)
-tri_obj = None
+cursor = None
 pressing = False
 mode = None
+image_buffer = None
+trace_session = None
+color_buffer = None
+vertex_index = None
+recorder = None
+stage_timings = None
+undo_stack = None
+mesh_cache = None
+stamp_cache = None
+dab_worker = None
+scratch_buffers = {}
@@ -0,0 +1,167 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import time
+
+import numpy
+from mathutils.kdtree import KDTree
+
+from . import undo
+
+# colors per undo chunk, the color attribute counterpart of an image tile
+UNDO_CHUNK_SIZE = 4096
+
+
+class VertexIndex:
+    """kd tree over the world positions of the mesh vertices and a vertex to corner lookup, built once per session"""
+
+    def __init__(self, obj):
+        mesh = obj.data
+
+        vertices = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float32)
+        mesh.vertices.foreach_get("co", vertices)
+        vertices = vertices.reshape(-1, 3)
+        matrix = numpy.array(obj.matrix_world, dtype=numpy.float32)
+        world_vertices = vertices @ matrix[:3, :3].T + matrix[:3, 3]
+
+        self.tree = KDTree(len(world_vertices))
+        for index, co in enumerate(world_vertices.tolist()):
+            self.tree.insert(co, index)
+        self.tree.balance()
+
+        # corners (loops) of every vertex, sorted by vertex, offsets like a csr matrix
+        loop_vertices = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+        mesh.loops.foreach_get("vertex_index", loop_vertices)
+        self.vertex_loops = numpy.argsort(loop_vertices, kind='stable')
+        self.vertex_loop_offsets = numpy.searchsorted(
+            loop_vertices[self.vertex_loops], numpy.arange(len(vertices) + 1)
+        )
+
+    def find_range(self, co, radius):
+        """indices and distances of all vertices within radius of the world space position"""
+
+        found = self.tree.find_range(co, radius)
+        indices = numpy.fromiter((index for _, index, _ in found), dtype=numpy.intp, count=len(found))
+        distances = numpy.fromiter((distance for _, _, distance in found), dtype=numpy.float32, count=len(found))
+        return indices, distances
+
+    def corners(self, indices, values):
+        """expand per vertex indices and values to all corners of those vertices"""
+
+        starts = self.vertex_loop_offsets[indices]
+        counts = self.vertex_loop_offsets[indices + 1] - starts
+        positions = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts - starts, counts)
+        return self.vertex_loops[positions], numpy.repeat(values, counts)
+
+
+class ColorAttributeBuffer:
+    """float32 copy of the active color attribute, dabs are blended into it and written back with one foreach_set
+
+    colors are read and written through the linear color property, so flow values are not sRGB converted
+    """
+
+    def __init__(self, mesh, vertex_index, attribute=None):
+        self.mesh = mesh
+        self.vertex_index = vertex_index
+        self.attribute = attribute if attribute is not None else mesh.color_attributes.active_color
+        self.corner_domain = self.attribute.domain == 'CORNER'
+
+        colors = numpy.empty(len(self.attribute.data) * 4, dtype=numpy.float32)
+        self.attribute.data.foreach_get("color", colors)
+        self.colors = colors.reshape(-1, 4)
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        # seconds the last write back took
+        self.flush_cost = 0.0
+
+        # chunks as they were before the stroke, only with undo tracking
+        self.undo_tiles = None
+        self.saved_chunks = None
+
+    def track_undo(self):
+        """from now on, every chunk of colors is stored before it is painted the first time"""
+
+        self.undo_tiles = undo.TileSnapshot()
+        self.saved_chunks = numpy.zeros(-(-len(self.colors) // UNDO_CHUNK_SIZE), dtype=bool)
+        return None
+
+    def save_chunks(self, indices):
+        """store the chunks containing the color indices, that were not stored yet"""
+
+        chunks = numpy.unique(indices // UNDO_CHUNK_SIZE)
+        chunks = chunks[~self.saved_chunks[chunks]]
+        for chunk in chunks.tolist():
+            self.undo_tiles.store(chunk, self.colors[chunk * UNDO_CHUNK_SIZE:(chunk + 1) * UNDO_CHUNK_SIZE])
+        self.saved_chunks[chunks] = True
+        return None
+
+    def swap_tiles(self, snapshot):
+        """write the chunks of the snapshot into the colors | returns a snapshot of the chunks they replaced"""
+
+        replaced = undo.TileSnapshot()
+        for chunk, colors in snapshot.items():
+            window = self.colors[chunk * UNDO_CHUNK_SIZE:chunk * UNDO_CHUNK_SIZE + len(colors)]
+            replaced.store(chunk, window)
+            window[...] = colors
+            self.dirty = True
+        return replaced
+
+    def paint_dabs(self, centers, radii, colors, strengths, falloff):
+        """blend round dabs into the colors | centers and radii are in world space, dabs are applied in order"""
+
+        lut_max = len(falloff) - 1
+
+        for center, radius, color, strength in zip(centers, radii, colors, strengths):
+            if radius <= 0 or strength <= 0:
+                continue
+
+            indices, distances = self.vertex_index.find_range(center, radius)
+            if indices.size == 0:
+                continue
+
+            lut_index = numpy.minimum(distances / radius * lut_max, lut_max).astype(numpy.intp)
+            alpha = falloff[lut_index] * numpy.float32(strength)
+
+            if self.corner_domain:
+                indices, alpha = self.vertex_index.corners(indices, alpha)
+
+            if self.undo_tiles is not None:
+                self.save_chunks(indices)
+
+            dab_color = numpy.asarray(color[:3], dtype=numpy.float32)
+            self.colors[indices, :3] += (dab_color - self.colors[indices, :3]) * alpha[:, numpy.newaxis]
+
+            self.dirty = True
+
+        return None
+
+    def flush(self, interval=None):
+        """write the colors back into the color attribute | during a stroke, skip until the interval has passed"""
+
+        now = time.monotonic()
+        if not self.dirty or interval is not None and now - self.last_flush < interval:
+            return False
+
+        start = time.perf_counter()
+        self.attribute.data.foreach_set("color", self.colors.ravel())
+        self.mesh.update()
+        self.flush_cost = time.perf_counter() - start
+        self.dirty = False
+        self.last_flush = now
+        return True
@@ -0,0 +1,71 @@
+# Copyright (C) 2021 Clemens Beute
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import queue
+import threading
+
+
+class DabWorker:
+    """thread, that composites queued dabs into the working buffers, the modal handler only computes the dabs
+
+    numpy releases the gil while blending, so the main thread keeps handling input meanwhile.
+    the lock guards the buffers, the main thread holds it while it writes them back into blender
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="flowmap dab worker", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return None
+                function, args, kwargs = job
+                # after an error, the remaining jobs of the stroke are dropped
+                if self.error is None:
+                    with self.lock:
+                        function(*args, **kwargs)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, function, *args, **kwargs):
+        self.jobs.put((function, args, kwargs))
+        return None
+
+    def wait(self):
+        """block until every queued job is done | raises the first error of the worker"""
+
+        self.jobs.join()
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+        return None
+
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
+        return None